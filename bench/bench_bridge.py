@@ -0,0 +1,323 @@
+"""
+End-to-end throughput and latency benchmark of the bridge, without any network.
+
+It starts an OSC2MQTTBridge against the in-process MiniBroker (TLS optional), then drives N
+SLIP framed OSC TCP clients (OSC -> MQTT) and M MQTT publishers (MQTT -> OSC) at once. It
+reports the messages/s and p50/p99/p999 latencies of each direction, the CPU time and RSS of
+the process (bridge and load generators together), and saves them as JSON, so runs can be
+compared across commits.
+
+Usage: python bench/bench_bridge.py [--osc-clients N] [--mqtt-publishers M] [--messages K]
+                                    [--output results.json]
+"""
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+
+from oscpy.parser import format_message, read_packet  # noqa: E402
+from paho.mqtt import client as mqtt  # noqa: E402
+from mini_broker import MiniBroker  # noqa: E402
+from osc2mqtt_bridge import OSC2MQTTBridge  # noqa: E402
+from osc_framing import encode_slip  # noqa: E402
+
+TOPIC_STAT = "bench/stat"
+TOPIC_CMND = "bench/cmnd"
+
+
+def free_port(kind=socket.SOCK_STREAM):
+    """
+    Find a free local port.
+
+    :param kind: The socket type.
+    :return: The port.
+    """
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(latencies):
+    """
+    Compute the latency percentiles.
+
+    :param latencies: The list of latencies, in seconds.
+    :return: A dictionary of the p50, p99, p999 and max latencies, in milliseconds.
+    """
+    if not latencies:
+        return {}
+    latencies = sorted(latencies)
+
+    def pick(q):
+        return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 3)
+    return {"p50_ms": pick(0.5), "p99_ms": pick(0.99), "p999_ms": pick(0.999),
+            "max_ms": round(latencies[-1] * 1000, 3)}
+
+
+def new_mqtt_client(client_id, port, tls):
+    """
+    Create an MQTT client connected to the broker.
+
+    :param client_id: The client ID.
+    :param port: The port of the broker.
+    :param tls: Whether to connect with TLS, without verifying the certificate.
+    :return: The client, with its network loop started.
+    """
+    client = mqtt.Client(client_id=client_id, callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+    if tls:
+        client.tls_set(cert_reqs=mqtt.ssl.CERT_NONE)
+        client.tls_insecure_set(True)
+    client.connect("127.0.0.1", port)
+    client.loop_start()
+    return client
+
+
+class Direction:
+    """
+    The send times and latencies of one direction of the bridge.
+    """
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.sent = {}
+        self.latencies = []
+        self.first_sent = None
+        self.last_received = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def on_sent(self, key):
+        now = time.perf_counter()
+        with self.lock:
+            self.sent[key] = now
+            if self.first_sent is None:
+                self.first_sent = now
+
+    def on_received(self, key):
+        now = time.perf_counter()
+        with self.lock:
+            sent = self.sent.pop(key, None)
+            if sent is None:
+                return
+            self.latencies.append(now - sent)
+            self.last_received = now
+            if len(self.latencies) >= self.expected:
+                self.done.set()
+
+    def results(self):
+        received = len(self.latencies)
+        elapsed = (self.last_received - self.first_sent) if received else 0
+        return {"sent": self.expected, "received": received,
+                "messages_per_s": round(received / elapsed) if elapsed else 0,
+                **percentiles(self.latencies)}
+
+
+def run_osc_client(index, tcp_port, messages, rate, direction, finished):
+    """
+    Send OSC messages to the bridge over a SLIP framed TCP connection.
+
+    :param index: The index of the client, used in the OSC address.
+    :param tcp_port: The TCP port of the bridge.
+    :param messages: The number of messages to send.
+    :param rate: The messages per second, 0 to send as fast as possible.
+    :param direction: The Direction recording the send times.
+    :param finished: The event set once both directions are done.
+    """
+    with socket.create_connection(("127.0.0.1", tcp_port)) as sock:
+        address = b"/bench/%d" % index
+        start = time.perf_counter()
+        for seq in range(messages):
+            packet = encode_slip(format_message(address, [index, seq])[0])
+            direction.on_sent((index, seq))
+            sock.sendall(packet)
+            if rate:
+                delay = start + (seq + 1) / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        # The bridge sends the MQTT messages to the connected clients only: keep the
+        # connection open until the messages of both directions went through
+        finished.wait(120)
+
+
+def run_mqtt_publisher(index, client, messages, rate, qos, direction):
+    """
+    Publish JSON messages to the subscribe topic of the bridge.
+
+    :param index: The index of the publisher, used in the topic.
+    :param client: The connected MQTT client.
+    :param messages: The number of messages to publish.
+    :param rate: The messages per second, 0 to publish as fast as possible.
+    :param qos: The QoS of the messages.
+    :param direction: The Direction recording the send times.
+    """
+    topic = f"{TOPIC_CMND}/bench/{index}"
+    start = time.perf_counter()
+    for seq in range(messages):
+        direction.on_sent((index, seq))
+        client.publish(topic, json.dumps([index, seq]), qos)
+        if rate:
+            delay = start + (seq + 1) / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def receive_osc(sock, direction, stop):
+    """
+    Receive the OSC messages sent by the bridge to the clients.
+
+    :param sock: The UDP socket bound to the client port.
+    :param direction: The Direction recording the latencies.
+    :param stop: The event stopping the reception.
+    """
+    sock.settimeout(0.2)
+    while not stop.is_set():
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            continue
+        for _, _, values, _ in read_packet(data):
+            if len(values) == 2:
+                direction.on_received(tuple(values))
+
+
+def git_commit():
+    """
+    Get the current git commit, if any.
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def rss_kb():
+    """
+    Get the current resident set size of the process, in KiB.
+    """
+    try:
+        with open("/proc/self/status", encoding="utf-8") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--osc-clients", type=int, default=4, help="OSC TCP clients")
+    parser.add_argument("--mqtt-publishers", type=int, default=2, help="MQTT publishers")
+    parser.add_argument("--messages", type=int, default=5000, help="messages per client")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="messages/s per client, 0 for as fast as possible")
+    parser.add_argument("--qos", type=int, default=0, help="QoS of the messages")
+    parser.add_argument("--engine", default="asyncio", choices=("threads", "asyncio"))
+    parser.add_argument("--unix", action="store_true",
+                        help="forward OSC through the Unix socket instead of the direct mode")
+    parser.add_argument("--certfile", help="certificate to enable TLS on the broker")
+    parser.add_argument("--keyfile", help="key of the certificate")
+    parser.add_argument("--output", help="JSON file to save the results to")
+    args = parser.parse_args()
+
+    tls = bool(args.certfile)
+    broker = MiniBroker(certfile=args.certfile, keyfile=args.keyfile)
+    mqtt_port = broker.start()
+    tcp_port, udp_port = free_port(), free_port(socket.SOCK_DGRAM)
+    config = {
+        "mqtt": {
+            "connection": {"broker": "127.0.0.1", "port": mqtt_port, "client_id": "bench-bridge",
+                           "username": "bench", "password": "bench", "tls": tls},
+            "topics": {"publish": TOPIC_STAT, "subscribe": TOPIC_CMND},
+            "publishing": {"qos": args.qos},
+        },
+        "osc": {"net": "127.0.0.1", "port": tcp_port, "max_connections": 64,
+                "engine": args.engine, "direct": not args.unix,
+                "unix_socket_path": f"/tmp/osc2mqtt-bench-{os.getpid()}.sock",
+                "client_port": udp_port},
+        "bridge": {"auto_reset": []},
+    }
+    if tls:
+        # The bridge verifies the self signed certificate of the benchmark, trusted as its own
+        # CA: it must be issued for 127.0.0.1
+        config["mqtt"]["connection"]["ca_certs"] = args.certfile
+    bridge = OSC2MQTTBridge(config)
+    bridge.start()
+
+    o2m = Direction(args.osc_clients * args.messages)
+    m2o = Direction(args.mqtt_publishers * args.messages)
+    subscriber = new_mqtt_client("bench-subscriber", mqtt_port, tls)
+    subscriber.on_message = lambda client, userdata, msg: o2m.on_received(
+        tuple(json.loads(msg.payload)))
+    subscriber.subscribe(TOPIC_STAT + "/#")
+    publishers = [new_mqtt_client(f"bench-publisher-{i}", mqtt_port, tls)
+                  for i in range(args.mqtt_publishers)]
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    udp.bind(("127.0.0.1", udp_port))
+    stop, finished = threading.Event(), threading.Event()
+    receiver = threading.Thread(target=receive_osc, args=(udp, m2o, stop))
+    receiver.start()
+    # Let the subscriptions and the bridge settle
+    time.sleep(1)
+
+    usage_start, wall_start = resource.getrusage(resource.RUSAGE_SELF), time.perf_counter()
+    threads = [threading.Thread(target=run_osc_client,
+                                args=(i, tcp_port, args.messages, args.rate, o2m, finished))
+               for i in range(args.osc_clients)]
+    # The m2o messages only reach the OSC clients once they are connected
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+    threads += [threading.Thread(target=run_mqtt_publisher,
+                                 args=(i, client, args.messages, args.rate, args.qos, m2o))
+                for i, client in enumerate(publishers)]
+    for thread in threads[args.osc_clients:]:
+        thread.start()
+    o2m.done.wait(60)
+    m2o.done.wait(60)
+    finished.set()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - wall_start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    stop.set()
+    receiver.join()
+    udp.close()
+    for client in publishers + [subscriber]:
+        client.loop_stop()
+        client.disconnect()
+    bridge.stop()
+    broker.stop()
+
+    cpu = (usage.ru_utime - usage_start.ru_utime) + (usage.ru_stime - usage_start.ru_stime)
+    results = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "parameters": vars(args),
+        "osc_to_mqtt": o2m.results(),
+        "mqtt_to_osc": m2o.results(),
+        "wall_s": round(wall, 3),
+        "cpu_s": round(cpu, 3),
+        "cpu_percent": round(100 * cpu / wall, 1) if wall else 0,
+        "rss_kb": rss_kb(),
+        "max_rss_kb": usage.ru_maxrss,
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
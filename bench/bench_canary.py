@@ -0,0 +1,78 @@
+"""
+Run a bridge with its canary (bridge.canary) against the in-process MiniBroker, standing in for
+the production broker, and report the latency measured by the probes.
+
+It reports the probes sent and lost per direction, the alerts, and the p50/p99 latencies of each
+path (o2m, m2o and round_trip), as estimated from the buckets of the canary histograms. With
+--config, the bridge is configured from a YAML file, its MQTT connection being redirected to the
+stand-in broker.
+
+Usage: python bench/bench_canary.py [--duration S] [--interval S] [--threshold S]
+                                    [--config config.yaml] [--output results.json]
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+
+from bench_bridge import free_port, git_commit  # noqa: E402
+from canary import LATENCY, PATHS  # noqa: E402
+from metrics import METRICS  # noqa: E402
+from mini_broker import MiniBroker  # noqa: E402
+from osc2mqtt_bridge import OSC2MQTTBridge  # noqa: E402
+from replay import bridge_config  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--duration", type=float, default=10, help="seconds of probing")
+    parser.add_argument("--interval", type=float, default=0.1, help="seconds between probes")
+    parser.add_argument("--threshold", type=float, default=0.05,
+                        help="one-way latency (s) alerted beyond")
+    parser.add_argument("--config", help="YAML configuration of the bridge")
+    parser.add_argument("--output", help="JSON file to save the results to")
+    args = parser.parse_args()
+
+    broker = MiniBroker()
+    config = bridge_config(args.config, broker.start(), free_port(),
+                           free_port(socket.SOCK_DGRAM))
+    config["bridge"]["canary"] = {"interval": args.interval, "threshold": args.threshold}
+    bridge = OSC2MQTTBridge(config)
+    bridge.start()
+    try:
+        time.sleep(args.duration)
+    finally:
+        bridge.stop()
+        broker.stop()
+
+    results = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "parameters": vars(args),
+    }
+    for direction in ("o2m", "m2o"):
+        results[f"sent_{direction}"] = METRICS.counter(
+            "osc2mqtt_canary_probes_total", "", direction=direction).value
+        results[f"lost_{direction}"] = METRICS.counter(
+            "osc2mqtt_canary_lost_total", "", direction=direction).value
+    for path in PATHS:
+        histogram = METRICS.histogram(LATENCY, "", path=path)
+        results[path] = {
+            "count": histogram.count,
+            "alerts": METRICS.counter("osc2mqtt_canary_alerts_total", "", path=path).value,
+            "p50_ms": (histogram.quantile(0.5) or 0) * 1000,
+            "p99_ms": (histogram.quantile(0.99) or 0) * 1000,
+        }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Micro-benchmark of the OSC TCP stream decoders.
+
+It builds a large synthetic stream of OSC messages, about a quarter of them needing SLIP escapes,
+and measures how many frames per second each decoder extracts when the stream is received
+in chunks, the way `recv_into` fills the decoder buffer.
+
+Usage: python bench/bench_framing.py [--messages N] [--chunk BYTES]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from oscpy.parser import format_message  # noqa: E402
+from osc_framing import (LengthPrefixDecoder, SlipDecoder,  # noqa: E402
+                         encode_length_prefixed, encode_slip)
+
+
+def build_packets(count, seed=0):
+    """
+    Build synthetic OSC messages, looking like fader and button updates.
+
+    :param count: The number of messages.
+    :param seed: The random seed.
+    :return: The list of OSC packets.
+    """
+    rng = random.Random(seed)
+    packets = []
+    for i in range(count):
+        address = b"/fader/%d" % (i % 64) if i % 4 else b"/cue/%d/go" % (i % 16)
+        # 6.0 is encoded as 0x40c00000 and needs a SLIP escape
+        value = 6.0 if i % 4 == 1 else rng.random()
+        packets.append(format_message(address, [value, i])[0])
+    return packets
+
+
+def legacy_split(stream, chunk):
+    """
+    The decoding done before the streaming decoders: split each chunk on END.
+
+    :param stream: The SLIP stream.
+    :param chunk: The size of a received chunk.
+    :return: The number of frames.
+    """
+    count = 0
+    last_part = b''
+    for i in range(0, len(stream), chunk):
+        data_parts = stream[i:i + chunk].split(b'\xc0')
+        if data_parts[0]:
+            last_part = b''
+            count += 1
+        for part in data_parts[1:-1]:
+            if part:
+                count += 1
+        if data_parts[:-1]:
+            last_part = data_parts[-1]
+    return count
+
+
+def run_decoder(decoder, stream, chunk):
+    """
+    Feed a stream to a decoder, chunk by chunk, through its receive buffer.
+
+    :param decoder: The StreamDecoder.
+    :param stream: The framed stream.
+    :param chunk: The maximum size of a received chunk.
+    :return: The number of frames.
+    """
+    count = 0
+    view = memoryview(stream)
+    offset = 0
+    while offset < len(stream):
+        buf = decoder.get_buffer()
+        nbytes = min(len(buf), chunk, len(stream) - offset)
+        buf[:nbytes] = view[offset:offset + nbytes]
+        offset += nbytes
+        count += len(decoder.buffer_updated(nbytes))
+    return count
+
+
+def bench(name, func, expected):
+    """
+    Time a decoding function and print its throughput.
+
+    :param name: The name of the benchmark.
+    :param func: The function returning the number of decoded frames.
+    :param expected: The expected number of frames, or None to not check it.
+    """
+    start = time.perf_counter()
+    count = func()
+    elapsed = time.perf_counter() - start
+    status = "" if expected is None or count == expected else f" (expected {expected} frames)"
+    print(f"{name:<16} {count:>9} frames {elapsed:8.3f} s {count / elapsed:>12,.0f} frames/s{status}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=500_000)
+    parser.add_argument("--chunk", type=int, default=64 * 1024)
+    args = parser.parse_args()
+
+    packets = build_packets(args.messages)
+    slip_stream = b''.join(encode_slip(p) for p in packets)
+    length_stream = b''.join(encode_length_prefixed(p) for p in packets)
+    print(f"{args.messages} messages, SLIP stream {len(slip_stream)} bytes, "
+          f"chunks of {args.chunk} bytes")
+    # The legacy decoding does not handle escapes, its frame count is not checked
+    bench("legacy split", lambda: legacy_split(slip_stream, args.chunk), None)
+    bench("slip", lambda: run_decoder(SlipDecoder(), slip_stream, args.chunk), len(packets))
+    bench("length prefix", lambda: run_decoder(LengthPrefixDecoder(), length_stream, args.chunk),
+          len(packets))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+A minimal in-process MQTT 3.1.1 broker, standing in for the real broker in benchmarks and tools.
+
+It accepts any credentials, handles QoS 0, 1 and 2 publishes, subscriptions with wildcards and
+retained messages, and delivers every message with QoS 0. TLS is enabled by giving a certificate
+and its key. It is not meant to be used as a real broker.
+"""
+import asyncio
+import logging
+import ssl
+import struct
+import threading
+
+from paho.mqtt.client import topic_matches_sub
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+
+def _packet(packet_type, flags, body):
+    """
+    Build an MQTT packet.
+
+    :param packet_type: The packet type.
+    :param flags: The flags of the fixed header.
+    :param body: The variable header and payload.
+    :return: The packet.
+    """
+    length = len(body)
+    header = bytearray([packet_type << 4 | flags])
+    while True:
+        byte, length = length % 128, length // 128
+        header.append(byte | (0x80 if length else 0))
+        if not length:
+            break
+    return bytes(header) + body
+
+
+def _publish_packet(topic, payload, retain=False):
+    """
+    Build a QoS 0 PUBLISH packet.
+
+    :param topic: The topic, as bytes.
+    :param payload: The payload.
+    :param retain: The retain flag.
+    :return: The packet.
+    """
+    return _packet(PUBLISH, int(retain), struct.pack(">H", len(topic)) + topic + payload)
+
+
+class _Session:
+    """
+    A connected client.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.task = asyncio.current_task()
+        self.subscriptions = set()
+
+
+class MiniBroker:
+    """
+    The broker, running its own event loop in a separate thread.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, certfile=None, keyfile=None):
+        """
+        Initialize the MiniBroker.
+
+        :param host: The address to listen on (default is "127.0.0.1").
+        :param port: The port to listen on (default is a free port).
+        :param certfile: The certificate file, to enable TLS.
+        :param keyfile: The key file of the certificate.
+        """
+        self.host = host
+        self.port = port
+        self.ssl_context = None
+        if certfile:
+            self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            self.ssl_context.load_cert_chain(certfile, keyfile)
+        self.sessions = set()
+        self.retained = {}
+        self.published = 0  # Number of PUBLISH packets received
+        self.loop = None
+        self.thread = None
+        self._started = threading.Event()
+        self._stopped = None
+
+    def start(self):
+        """
+        Start the broker, and wait for it to listen.
+
+        :return: The port the broker listens on.
+        """
+        self.thread = threading.Thread(target=self._run, name="mini_broker", daemon=True)
+        self.thread.start()
+        self._started.wait()
+        return self.port
+
+    def stop(self):
+        """
+        Stop the broker.
+        """
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._stopped.set)
+            self.thread.join()
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        self._stopped = asyncio.Event()
+        self.loop.run_until_complete(self._serve())
+        self.loop.close()
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._handle, self.host, self.port,
+                                            ssl=self.ssl_context)
+        self.port = server.sockets[0].getsockname()[1]
+        self._started.set()
+        async with server:
+            await self._stopped.wait()
+            server.close()
+            tasks = [session.task for session in self.sessions]
+            for session in list(self.sessions):
+                session.writer.close()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _handle(self, reader, writer):
+        session = _Session(writer)
+        self.sessions.add(session)
+        try:
+            while True:
+                first = await reader.readexactly(1)
+                length, multiplier = 0, 1
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7f) * multiplier
+                    multiplier *= 128
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length)
+                if not self._dispatch(session, first[0] >> 4, first[0] & 0x0f, body):
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logging.exception("Mini broker error: %s", e)
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+
+    def _dispatch(self, session, packet_type, flags, body):
+        """
+        Handle a packet from a client.
+
+        :return: False to close the connection.
+        """
+        write = session.writer.write
+        if packet_type == CONNECT:
+            write(_packet(CONNACK, 0, b"\x00\x00"))
+        elif packet_type == PUBLISH:
+            qos, retain = (flags >> 1) & 3, flags & 1
+            topic_length = struct.unpack_from(">H", body)[0]
+            topic = body[2:2 + topic_length]
+            offset = 2 + topic_length
+            if qos:
+                packet_id = body[offset:offset + 2]
+                offset += 2
+                write(_packet(PUBACK if qos == 1 else PUBREC, 0, packet_id))
+            self.published += 1
+            self._deliver(topic, body[offset:], retain)
+        elif packet_type == PUBREL:
+            write(_packet(PUBCOMP, 0, body[:2]))
+        elif packet_type == SUBSCRIBE:
+            packet_id, offset, granted = body[:2], 2, bytearray()
+            while offset < len(body):
+                length = struct.unpack_from(">H", body, offset)[0]
+                topic_filter = body[offset + 2:offset + 2 + length].decode("utf-8")
+                offset += 3 + length
+                session.subscriptions.add(topic_filter)
+                granted.append(0)
+                for topic, payload in self.retained.items():
+                    if topic_matches_sub(topic_filter, topic.decode("utf-8")):
+                        write(_publish_packet(topic, payload, True))
+            write(_packet(SUBACK, 0, packet_id + bytes(granted)))
+        elif packet_type == UNSUBSCRIBE:
+            offset = 2
+            while offset < len(body):
+                length = struct.unpack_from(">H", body, offset)[0]
+                session.subscriptions.discard(body[offset + 2:offset + 2 + length].decode("utf-8"))
+                offset += 2 + length
+            write(_packet(UNSUBACK, 0, body[:2]))
+        elif packet_type == PINGREQ:
+            write(_packet(PINGRESP, 0, b""))
+        elif packet_type == DISCONNECT:
+            return False
+        return True
+
+    def _deliver(self, topic, payload, retain):
+        """
+        Send a message to the subscribed clients.
+
+        :param topic: The topic, as bytes.
+        :param payload: The payload.
+        :param retain: Whether to retain the message.
+        """
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        name = topic.decode("utf-8")
+        packet = None
+        for session in self.sessions:
+            if any(topic_matches_sub(f, name) for f in session.subscriptions):
+                packet = packet or _publish_packet(topic, payload)
+                session.writer.write(packet)
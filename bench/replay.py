@@ -0,0 +1,180 @@
+"""
+Replay a capture recorded by the bridge (bridge.recorder) into a bridge instance.
+
+By default, it starts an OSC2MQTTBridge against the in-process MiniBroker, standing in for the
+production broker. The recorded OSC packets are sent to the bridge over a SLIP framed TCP
+connection, and the recorded MQTT messages are published to the broker, with their original
+timing (--speed 1), N times faster (--speed N) or as fast as possible (--speed 0). It reports
+the replayed messages per direction and what came out of the bridge.
+
+With --config, the bridge is configured from a YAML file, its MQTT connection being redirected
+to the stand-in broker. With --osc-port and --mqtt-port, the capture is replayed into a bridge
+and a broker which are already running instead.
+
+Usage: python bench/replay.py CAPTURE_DIR [--speed N] [--config config.yaml]
+                              [--osc-port PORT --mqtt-port PORT] [--output results.json]
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+
+import yaml  # noqa: E402
+from bench_bridge import free_port, git_commit, new_mqtt_client  # noqa: E402
+from mini_broker import MiniBroker  # noqa: E402
+from osc2mqtt_bridge import OSC2MQTTBridge  # noqa: E402
+from osc_framing import encode_slip  # noqa: E402
+from recorder import M2O, O2M, read_capture  # noqa: E402
+
+
+def bridge_config(path, mqtt_port, tcp_port, udp_port):
+    """
+    Build the configuration of the replayed bridge.
+
+    :param path: The YAML configuration file, or None for a default configuration.
+    :param mqtt_port: The port of the stand-in broker.
+    :param tcp_port: The OSC TCP port of the bridge.
+    :param udp_port: The UDP port the bridge sends the OSC messages to.
+    :return: The configuration.
+    """
+    if path:
+        with open(path, encoding="utf-8") as file:
+            config = yaml.safe_load(file)
+    else:
+        config = {"mqtt": {"connection": {}, "topics": {"publish": "osc/stat",
+                                                        "subscribe": "osc/cmnd/openSC"}},
+                  "osc": {"max_connections": 64, "engine": "asyncio", "direct": True},
+                  "bridge": {"auto_reset": []}}
+    config["mqtt"]["connection"].update(
+        {"broker": "127.0.0.1", "port": mqtt_port, "client_id": "replay-bridge",
+         "username": "replay", "password": "replay", "tls": False})
+    config["mqtt"].pop("spool", None)
+    config["osc"].update({"net": "127.0.0.1", "port": tcp_port, "client_port": udp_port,
+                          "reuse_port": False})
+    config["osc"].pop("udp", None)
+    bridge = config.setdefault("bridge", {})
+    for section in ("recorder", "metrics", "state", "workers"):
+        bridge.pop(section, None)
+    return config
+
+
+def replay(capture, speed, osc_port, publisher):
+    """
+    Replay a capture.
+
+    :param capture: The directory of the capture.
+    :param speed: The speed factor, 0 for as fast as possible.
+    :param osc_port: The OSC TCP port of the bridge.
+    :param publisher: The MQTT client publishing the recorded MQTT messages.
+    :return: The number of replayed messages per direction, and the time it took.
+    """
+    counts = {O2M: 0, M2O: 0}
+    with socket.create_connection(("127.0.0.1", osc_port)) as sock:
+        start = first = None
+        for record in read_capture(capture):
+            if start is None:
+                start, first = time.perf_counter(), record.timestamp
+            elif speed:
+                delay = start + (record.timestamp - first) / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            if record.direction == O2M:
+                sock.sendall(encode_slip(record.data))
+            else:
+                publisher.publish(record.key.decode("utf-8"), record.data)
+            counts[record.direction] += 1
+        elapsed = time.perf_counter() - start if start is not None else 0
+        # Let the last messages go through before closing the connection
+        time.sleep(0.5)
+    return counts, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("capture", help="directory of the capture")
+    parser.add_argument("--speed", type=float, default=1,
+                        help="speed factor, 0 for as fast as possible")
+    parser.add_argument("--config", help="YAML configuration of the replayed bridge")
+    parser.add_argument("--osc-port", type=int, help="OSC TCP port of a running bridge")
+    parser.add_argument("--mqtt-port", type=int, help="port of the broker of a running bridge")
+    parser.add_argument("--output", help="JSON file to save the results to")
+    args = parser.parse_args()
+    if (args.osc_port is None) != (args.mqtt_port is None):
+        parser.error("--osc-port and --mqtt-port go together")
+
+    broker = bridge = None
+    udp_port = free_port(socket.SOCK_DGRAM)
+    if args.osc_port is None:
+        broker = MiniBroker()
+        mqtt_port, osc_port = broker.start(), free_port()
+        bridge = OSC2MQTTBridge(bridge_config(args.config, mqtt_port, osc_port, udp_port))
+        bridge.start()
+    else:
+        mqtt_port, osc_port = args.mqtt_port, args.osc_port
+
+    received = {"mqtt": 0, "osc": 0}
+    lock = threading.Lock()
+
+    def on_message(client, userdata, msg):
+        with lock:
+            received["mqtt"] += 1
+    subscriber = new_mqtt_client("replay-subscriber", mqtt_port, False)
+    subscriber.on_message = on_message
+    subscriber.subscribe("#")
+    publisher = new_mqtt_client("replay-publisher", mqtt_port, False)
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    udp.bind(("127.0.0.1", udp_port))
+    udp.settimeout(0.2)
+    stop = threading.Event()
+
+    def receive():
+        while not stop.is_set():
+            try:
+                udp.recv(65536)
+            except socket.timeout:
+                continue
+            received["osc"] += 1
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+    time.sleep(1)
+
+    counts, elapsed = replay(args.capture, args.speed, osc_port, publisher)
+
+    stop.set()
+    receiver.join()
+    udp.close()
+    for client in (publisher, subscriber):
+        client.loop_stop()
+        client.disconnect()
+    if bridge is not None:
+        bridge.stop()
+        broker.stop()
+
+    total = counts[O2M] + counts[M2O]
+    results = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "parameters": vars(args),
+        "replayed_osc": counts[O2M],
+        "replayed_mqtt": counts[M2O],
+        "elapsed_s": round(elapsed, 3),
+        "messages_per_s": round(total / elapsed) if elapsed else 0,
+        # Every MQTT message seen by the broker, including the replayed ones
+        "received_mqtt": received["mqtt"],
+        "received_osc_datagrams": received["osc"],
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+This module provides the queues linking the stages of the bridge, and helpers to use them.
+"""
+import collections
+import logging
+import queue
+import threading
+import time
+from metrics import METRICS
+
+CLOSED = object()  # Item queued by BridgeQueue.close, after all the others
+
+
+class BridgeQueue(queue.Queue):
+    """
+    A queue with a selectable policy when it is full:
+
+    - "block": the producer waits for some room, like `queue.Queue`,
+    - "drop_oldest": the oldest item is dropped to make room for the new one,
+    - "drop_newest": the new item is dropped,
+    - "coalesce": the new item replaces the queued item of the same key, if any, otherwise the
+      oldest item is dropped.
+
+    Every dropped item is counted in `dropped`, and the time the items wait in the queue is
+    recorded in the osc2mqtt_queue_wait_seconds histogram. Once the queue is closed, the items
+    put are dropped: the CLOSED marker is never dropped to make room for them.
+    """
+
+    POLICIES = ("block", "drop_oldest", "drop_newest", "coalesce")
+
+    def __init__(self, maxsize=0, policy="block", key=None, name="queue"):
+        """
+        Initialize the BridgeQueue.
+
+        :param maxsize: The capacity of the queue, 0 for unbounded (default is 0).
+        :param policy: The policy when the queue is full (default is "block").
+        :param key: The function giving the key of an item for the "coalesce" policy
+            (default is the first element of the item, the OSC address or MQTT topic).
+        :param name: The name of the queue in the logs.
+        """
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown queue policy {policy}, expected one of {self.POLICIES}")
+        self.policy = policy
+        self.key = key or (lambda item: item[0])
+        self.name = name
+        self.dropped = 0
+        self.closed = False
+        self.wait_seconds = METRICS.histogram("osc2mqtt_queue_wait_seconds",
+                                              "Time spent by the messages in the queues",
+                                              queue=name)
+        METRICS.gauge("osc2mqtt_queue_depth", "Number of messages in the queues",
+                      function=self.qsize, queue=name)
+        METRICS.gauge("osc2mqtt_queue_dropped", "Number of messages dropped by the full queues",
+                      function=lambda: self.dropped, queue=name)
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        # Items are queued in [item, time queued] cells, the item of a cell can be replaced by
+        # the "coalesce" policy
+        self.queue = collections.deque()
+        self._cells = {}  # Key -> queued cell, for the "coalesce" policy
+
+    def _put(self, item):
+        cell = [item, time.perf_counter()]
+        if self.policy == "coalesce":
+            self._cells[self.key(item)] = cell
+        self.queue.append(cell)
+
+    def _pop(self):
+        """
+        Remove the oldest cell of the queue.
+
+        :return: The [item, time queued] cell.
+        """
+        cell = self.queue.popleft()
+        if self.policy == "coalesce" and cell[0] is not CLOSED:
+            key = self.key(cell[0])
+            if self._cells.get(key) is cell:
+                del self._cells[key]
+        return cell
+
+    def _get(self):
+        item, queued = self._pop()
+        self.wait_seconds.observe(time.perf_counter() - queued)
+        return item
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Put an item into the queue, applying the policy if the queue is full.
+
+        :param item: The item.
+        :param block: Whether to wait for some room with the "block" policy.
+        :param timeout: The maximum time to wait with the "block" policy.
+        """
+        if self.closed:
+            # Never handled by the consumer, which stops at the CLOSED marker
+            with self.mutex:
+                self.dropped += 1
+            return
+        if self.policy == "block" or self.maxsize <= 0:
+            super().put(item, block, timeout)
+            return
+        with self.not_full:
+            if self._qsize() >= self.maxsize:
+                dropped = self.dropped = self.dropped + 1
+                if self.policy == "drop_newest":
+                    item = None
+                elif self.policy == "coalesce" and self.key(item) in self._cells:
+                    self._cells[self.key(item)][0] = item
+                    item = None
+                else:
+                    self._pop()
+            else:
+                dropped = 0
+            if item is not None:
+                self._put(item)
+                self.unfinished_tasks += 1
+                self.not_empty.notify()
+        # Log the 1st, 10th, 100th... dropped item, without flooding the logs under overload
+        if dropped and str(dropped).strip('0') == '1':
+            logging.warning("Queue %s is full, %d items dropped so far.", self.name, dropped)
+
+    def close(self):
+        """
+        Queue the CLOSED marker after the queued items, whatever the capacity of the queue, for
+        the consumer to stop once it got them all.
+        """
+        with self.not_empty:
+            self.closed = True
+            self.queue.append([CLOSED, time.perf_counter()])
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+
+class DispatchPool:
+    """
+    Handles items in parallel in partitions, each a BridgeQueue consumed by its own thread. The
+    partition of an item is given by the hash of its key: items of the same key are handled in
+    order, while items of other keys are handled by the other threads.
+
+    The threads wait for their items without polling, and are stopped once they handled all the
+    items queued before the stop.
+    """
+
+    def __init__(self, handler, partitions=1, key=None, name="queue", maxsize=0, **queue_config):
+        """
+        Initialize the DispatchPool.
+
+        :param handler: The function called with each item.
+        :param partitions: The number of partitions, and threads (default is 1).
+        :param key: The function giving the partition key of an item (default is the first
+            element of the item).
+        :param name: The name of the pool, and of its queues in the logs and metrics.
+        :param maxsize: The capacity of the pool, split between the partitions, 0 for unbounded
+            (default is 0).
+        :param queue_config: The other parameters of the queues (see BridgeQueue).
+        """
+        if partitions < 1:
+            raise ValueError("A dispatch pool needs at least one partition")
+        self.handler = handler
+        self.key = key or (lambda item: item[0])
+        self.name = name
+        maxsize = -(-maxsize // partitions) if maxsize > 0 else 0
+        self.queues = [BridgeQueue(maxsize, **queue_config,
+                                   name=name if partitions == 1 else f"{name}-{i}")
+                       for i in range(partitions)]
+        self.threads = []
+
+    @property
+    def dropped(self):
+        """
+        Get the number of items dropped by the full queues.
+        """
+        return sum(buffer.dropped for buffer in self.queues)
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Put an item into the queue of its partition.
+
+        :param item: The item.
+        :param block: Whether to wait for some room with the "block" policy.
+        :param timeout: The maximum time to wait with the "block" policy.
+        """
+        queues = self.queues
+        buffer = queues[hash(self.key(item)) % len(queues)] if len(queues) > 1 else queues[0]
+        buffer.put(item, block, timeout)
+
+    def start(self):
+        """
+        Start the threads handling the items.
+        """
+        self.threads = [threading.Thread(target=self._run, args=(buffer,), name=buffer.name)
+                        for buffer in self.queues]
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self, buffer):
+        """
+        Handle the items of a partition until it is closed.
+
+        :param buffer: The BridgeQueue of the partition.
+        """
+        handler = self.handler
+        while True:
+            item = buffer.get()
+            if item is CLOSED:
+                break
+            try:
+                handler(item)
+            except Exception as e:
+                logging.exception("Error handling %s item: %s", buffer.name, e)
+
+    def stop(self):
+        """
+        Handle the items already queued, then stop the threads.
+        """
+        for buffer in self.queues:
+            buffer.close()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        logging.info("Dispatch pool %s stopped.", self.name)
+
+
+def get_batch(buffer: queue.Queue, max_size, max_latency=0.0, timeout=1):
+    """
+    Get a batch of items from a queue.
+
+    Waits up to `timeout` seconds for a first item, then keeps collecting items until the batch
+    holds `max_size` items or `max_latency` seconds elapsed since the first one.
+
+    :param buffer: The queue to get the items from.
+    :param max_size: The maximum number of items in the batch.
+    :param max_latency: The maximum time to wait for more items after the first one.
+    :param timeout: The maximum time to wait for the first item.
+    :return: The list of items, empty if none arrived before the timeout.
+    """
+    try:
+        batch = [buffer.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    deadline = time.monotonic() + max_latency
+    while len(batch) < max_size:
+        remaining = deadline - time.monotonic()
+        try:
+            if remaining > 0:
+                batch.append(buffer.get(timeout=remaining))
+            else:
+                batch.append(buffer.get_nowait())
+        except queue.Empty:
+            break
+    return batch
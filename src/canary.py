@@ -0,0 +1,321 @@
+"""
+This module provides the canary of the bridge: probe messages injected periodically, and caught
+on the far side, to measure the end-to-end latency of the bridge continuously.
+
+Each probe carries a sequence number and makes a loop through both directions. It is sent as an
+OSC message to the canary address, through a loopback TCP connection to the OSC server, and
+caught on MQTT on the topic it is routed to (o2m latency). It is then published on the subscribe
+topic routed back to the canary address, and caught as a UDP datagram by the canary, registered
+as an OSC client receiving only the canary address (m2o latency). The round trip goes from the
+OSC send to the UDP datagram. Without the o2m direction, the probes are published directly on
+MQTT, and only the m2o latency is measured.
+
+The latencies are exposed as histograms. A warning is logged when a latency goes over its
+threshold, or when probes start being lost, and a message once it is back under it.
+"""
+import logging
+import select
+import socket
+import threading
+import time
+from oscpy.parser import format_message, read_packet
+from metrics import METRICS
+from osc_framing import ENCODERS
+from payload_codecs import OscPacket, RawOscCodec
+from simple_thread import SimpleThread
+
+LATENCY = "osc2mqtt_canary_latency_seconds"
+PATHS = ("o2m", "m2o", "round_trip")
+
+
+class Canary:
+    """
+    Sends probes through the bridge and measures their latency.
+    """
+
+    ADDRESS = "/osc2mqtt/canary"
+
+    def __init__(self, mqtt_handler, t2u, m2o_topic, o2m_topic=None, address=ADDRESS,
+                 interval=1.0, threshold=0.05, round_trip_threshold=None, timeout=5.0,
+                 encoding='utf-8'):
+        """
+        Initialize the Canary.
+
+        :param mqtt_handler: The MQTTClientHandler of the bridge.
+        :param t2u: The Tcp2UnixOscServer of the bridge.
+        :param m2o_topic: The MQTT topic routed to the canary address.
+        :param o2m_topic: The MQTT topic the canary address is routed to, or None to only probe
+            the m2o direction.
+        :param address: The OSC address of the probes (default is /osc2mqtt/canary).
+        :param interval: The time between two probes, in seconds (default is 1).
+        :param threshold: The o2m and m2o latency above which a warning is logged, in seconds
+            (default is 0.05).
+        :param round_trip_threshold: The round trip latency above which a warning is logged, in
+            seconds (default is twice threshold).
+        :param timeout: The time after which a probe which did not come back is lost, in seconds
+            (default is 5).
+        :param encoding: The encoding of the OSC addresses.
+        """
+        self.mqtt_handler = mqtt_handler
+        self.t2u = t2u
+        self.m2o_topic = m2o_topic
+        self.o2m_topic = o2m_topic
+        self.address = address.encode(encoding)
+        self.interval = interval
+        self.thresholds = {"o2m": threshold, "m2o": threshold,
+                           "round_trip": round_trip_threshold or 2 * threshold}
+        self.timeout = timeout
+        self.encoding = encoding
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._pending = {}  # Sequence number -> [o2m send time, m2o send time]
+        self._alerting = set()  # Paths over their threshold, and ("lost", direction)
+        self._next_probe = 0
+        self._tcp = None
+        self._tcp_address = None
+        self._udp = None
+        self._endpoint = None
+        self._task = None
+        self._histograms = {path: METRICS.histogram(LATENCY, "Latency of the canary probes",
+                                                    path=path) for path in PATHS}
+        self._last = {path: METRICS.gauge("osc2mqtt_canary_last_latency_seconds",
+                                          "Latency of the last canary probe", path=path)
+                      for path in PATHS}
+        self._alerts = {path: METRICS.counter("osc2mqtt_canary_alerts_total",
+                                              "Canary probes over their latency threshold",
+                                              path=path) for path in PATHS}
+        self._sent = {direction: METRICS.counter("osc2mqtt_canary_probes_total",
+                                                 "Canary probes sent", direction=direction)
+                      for direction in ("o2m", "m2o")}
+        self._lost = {direction: METRICS.counter("osc2mqtt_canary_lost_total",
+                                                 "Canary probes which did not come back",
+                                                 direction=direction)
+                      for direction in ("o2m", "m2o")}
+
+    def start(self):
+        """
+        Register the canary as an OSC client, subscribe to the o2m probes, and start sending
+        probes. The bridge must be started.
+        """
+        self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._udp.bind(("127.0.0.1", 0))
+        self._udp.setblocking(False)
+        self._endpoint = self._udp.getsockname()
+        registry = self.t2u.osc_clients
+        registry.add(self._endpoint)
+        registry.subscribe(self._endpoint, [self.address.decode(self.encoding)])
+        if self.o2m_topic is not None:
+            self.mqtt_handler.subscribe_callback(self.o2m_topic, self._on_o2m_probe)
+        self._next_probe = time.monotonic() + self.interval
+        self._task = SimpleThread(self._canary_loop, args=())
+        logging.info("Canary probing every %s s on %s", self.interval,
+                     self.address.decode(self.encoding))
+
+    def stop(self):
+        """
+        Stop sending probes, and unregister the canary.
+        """
+        if self._task is None:
+            return
+        self._task.stop()
+        self._task = None
+        self._close_tcp()
+        self.t2u.osc_clients.remove(self._endpoint)
+        self._udp.close()
+
+    def _canary_loop(self):
+        """
+        Receive the m2o probes until the next probe is due, then send it.
+        """
+        timeout = self._next_probe - time.monotonic()
+        if timeout > 0:
+            readable, _, _ = select.select([self._udp], [], [], min(timeout, 0.5))
+            if readable:
+                self._receive()
+            return
+        self._next_probe += self.interval
+        if self._next_probe < time.monotonic():
+            self._next_probe = time.monotonic() + self.interval
+        self._expire()
+        self._send_probe()
+
+    def _send_probe(self):
+        """
+        Send a probe, as an OSC message through the loopback TCP connection, or on MQTT without
+        the o2m direction.
+        """
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            entry = self._pending[seq] = [None, None]
+        if self.o2m_topic is None:
+            self._publish_probe(seq)
+            return
+        packet, _ = format_message(self.address, [seq], encoding=self.encoding)
+        try:
+            if self._tcp is None:
+                self._connect_tcp()
+            entry[0] = time.perf_counter()
+            self._tcp.sendall(ENCODERS[self.t2u.framing](packet))
+        except OSError as e:
+            logging.warning("Canary failed to send probe %d to the OSC server: %s", seq, e)
+            with self._lock:
+                self._pending.pop(seq, None)
+            self._close_tcp()
+            return
+        self._sent["o2m"].inc()
+
+    def _publish_probe(self, seq):
+        """
+        Publish a probe on the topic routed to the canary address.
+
+        :param seq: The sequence number of the probe.
+        """
+        message = seq
+        if isinstance(self.mqtt_handler.codecs.resolve(self.m2o_topic), RawOscCodec):
+            message = format_message(self.address, [seq], encoding=self.encoding)[0]
+        with self._lock:
+            entry = self._pending.get(seq)
+            if entry is None:
+                return
+            entry[1] = time.perf_counter()
+        try:
+            self.mqtt_handler.publish_json(self.m2o_topic, message, qos=0, retain=False)
+        except IOError as e:
+            logging.warning("Canary failed to publish probe %d: %s", seq, e)
+            return
+        self._sent["m2o"].inc()
+
+    def _connect_tcp(self):
+        """
+        Open the loopback TCP connection to the OSC server, declared as a probe connection
+        before connecting so that it is not registered as an OSC client.
+        """
+        host = "127.0.0.1" if self.t2u.net in ("", "0.0.0.0") else self.t2u.net
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.bind((host, 0))
+            self._tcp_address = sock.getsockname()
+            self.t2u.probe_addresses.add(self._tcp_address)
+            sock.settimeout(self.interval)
+            sock.connect((host, self.t2u.port))
+        except OSError:
+            sock.close()
+            self.t2u.probe_addresses.discard(self._tcp_address)
+            raise
+        self._tcp = sock
+
+    def _close_tcp(self):
+        """
+        Close the loopback TCP connection, if any.
+        """
+        if self._tcp is not None:
+            self._tcp.close()
+            self._tcp = None
+        # The server may still be handling the connection: forget it once it is closed
+        self.t2u.probe_addresses.discard(self._tcp_address)
+
+    def _on_o2m_probe(self, topic, payload):
+        """
+        Handle an o2m probe caught on MQTT, called from the network loop: the probe goes on in
+        the m2o direction.
+
+        :param topic: The topic of the probe.
+        :param payload: The payload of the probe.
+        """
+        now = time.perf_counter()
+        try:
+            seq = self._probe_seq(self.mqtt_handler.codecs.resolve(topic).decode(payload))
+        except Exception as e:
+            logging.debug("Ignored canary message on %s: %s", topic, e)
+            return
+        with self._lock:
+            entry = self._pending.get(seq)
+            if entry is None or entry[0] is None or entry[1] is not None:
+                return
+        self._observe("o2m", now - entry[0])
+        self._publish_probe(seq)
+
+    def _receive(self):
+        """
+        Handle the m2o probes received as UDP datagrams.
+        """
+        while True:
+            try:
+                data = self._udp.recv(65536)
+            except BlockingIOError:
+                return
+            now = time.perf_counter()
+            try:
+                messages = read_packet(data)
+            except Exception as e:
+                logging.debug("Ignored canary datagram: %s", e)
+                continue
+            for address, _, values, _ in messages:
+                if address != self.address or not values:
+                    continue
+                with self._lock:
+                    entry = self._pending.get(values[0])
+                    if entry is None or entry[1] is None:
+                        continue
+                    del self._pending[values[0]]
+                self._observe("m2o", now - entry[1])
+                if entry[0] is not None:
+                    self._observe("round_trip", now - entry[0])
+
+    def _probe_seq(self, message):
+        """
+        Get the sequence number of a probe decoded from MQTT.
+
+        :param message: The decoded message.
+        :return: The sequence number.
+        """
+        if isinstance(message, OscPacket):
+            (_, _, message, _), = read_packet(bytes(message))
+        if isinstance(message, (list, tuple)):
+            message = message[0]
+        return int(message)
+
+    def _expire(self):
+        """
+        Count the probes which did not come back within the timeout as lost, in the direction
+        they were lost in.
+        """
+        deadline = time.perf_counter() - self.timeout
+        lost = []
+        with self._lock:
+            for seq, entry in list(self._pending.items()):
+                sent = entry[0] if entry[0] is not None else entry[1]
+                if sent is not None and sent < deadline:
+                    del self._pending[seq]
+                    lost.append("o2m" if entry[1] is None else "m2o")
+        for direction in lost:
+            self._lost[direction].inc()
+            self._alerts[direction].inc()
+            if ("lost", direction) not in self._alerting:
+                self._alerting.add(("lost", direction))
+                logging.warning("Canary probe lost in the %s direction after %s s",
+                                direction, self.timeout)
+
+    def _observe(self, path, latency):
+        """
+        Record the latency of a probe on a path, and warn when it crosses its threshold.
+
+        :param path: "o2m", "m2o" or "round_trip".
+        :param latency: The latency, in seconds.
+        """
+        self._histograms[path].observe(latency)
+        self._last[path].set(latency)
+        if ("lost", path) in self._alerting:
+            self._alerting.discard(("lost", path))
+            logging.info("Canary probes back in the %s direction", path)
+        threshold = self.thresholds[path]
+        if latency > threshold:
+            self._alerts[path].inc()
+            if path not in self._alerting:
+                self._alerting.add(path)
+                logging.warning("Canary %s latency %.1f ms over the %.1f ms threshold",
+                                path, latency * 1000, threshold * 1000)
+        elif path in self._alerting:
+            self._alerting.discard(path)
+            logging.info("Canary %s latency back to %.1f ms", path, latency * 1000)
@@ -0,0 +1,100 @@
+"""
+This module provides the coalescing of high rate OSC addresses, like faders and XY pads, before
+their messages are published to MQTT.
+"""
+import fnmatch
+import heapq
+
+
+class Coalescer:
+    """
+    Limits the rate of the messages of some OSC addresses, keeping only the latest value.
+
+    An address matching a rule is sent at most once per interval of the rule: the messages
+    arriving in between replace each other as the pending message, sent when the interval
+    elapses. The other addresses pass through unthrottled.
+    """
+
+    def __init__(self, rules=()):
+        """
+        Initialize the Coalescer.
+
+        :param rules: The list of rules, each a dictionary with an "address" pattern (shell
+            wildcards) and either a "max_rate" in Hz or a "window" in seconds. The first
+            matching rule applies.
+        """
+        self.rules = [(rule["address"],
+                       rule["window"] if "window" in rule else 1.0 / rule["max_rate"])
+                      for rule in rules]
+        self.merged = 0  # Number of messages replaced by a later one
+        self._intervals = {}  # Address -> interval of its rule, or None
+        self._states = {}  # Address -> [time of the last sent message, pending message]
+        self._due = []  # Heap of (due time, address) of the pending messages
+
+    def _interval(self, address):
+        """
+        Get the minimum interval between two messages of an address.
+
+        :param address: The OSC address, as bytes.
+        :return: The interval in seconds, or None if the address is not throttled.
+        """
+        try:
+            return self._intervals[address]
+        except KeyError:
+            pass
+        name = address.decode('utf-8', errors='replace')
+        interval = next((interval for pattern, interval in self.rules
+                         if fnmatch.fnmatchcase(name, pattern)), None)
+        self._intervals[address] = interval
+        return interval
+
+    def offer(self, address, message, now):
+        """
+        Offer a message to the coalescer.
+
+        :param address: The OSC address, as bytes.
+        :param message: The message, held as it is.
+        :param now: The current monotonic time.
+        :return: True if the message must be sent now, False if it is held.
+        """
+        interval = self._interval(address)
+        if interval is None:
+            return True
+        state = self._states.get(address)
+        if state is None:
+            self._states[address] = [now, None]
+            return True
+        if state[1] is not None:
+            self.merged += 1
+            state[1] = message
+            return False
+        if now - state[0] >= interval:
+            state[0] = now
+            return True
+        state[1] = message
+        heapq.heappush(self._due, (state[0] + interval, address))
+        return False
+
+    def due(self, now):
+        """
+        Take the held messages whose interval elapsed.
+
+        :param now: The current monotonic time.
+        :return: The list of the messages to send now.
+        """
+        messages = []
+        due = self._due
+        while due and due[0][0] <= now:
+            _, address = heapq.heappop(due)
+            state = self._states[address]
+            messages.append(state[1])
+            state[0], state[1] = now, None
+        return messages
+
+    def next_due(self):
+        """
+        Get the time the next held message is due.
+
+        :return: The monotonic time, or None if no message is held.
+        """
+        return self._due[0][0] if self._due else None
@@ -0,0 +1,350 @@
+"""
+This module provides the instrumentation of the bridge: counters, gauges and latency histograms
+of each stage, exposed in the Prometheus text format over HTTP, and a sampled trace of the
+messages going through the bridge.
+
+The metrics are registered in the module level `METRICS` registry, the way log records go
+through the `logging` module, and the per-message trace goes through `TRACER`.
+"""
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in seconds, from 1 µs to 1 s
+LATENCY_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4,
+                   1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+
+
+def _format_labels(labels, extra=None):
+    """
+    Format labels for the Prometheus text format.
+
+    :param labels: The tuple of (name, value) labels.
+    :param extra: An additional (name, value) label, or None.
+    :return: The formatted labels, empty if there are none.
+    """
+    if extra is not None:
+        labels = labels + (extra,)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Counter:
+    """
+    A monotonically increasing count.
+    """
+
+    type = "counter"
+
+    def __init__(self, labels=()):
+        self.labels = labels
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """
+        Increase the counter.
+
+        :param amount: The amount to add (default is 1).
+        """
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name):
+        yield name + _format_labels(self.labels), self.value
+
+
+class Gauge:
+    """
+    A value which can go up and down, either set or read from a function when exposed.
+    """
+
+    type = "gauge"
+
+    def __init__(self, labels=(), function=None):
+        self.labels = labels
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        """
+        Set the gauge.
+
+        :param value: The value.
+        """
+        self.value = value
+
+    def samples(self, name):
+        value = self.function() if self.function is not None else self.value
+        yield name + _format_labels(self.labels), value
+
+
+class Histogram:
+    """
+    A distribution of observed values, counted in cumulative buckets.
+    """
+
+    type = "histogram"
+
+    def __init__(self, labels=(), buckets=LATENCY_BUCKETS):
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        Observe a value.
+
+        :param value: The value, in seconds for latencies.
+        """
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """
+        Get a context manager observing the time spent in its block.
+        """
+        return _Timer(self)
+
+    def quantile(self, q):
+        """
+        Estimate a quantile from the buckets.
+
+        :param q: The quantile, between 0 and 1.
+        :return: The upper bound of the bucket holding the quantile, or None if no value was
+            observed.
+        """
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return None
+        rank = q * count
+        total = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            total += bucket_count
+            if total >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self, name):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            yield name + "_bucket" + _format_labels(self.labels, ("le", repr(bound))), cumulative
+        yield name + "_bucket" + _format_labels(self.labels, ("le", "+Inf")), count
+        yield name + "_sum" + _format_labels(self.labels), total
+        yield name + "_count" + _format_labels(self.labels), count
+
+
+class _Timer:
+    """
+    Context manager observing the time spent in its block in a histogram.
+    """
+
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry:
+    """
+    A registry of metrics, each identified by its name and labels.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = {}  # Name -> (help, type, {labels: metric})
+
+    def _get(self, cls, name, help_text, labels, **kwargs):
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._families.setdefault(name, (help_text, cls.type, {}))
+            if family[1] != cls.type:
+                raise ValueError(f"Metric {name} is already registered as a {family[1]}")
+            metric = family[2].get(labels)
+            if metric is None:
+                metric = family[2][labels] = cls(labels, **kwargs)
+            return metric
+
+    def counter(self, name, help_text, **labels):
+        """
+        Get or create a counter.
+
+        :param name: The name of the metric.
+        :param help_text: The description of the metric.
+        :param labels: The labels of the metric.
+        :return: The Counter.
+        """
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text, function=None, **labels):
+        """
+        Get or create a gauge.
+
+        :param name: The name of the metric.
+        :param help_text: The description of the metric.
+        :param function: The function giving the value of the gauge, replacing the previous
+            one if any (default is to use the value set).
+        :param labels: The labels of the metric.
+        :return: The Gauge.
+        """
+        gauge = self._get(Gauge, name, help_text, labels)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, **labels):
+        """
+        Get or create a histogram.
+
+        :param name: The name of the metric.
+        :param help_text: The description of the metric.
+        :param buckets: The upper bounds of the buckets (default is LATENCY_BUCKETS).
+        :param labels: The labels of the metric.
+        :return: The Histogram.
+        """
+        return self._get(Histogram, name, help_text, labels, buckets=buckets)
+
+    def render(self):
+        """
+        Render all the metrics in the Prometheus text format.
+
+        :return: The text.
+        """
+        with self._lock:
+            families = [(name, help_text, metric_type, list(metrics.values()))
+                        for name, (help_text, metric_type, metrics)
+                        in sorted(self._families.items())]
+        lines = []
+        for name, help_text, metric_type, metrics in families:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for metric in metrics:
+                try:
+                    lines.extend(f"{sample} {value}" for sample, value in metric.samples(name))
+                except Exception as e:
+                    logging.debug("Failed to read metric %s: %s", name, e)
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Registry()
+
+
+def stage_histogram(stage):
+    """
+    Get the latency histogram of a stage of the bridge.
+
+    :param stage: The name of the stage.
+    :return: The Histogram.
+    """
+    return METRICS.histogram("osc2mqtt_stage_seconds",
+                             "Time spent in each stage of the bridge", stage=stage)
+
+
+class Tracer:
+    """
+    A sampled trace of the messages going through the bridge: one message out of `sample` is
+    logged at INFO level, none if `sample` is 0, so that production runs without log I/O on the
+    hot path.
+    """
+
+    def __init__(self, sample=0):
+        """
+        Initialize the Tracer.
+
+        :param sample: Log one message out of sample, 0 to disable the trace (default is 0).
+        """
+        self.sample = sample
+        self._count = 0
+
+    def log(self, msg, *args):
+        """
+        Log a message if it is sampled.
+
+        :param msg: The message format.
+        :param args: The arguments of the message.
+        """
+        if self.sample:
+            self._count += 1
+            if self._count >= self.sample:
+                self._count = 0
+                logging.info(msg, *args)
+
+
+TRACER = Tracer()
+
+
+class MetricsServer:
+    """
+    An HTTP server exposing the metrics of a registry in the Prometheus text format.
+    """
+
+    def __init__(self, net="127.0.0.1", port=9100, registry=METRICS):
+        """
+        Initialize the MetricsServer.
+
+        :param net: The address to listen on (default is "127.0.0.1").
+        :param port: The port to listen on (default is 9100).
+        :param registry: The registry to expose (default is METRICS).
+        """
+        self.net = net
+        self.port = port
+        self.registry = registry
+        self.httpd = None
+        self.thread = None
+
+    def start(self):
+        """
+        Start serving the metrics in a separate thread.
+        """
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((self.net, self.port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="metrics")
+        self.thread.start()
+        logging.info("Serving metrics on http://%s:%d/metrics", self.net, self.port)
+
+    def stop(self):
+        """
+        Stop the server.
+        """
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.thread.join()
+            logging.info("Metrics server stopped.")
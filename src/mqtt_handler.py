@@ -1,13 +1,51 @@
 """
 This module provides an MQTT client handler for connecting to an MQTT broker,
-publishing and subscribing to topics, and handling JSON messages.
+publishing and subscribing to topics, and handling JSON messages. The payloads are encoded
+and decoded with the codec of their topic (see payload_codecs).
+
+The connection is a small state machine driven by the callbacks of the paho network loop, which
+reconnects in the background with an exponential backoff. While the broker is unreachable, the
+published messages go to an optional disk spool, replayed in order at a bounded rate once the
+connection is back.
+
+With several connections, the publications are spread over a pool of connections to the broker,
+each topic being published on a fixed connection chosen by the hash of the topic, which keeps the
+order of the messages of each topic. The subscriptions are kept on the first connection. Each
+connection has its own spool, so that a connection down does not hold the others back.
 """
 
-import json
 import logging
+import os
+import threading
 import time
 import queue
+import zlib
 from paho.mqtt import client as mqtt
+from metrics import METRICS, TRACER, stage_histogram
+from payload_codecs import PayloadCodecs
+from publish_policy import PublishPolicy
+from recorder import M2O
+from spool import Spool
+
+ENCODE_SECONDS = stage_histogram("mqtt_encode")
+PUBLISH_SECONDS = stage_histogram("mqtt_publish")
+PUBLISHED = METRICS.counter("osc2mqtt_mqtt_published_total", "Messages published to MQTT")
+PUBLISH_FAILURES = METRICS.counter("osc2mqtt_mqtt_publish_failures_total",
+                                   "Messages which failed to be published to MQTT")
+RECEIVED = METRICS.counter("osc2mqtt_mqtt_received_total", "Messages received from MQTT")
+DECODE_SECONDS = stage_histogram("mqtt_decode")
+SPOOLED = METRICS.counter("osc2mqtt_mqtt_spooled_total",
+                          "Messages spooled while the MQTT broker was unreachable")
+REPLAYED = METRICS.counter("osc2mqtt_mqtt_replayed_total",
+                           "Spooled messages published once the MQTT broker was back")
+SUPERSEDED = METRICS.counter("osc2mqtt_mqtt_replay_superseded_total",
+                             "Spooled messages not replayed, a newer message of their topic "
+                             "being published")
+
+# States of the connection
+DISCONNECTED = "disconnected"
+CONNECTING = "connecting"
+CONNECTED = "connected"
 
 
 class MQTTClientHandler:
@@ -16,22 +54,10 @@ class MQTTClientHandler:
     publishing and subscribing to topics, and handling JSON messages.
     """
 
-    class BytesEncoder(json.JSONEncoder):
-        """
-        Custom JSON encoder to handle bytes objects.
-        """
-        encoding = 'utf-8'
-
-        def default(self, o):
-            """
-            Override the default method to handle bytes objects.
-            """
-            if isinstance(o, bytes):
-                return o.decode(self.encoding)
-            else:
-                return super().default(o)
-
-    def __init__(self, broker, port, client_id, username, password, ca_certs, encoding='utf-8'):
+    def __init__(self, broker, port, client_id, username, password, ca_certs=None,
+                 encoding='utf-8', publish_policy=None, mqtt_buffer=None, tls=True,
+                 reconnect_min_delay=1, reconnect_max_delay=60, spool=None, replay_rate=1000,
+                 codecs=None, recorder=None, connections=1):
         """
         Initialize the MQTTClientHandler.
 
@@ -40,8 +66,29 @@ class MQTTClientHandler:
         :param client_id: The client ID to use when connecting to the broker.
         :param username: The username for authentication.
         :param password: The password for authentication.
-        :param ca_certs: Path to the CA certificate file.
+        :param ca_certs: Path to the CA certificate file (default is the system CA certificates).
         :param encoding: The encoding to use for messages (default is 'utf-8').
+        :param publish_policy: The PublishPolicy choosing the QoS and retain flag of the
+            published topics (default is QoS 2, not retained, for all topics).
+        :param mqtt_buffer: The queue to buffer received messages in (default is an unbounded
+            queue).
+        :param tls: Whether to connect with TLS (default is True).
+        :param reconnect_min_delay: The delay before the first reconnection attempt, doubled
+            after each failed attempt, in seconds (default is 1).
+        :param reconnect_max_delay: The maximum delay between reconnection attempts, in seconds
+            (default is 60).
+        :param spool: The Spool keeping the messages published while disconnected (default is
+            to drop them, except the QoS 1 and 2 messages kept in memory by the client). With
+            several connections, it is the spool of the first one, the others spooling to the
+            c1, c2... subdirectories with the same limits.
+        :param replay_rate: The maximum number of spooled messages published per second once
+            reconnected (default is 1000).
+        :param codecs: The PayloadCodecs choosing the codec of each topic (default is JSON for
+            all topics).
+        :param recorder: The Recorder capturing the received messages, or None.
+        :param connections: The number of connections publishing the messages, the topics being
+            spread over them by hash (default is 1). The first connection uses client_id, the
+            others client_id followed by -c1, -c2...
         """
         self.broker = broker
         self.port = port
@@ -50,58 +97,153 @@ class MQTTClientHandler:
         self.password = password
         self.ca_certs = ca_certs
         self.encoding = encoding
-        self.BytesEncoder.encoding = encoding
-        self.client = mqtt.Client(client_id=self.client_id,
-                                  callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
-        self.client.username_pw_set(self.username, self.password)
-        self.client.tls_set(ca_certs=self.ca_certs)
-        self.client.on_connect = self._on_connect
-        self.client.on_disconnect = self._on_disconnect
-        self.mqtt_buffer = queue.Queue()
+        self.publish_policy = publish_policy or PublishPolicy()
+        self.codecs = codecs or PayloadCodecs(encoding=encoding)
+        self.client_ids = [client_id] + [f"{client_id}-c{index}"
+                                         for index in range(1, max(1, connections))]
+        self.clients = []
+        for index, connection_id in enumerate(self.client_ids):
+            # The index of the connection is given to the callbacks as user data
+            client = mqtt.Client(client_id=connection_id, userdata=index,
+                                 callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+            client.username_pw_set(self.username, self.password)
+            if tls:
+                client.tls_set(ca_certs=self.ca_certs)
+            # The network loop reconnects by itself, waiting between attempts without blocking
+            client.reconnect_delay_set(reconnect_min_delay, reconnect_max_delay)
+            client.on_connect = self._on_connect
+            client.on_connect_fail = self._on_connect_fail
+            client.on_disconnect = self._on_disconnect
+            client.on_publish = self._on_publish
+            self.clients.append(client)
+        # The first connection also carries the subscriptions
+        self.client = self.clients[0]
+        self.states = [DISCONNECTED] * len(self.clients)
+        # Messages handed to each connection, and those it has written or got acknowledged
+        self._sent = [0] * len(self.clients)
+        self._acked = [0] * len(self.clients)
+        self.mqtt_buffer = queue.Queue() if mqtt_buffer is None else mqtt_buffer
+        self.spool = spool
+        # Spool of each connection, or None
+        self.spools = [spool] + [
+            Spool(os.path.join(spool.path, f"c{index}"), spool.max_bytes, spool.max_age,
+                  spool.segment_size) if spool is not None else None
+            for index in range(1, len(self.clients))]
+        self.replay_rate = replay_rate
+        # Per connection, the time each topic was last published while the spool was being
+        # replayed: the older spooled messages of the topic are not replayed after it
+        self._live = [{} for _ in self.clients]
+        self._replay_locks = [threading.Lock() for _ in self.clients]
+        self.recorder = recorder
+        self._subscriptions = {}  # Topic -> QoS, subscribed again after a reconnection
+        self._connected_once = False
+        self._replay_event = threading.Event()
+        self._replay_thread = None
+        self._stopping = False
+        for index, connection_id in enumerate(self.client_ids):
+            METRICS.gauge("osc2mqtt_mqtt_connected", "Whether the MQTT connection is connected",
+                          function=lambda index=index: int(self.states[index] == CONNECTED),
+                          client_id=connection_id)
+            METRICS.gauge("osc2mqtt_mqtt_inflight_messages",
+                          "Messages handed to the MQTT connection, not yet sent or acknowledged",
+                          function=lambda index=index: max(0, self._sent[index]
+                                                           - self._acked[index]),
+                          client_id=connection_id)
+            connection_spool = self.spools[index]
+            if connection_spool is not None:
+                METRICS.gauge("osc2mqtt_mqtt_spool_messages", "Messages waiting in the spool",
+                              function=connection_spool.__len__, client_id=connection_id)
+                METRICS.gauge("osc2mqtt_mqtt_spool_bytes", "Size of the spool",
+                              function=lambda spool=connection_spool: spool.size,
+                              client_id=connection_id)
+                METRICS.gauge("osc2mqtt_mqtt_spool_evicted", "Spooled messages evicted",
+                              function=lambda spool=connection_spool: spool.dropped +
+                              spool.expired, client_id=connection_id)
+
+    @property
+    def state(self):
+        """
+        The state of the pool of connections: CONNECTED once all of them are connected,
+        DISCONNECTED once all of them are disconnected, CONNECTING otherwise.
+        """
+        states = set(self.states)
+        return states.pop() if len(states) == 1 else CONNECTING
+
+    def connection_for(self, topic):
+        """
+        Get the index of the connection publishing the messages of a topic.
+
+        :param topic: The topic.
+        :return: The index of the connection.
+        """
+        if len(self.clients) == 1:
+            return 0
+        return zlib.crc32(topic.encode(self.encoding)) % len(self.clients)
 
     def _on_connect(self, client, userdata, flags, rc, properties):
         """
         Callback for when the client connects to the broker.
 
         :param client: The client instance.
-        :param userdata: User data of any type.
+        :param userdata: The index of the connection.
         :param flags: Response flags sent by the broker.
         :param rc: The connection result code.
         :param properties: The MQTT properties.
         """
-        if rc == 0:
-            logging.info("Connected to MQTT Broker %s:%d as %s",
-                         self.broker, self.port, self.client_id)
-        else:
-            msg = f"Failed to connect, return code {rc}"
-            logging.error(msg)
-            raise ConnectionError(msg)
+        if rc != 0:
+            # The network loop keeps trying to reconnect
+            logging.error("Failed to connect, return code %s", rc)
+            return
+        logging.info("Connected to MQTT Broker %s:%d as %s",
+                     self.broker, self.port, self.client_ids[userdata])
+        if userdata == 0:
+            if self._connected_once:
+                for topic, qos in self._subscriptions.items():
+                    client.subscribe(topic, qos)
+            self._connected_once = True
+        self.states[userdata] = CONNECTED
+        self._replay_event.set()
 
-    def _on_disconnect(self, client, userdata, rc):
+    def _on_connect_fail(self, client, userdata):
         """
-        Callback for when the client disconnects from the broker.
+        Callback for when a reconnection attempt fails.
 
         :param client: The client instance.
-        :param userdata: User data of any type.
-        :param rc: The disconnection result code.
+        :param userdata: The index of the connection.
         """
-        logging.info("Disconnected with result code: %d", rc)
-        count, delay = 0, 1
-        while count < 12:
-            logging.info("Reconnecting in %d seconds...", delay)
-            time.sleep(delay)
-            try:
-                client.reconnect()
-                logging.info("Reconnected successfully!")
-                return
-            except Exception as err:
-                logging.error("Reconnect failed: %s", err)
-            delay *= 2
-            delay = min(delay, 60)
-            count += 1
-        msg = f"Reconnect failed after {count} attempts"
-        logging.error(msg)
-        raise ConnectionError(msg)
+        logging.warning("Failed to reconnect to MQTT Broker %s:%d as %s, retrying",
+                        self.broker, self.port, self.client_ids[userdata])
+
+    def _on_disconnect(self, client, userdata, flags, rc, properties):
+        """
+        Callback for when the client disconnects from the broker. The network loop reconnects
+        in the background, unless the client is stopping.
+
+        :param client: The client instance.
+        :param userdata: The index of the connection.
+        :param flags: The disconnection flags.
+        :param rc: The disconnection reason code.
+        :param properties: The MQTT properties.
+        """
+        self.states[userdata] = DISCONNECTED if self._stopping else CONNECTING
+        logging.info("Disconnected %s with result code: %s", self.client_ids[userdata], rc)
+        if not self._stopping:
+            if self.spools[userdata] is not None:
+                logging.info("Spooling messages to %s until reconnected",
+                             self.spools[userdata].path)
+            logging.info("Reconnecting...")
+
+    def _on_publish(self, client, userdata, mid, rc, properties):
+        """
+        Callback for when a message has been sent (QoS 0) or acknowledged (QoS 1 and 2).
+
+        :param client: The client instance.
+        :param userdata: The index of the connection.
+        :param mid: The message ID.
+        :param rc: The reason code.
+        :param properties: The MQTT properties.
+        """
+        self._acked[userdata] += 1
 
     def _on_json_message(self, client, userdata, msg):
         """
@@ -111,43 +253,252 @@ class MQTTClientHandler:
         :param userdata: User data of any type.
         :param msg: The received message.
         """
-        self.mqtt_buffer.put(
-            (msg.topic, json.loads(msg.payload.decode(self.encoding))))
+        RECEIVED.inc()
+        if self.recorder is not None:
+            self.recorder.record(M2O, msg.topic.encode(self.encoding), msg.payload)
+        codec = self.codecs.resolve(msg.topic)
+        start = time.perf_counter()
+        try:
+            message = codec.decode(msg.payload)
+        except Exception as e:
+            # Counted and dropped: raising here would stop the network loop
+            METRICS.counter("osc2mqtt_mqtt_decode_failures_total",
+                            "MQTT payloads which could not be decoded", codec=codec.name).inc()
+            logging.debug("Dropped %s payload on %s which failed to decode: %s",
+                          codec.name, msg.topic, e)
+            return
+        DECODE_SECONDS.observe(time.perf_counter() - start)
+        self.mqtt_buffer.put((msg.topic, message))
 
     def connect(self):
         """
-        Connect to the MQTT broker.
+        Connect to the MQTT broker. The connections of the pool are opened in parallel, so that
+        their TLS handshakes do not add up.
+
+        :raises Exception: The error of the first connection which failed, if any.
         """
         logging.info("Connecting to MQTT Broker %s:%d as %s",
-                     self.broker, self.port, self.client_id)
-        self.client.connect(self.broker, self.port)
+                     self.broker, self.port, ", ".join(self.client_ids))
+        self.states = [CONNECTING] * len(self.clients)
+        if len(self.clients) == 1:
+            self.client.connect(self.broker, self.port)
+            return
+        errors = [None] * len(self.clients)
 
-    def publish_json(self, topic, message, qos=2, retain=False):
+        def connect(index):
+            try:
+                self.clients[index].connect(self.broker, self.port)
+            except Exception as e:
+                errors[index] = e
+        threads = [threading.Thread(target=connect, args=(index,), name=f"mqtt_connect_{index}")
+                   for index in range(len(self.clients))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def _publish_on(self, index, topic, payload, qos, retain):
         """
-        Publish a JSON message to a topic.
+        Publish a message on a connection of the pool.
+
+        :param index: The index of the connection.
+        :param topic: The topic to publish to.
+        :param payload: The encoded message.
+        :param qos: The quality of service level.
+        :param retain: Whether to retain the message.
+        :return: The reason code of the publication.
+        """
+        rc = self.clients[index].publish(topic, payload, qos, retain).rc
+        if rc == mqtt.MQTT_ERR_SUCCESS or (rc == mqtt.MQTT_ERR_NO_CONN and qos):
+            self._sent[index] += 1
+        return rc
+
+    def _publish(self, topic, payload, qos, retain):
+        """
+        Publish an encoded message, or spool it while disconnected. Once reconnected, the
+        messages are published right away, while the spooled ones are replayed alongside at
+        replay_rate, so that the live messages are not delayed by the backlog. The spooled
+        messages of a topic published meanwhile are then skipped, not to overwrite its newer
+        message.
+
+        :param topic: The topic to publish to.
+        :param payload: The encoded message.
+        :param qos: The quality of service level.
+        :param retain: Whether to retain the message.
+        :return: The reason code of the publication, MQTT_ERR_SUCCESS if spooled.
+        """
+        index = self.connection_for(topic)
+        spool = self.spools[index]
+        if spool is not None and self.states[index] != CONNECTED:
+            spool.append(topic, payload, qos, retain)
+            SPOOLED.inc()
+            self._replay_event.set()
+            return mqtt.MQTT_ERR_SUCCESS
+        if spool:
+            # Being replayed
+            with self._replay_locks[index]:
+                self._live[index][topic] = time.time()
+                rc = self._publish_on(index, topic, payload, qos, retain)
+        else:
+            rc = self._publish_on(index, topic, payload, qos, retain)
+        if rc == mqtt.MQTT_ERR_NO_CONN:
+            if qos:
+                # Kept by the client, and sent once reconnected
+                return mqtt.MQTT_ERR_SUCCESS
+            if spool is not None:
+                spool.append(topic, payload, qos, retain)
+                SPOOLED.inc()
+                return mqtt.MQTT_ERR_SUCCESS
+        return rc
+
+    def _replay_loop(self):
+        """
+        Publish the spooled messages of each connection in order while it is connected, the
+        connections taking turns, at most replay_rate per second in total. The messages older
+        than a message of their topic published since the reconnection are skipped.
+        """
+        interval = 1 / self.replay_rate
+        chunk = max(1, int(self.replay_rate / 10))
+        replaying = set()  # Indexes of the connections whose spool is being replayed
+        next_time = time.monotonic()
+        while not self._stopping:
+            ready = [index for index, spool in enumerate(self.spools)
+                     if spool and self.states[index] == CONNECTED]
+            if not ready:
+                self._replay_event.wait(1)
+                self._replay_event.clear()
+                next_time = time.monotonic()
+                continue
+            for index in ready:
+                spool = self.spools[index]
+                if index not in replaying:
+                    replaying.add(index)
+                    logging.info("Replaying %d spooled messages of %s", len(spool),
+                                 self.client_ids[index])
+                live = self._live[index]
+                for record in spool.read(chunk):
+                    if self._stopping or self.states[index] != CONNECTED:
+                        break
+                    with self._replay_locks[index]:
+                        published = live.get(record.topic)
+                        if published is not None and record.timestamp <= published:
+                            spool.commit(record)
+                            SUPERSEDED.inc()
+                            continue
+                        rc = self._publish_on(index, record.topic, record.payload, record.qos,
+                                              record.retain)
+                    if rc != mqtt.MQTT_ERR_SUCCESS and not (
+                            rc == mqtt.MQTT_ERR_NO_CONN and record.qos):
+                        # Disconnected meanwhile: retried once reconnected
+                        self._replay_event.wait(interval)
+                        break
+                    spool.commit(record)
+                    REPLAYED.inc()
+                    next_time += interval
+                    delay = next_time - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    else:
+                        next_time = time.monotonic()
+                if not spool:
+                    with self._replay_locks[index]:
+                        live.clear()
+                    replaying.discard(index)
+                    logging.info("Replayed the spooled messages of %s", self.client_ids[index])
+
+    def publish_json(self, topic, message, qos=None, retain=None):
+        """
+        Publish a message to a topic, encoded with the codec of the topic (JSON by default).
 
         :param topic: The topic to publish to.
         :param message: The message to publish.
-        :param qos: The quality of service level (default is 2).
-        :param retain: Whether to retain the message (default is False).
+        :param qos: The quality of service level (default is given by the publish policy).
+        :param retain: Whether to retain the message (default is given by the publish policy).
         """
-        message = json.dumps(message, cls=self.BytesEncoder)
-        info = self.client.publish(topic, message, qos, retain)
-        if info.rc == mqtt.MQTT_ERR_SUCCESS:
-            logging.info("Published to MQTT: {%s: %s}", topic, message)
+        if qos is None or retain is None:
+            policy_qos, policy_retain = self.publish_policy.resolve(topic)
+            qos = policy_qos if qos is None else qos
+            retain = policy_retain if retain is None else retain
+        message = self.codecs.resolve(topic).encode(message)
+        rc = self._publish(topic, message, qos, retain)
+        if rc == mqtt.MQTT_ERR_SUCCESS:
+            PUBLISHED.inc()
+            TRACER.log("Published to MQTT: {%s: %s}", topic, message)
         else:
-            msg = f"Failed to publish to topic {topic}, reason code {info.rc}"
+            PUBLISH_FAILURES.inc()
+            msg = f"Failed to publish to topic {topic}, reason code {rc}"
             logging.error(msg)
             raise IOError(msg)
 
+    def publish_json_batch(self, messages):
+        """
+        Publish a batch of messages, each encoded with the codec of its topic and published with
+        the QoS and retain flag given by the publish policy. All the messages are encoded, then
+        handed to the client in one go.
+
+        :param messages: The list of (topic, message) tuples to publish.
+        """
+        resolve = self.publish_policy.resolve
+        codec = self.codecs.resolve
+        publish = self._publish
+        failed = 0
+        start = time.perf_counter()
+        payloads = []
+        for topic, message in messages:
+            try:
+                payloads.append((topic, codec(topic).encode(message)))
+            except (TypeError, ValueError, OverflowError) as e:
+                failed += 1
+                logging.error("Failed to encode message to topic %s: %s", topic, e)
+        encoded = time.perf_counter()
+        ENCODE_SECONDS.observe(encoded - start)
+        for topic, payload in payloads:
+            qos, retain = resolve(topic)
+            rc = publish(topic, payload, qos, retain)
+            if rc != mqtt.MQTT_ERR_SUCCESS:
+                failed += 1
+                logging.error("Failed to publish to topic %s, reason code %d", topic, rc)
+        PUBLISH_SECONDS.observe(time.perf_counter() - encoded)
+        PUBLISHED.inc(len(messages) - failed)
+        if failed:
+            PUBLISH_FAILURES.inc(failed)
+            raise IOError(f"Failed to publish {failed} of {len(messages)} messages")
+
     def subscribe_json(self, topic, qos=2):
         """
-        Subscribe to a topic and handle JSON messages.
+        Subscribe to a topic and handle its messages, decoded with the codec of their topic.
 
         :param topic: The topic to subscribe to.
         :param qos: The quality of service level (default is 2).
         """
         self.client.on_message = self._on_json_message
+        self._subscribe(topic, qos)
+
+    def subscribe_callback(self, topic, callback, qos=0):
+        """
+        Subscribe to a topic and handle its messages with a callback, called from the network
+        loop, instead of buffering them.
+
+        :param topic: The topic to subscribe to.
+        :param callback: The function called with the topic and the payload of each message.
+        :param qos: The quality of service level (default is 0).
+        """
+        self.client.message_callback_add(
+            topic, lambda client, userdata, msg: callback(msg.topic, msg.payload))
+        self._subscribe(topic, qos)
+
+    def _subscribe(self, topic, qos):
+        """
+        Subscribe to a topic on the first connection, again after each reconnection.
+
+        :param topic: The topic to subscribe to.
+        :param qos: The quality of service level.
+        :raises ConnectionError: If the subscription failed.
+        """
+        self._subscriptions[topic] = qos
         rc, mid = self.client.subscribe(topic, qos)
         if rc == mqtt.MQTT_ERR_SUCCESS:
             logging.info(
@@ -159,12 +510,31 @@ class MQTTClientHandler:
 
     def start(self):
         """
-        Start the MQTT client loop.
+        Start the MQTT client loops, and the replay of the spooled messages.
         """
-        self.client.loop_start()
+        self._stopping = False
+        for client in self.clients:
+            client.loop_start()
+        if self.spool is not None:
+            self._replay_thread = threading.Thread(target=self._replay_loop, name="mqtt_replay")
+            self._replay_thread.start()
 
     def stop(self):
         """
-        Stop the MQTT client loop.
+        Stop the MQTT client loops. The messages left in the spool are kept for the next run.
         """
-        self.client.loop_stop()
+        self._stopping = True
+        self._replay_event.set()
+        if self._replay_thread is not None:
+            self._replay_thread.join()
+            self._replay_thread = None
+        for client in self.clients:
+            client.disconnect()
+        for client in self.clients:
+            client.loop_stop()
+        self.states = [DISCONNECTED] * len(self.clients)
+        for spool in self.spools:
+            if spool is not None:
+                if len(spool):
+                    logging.info("%d messages left in the spool %s", len(spool), spool.path)
+                spool.close()
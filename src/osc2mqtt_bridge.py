@@ -2,17 +2,39 @@
 A bridge that connects OSC (Open Sound Control) and MQTT (Message Queuing Telemetry Transport)
 protocols. It listens for OSC messages and publishes them to an MQTT topic, and vice versa.
 """
+import fnmatch
+import functools
+import itertools
+import threading
 import time
 import logging
-import queue
 import shutil
+import signal
 import os
+import sys
 from collections.abc import Iterable
 import yaml
+from oscpy.parser import format_message
+from bridge_queue import BridgeQueue, DispatchPool, get_batch
+from canary import Canary
+from coalescer import Coalescer
+from metrics import METRICS, TRACER, MetricsServer
 from mqtt_handler import MQTTClientHandler
-from osc_handler import OSCServerHandler
+from osc_handler import OSCServerHandler, read_values
+from payload_codecs import OscPacket, PayloadCodecs, RawOscCodec
+from publish_policy import PublishPolicy
+from recorder import Recorder
+from routing import RoutingTable
+from scheduler import DelayedScheduler
 from simple_thread import SimpleThread
+from spool import Spool
+from state_cache import StateCache
 from t2u_osc_server import Tcp2UnixOscServer
+from udp_osc_server import UdpOscServer
+
+
+O2M_ERRORS = METRICS.counter("osc2mqtt_o2m_errors_total",
+                             "OSC messages dropped on an error before being published to MQTT")
 
 
 class OSC2MQTTBridge:
@@ -21,93 +43,410 @@ class OSC2MQTTBridge:
     protocols. It listens for OSC messages and publishes them to an MQTT topic, and vice versa.
     """
 
-    def __init__(self, config, encoding='utf-8'):
+    # By default, a [1.0] message is followed by a [0.0] message 100 ms later, on all addresses
+    DEFAULT_AUTO_RESET = [{"address": "*", "trigger": [1.0], "reset": [0.0], "delay": 0.1}]
+
+    DIRECTIONS = ("o2m", "m2o")
+
+    def __init__(self, config, encoding='utf-8', directions=DIRECTIONS):
         """
         Initialize the OSC2MQTTBridge with the given configuration.
 
         :param config: Configuration dictionary containing MQTT and OSC settings.
         :param encoding: Encoding to use for OSC messages.
+        :param directions: The directions handled by the bridge: "o2m" listens to the OSC
+            clients and publishes to MQTT, "m2o" subscribes to MQTT and sends to the OSC clients
+            (default is both).
         """
         self.config = config
         self.encoding = encoding
-        self.mqtt_handler = MQTTClientHandler(**config["mqtt"]["connection"])
-        self.osc_handler = OSCServerHandler(config["osc"]["unix_socket_path"])
-        self.t2u = Tcp2UnixOscServer(**config["osc"])
+        self.directions = directions
+        bridge_config = config.get("bridge", {})
+        queues = bridge_config.get("queues", {})
+        self.osc_buffer = BridgeQueue(**queues.get("osc", {}), name="osc")
+        # Messages from MQTT, dispatched by OSC address to m2o_threads threads
+        self.mqtt_buffer = DispatchPool(self._m2o_dispatch, bridge_config.get("m2o_threads", 1),
+                                        key=self._m2o_partition_key, name="mqtt",
+                                        **queues.get("mqtt", {}))
+        publishing = config["mqtt"].get("publishing", {})
+        self.batch_size = publishing.get("batch_size", 100)
+        self.max_latency = publishing.get("max_latency", 0.005)
+        publish_policy = PublishPolicy(publishing.get("rules", ()),
+                                       publishing.get("qos", 2),
+                                       publishing.get("retain", False))
+        spool_config = dict(config["mqtt"].get("spool") or {})
+        replay_rate = spool_config.pop("replay_rate", 1000)
+        spool = Spool(**spool_config) if spool_config else None
+        recorder_config = bridge_config.get("recorder")
+        self.recorder = Recorder(**recorder_config) if recorder_config else None
+        codecs_config = config["mqtt"].get("codecs", {})
+        self.codecs = PayloadCodecs(codecs_config.get("rules", ()),
+                                    codecs_config.get("default", "json"), encoding)
+        self.mqtt_handler = MQTTClientHandler(**config["mqtt"]["connection"],
+                                              publish_policy=publish_policy,
+                                              mqtt_buffer=self.mqtt_buffer,
+                                              spool=spool, replay_rate=replay_rate,
+                                              codecs=self.codecs, recorder=self.recorder)
+        self.osc_handler = OSCServerHandler(config["osc"].get("unix_socket_path"),
+                                            osc_buffer=self.osc_buffer,
+                                            recorder=self.recorder)
+        osc_config = dict(config["osc"])
+        udp_config = osc_config.pop("udp", None)
+        self.t2u = Tcp2UnixOscServer(**osc_config,
+                                     packet_handler=self.osc_handler.handle_packet,
+                                     encoding=encoding)
+        self.udp = UdpOscServer(**udp_config, packet_handler=self.osc_handler.handle_packet) \
+            if udp_config else None
+        self.auto_reset_rules = [
+            (rule["address"], list(rule.get("trigger", [1.0])), list(rule.get("reset", [0.0])),
+             rule.get("delay", 0.1))
+            for rule in bridge_config.get("auto_reset", self.DEFAULT_AUTO_RESET)]
+        self._auto_reset_rule = functools.lru_cache(
+            maxsize=bridge_config.get("route_cache_size", 4096))(self._find_auto_reset_rule)
+        # Address -> id of its pending reset: a reset only fires if it is still the pending one
+        self._pending_resets = {}
+        self._reset_ids = itertools.count()
+        # The addresses are spread over these locks, held while sending a message of an address
+        # and updating its pending reset, and while sending the reset
+        self._reset_locks = [threading.Lock()
+                             for _ in range(max(1, bridge_config.get("m2o_threads", 1)))]
+        self.scheduler = DelayedScheduler("auto_reset")
+        coalesce_rules = bridge_config.get("coalesce", ())
+        self.coalescer = Coalescer(coalesce_rules) if coalesce_rules else None
+        # The topics give the catch-all routes, overridden by longer route prefixes
+        topics = config["mqtt"]["topics"]
+        routes = [{"osc": "", "mqtt": topics["publish"], "direction": "o2m"},
+                  {"osc": "", "mqtt": topics["subscribe"], "direction": "m2o"}]
+        routes.extend(bridge_config.get("routes", ()))
+        self.routes = RoutingTable(routes, encoding,
+                                   bridge_config.get("route_cache_size", 4096))
+        TRACER.sample = bridge_config.get("trace_sample", 0)
+        metrics_config = bridge_config.get("metrics")
+        self.metrics_server = MetricsServer(**metrics_config) if metrics_config else None
+        state_config = bridge_config.get("state")
+        self.state = None
+        # Called with the list of (address, message) tuples which changed the state, per batch
+        # of messages from OSC, or None
+        self.on_state_change = None
+        if state_config is not None:
+            state_config = dict(state_config)
+            self.suppress_unchanged = state_config.pop("suppress_unchanged", False)
+            self.snapshot_bundle_size = state_config.pop("bundle_size", 1400)
+            self.state = StateCache(**state_config, encoding=encoding)
+            METRICS.gauge("osc2mqtt_state_addresses", "OSC addresses in the state cache",
+                          function=self.state.__len__)
+            METRICS.gauge("osc2mqtt_state_suppressed_messages",
+                          "OSC messages not published as they did not change the state",
+                          function=lambda: self.state.suppressed)
+            if "m2o" in directions:
+                self.t2u.osc_clients.on_change = self._on_osc_clients_change
+        if self.coalescer:
+            METRICS.gauge("osc2mqtt_coalesced_messages",
+                          "OSC messages merged into a later one by the coalescer",
+                          function=lambda: self.coalescer.merged)
+        canary_config = bridge_config.get("canary")
+        self.canary = None
+        if canary_config is not None and "m2o" in directions:
+            self.canary = self._new_canary(dict(canary_config), topics["subscribe"])
         self.o2m_task = None
-        self.m2o_task = None
+
+    def _new_canary(self, canary_config, subscribe_topic):
+        """
+        Create the canary, probing the directions of the bridge through its routes.
+
+        :param canary_config: The parameters of the canary (see Canary).
+        :param subscribe_topic: The subscribe topic, the canary address being appended to it
+            to publish the m2o probes (default for the topic option of the canary).
+        :return: The Canary.
+        :raises ValueError: If the canary address is not routed in both directions.
+        """
+        address = canary_config.pop("address", Canary.ADDRESS)
+        b_addr = address.encode(self.encoding)
+        m2o_topic = canary_config.pop("topic", subscribe_topic.rstrip("/") + address)
+        route = self.routes.m2o(m2o_topic)
+        if route is None or route[0] != b_addr:
+            raise ValueError(f"The canary topic {m2o_topic} is not routed to {address}")
+        o2m_topic = None
+        if "o2m" in self.directions:
+            route = self.routes.o2m(b_addr)
+            if route is None:
+                raise ValueError(f"The canary address {address} is not routed to MQTT")
+            o2m_topic = route[0]
+        return Canary(self.mqtt_handler, self.t2u, m2o_topic, o2m_topic, address,
+                      **canary_config, encoding=self.encoding)
 
     def start(self):
         """
         Start the OSC2MQTTBridge. This includes starting the OSC server, TCP to Unix OSC server,
         connecting to the MQTT broker, and starting the message handling loops.
         """
-        self.osc_handler.start()
-        self.t2u.start()
-        topic_cmnd = self.config["mqtt"]["topics"]["subscribe"]
-        topic_stat = self.config["mqtt"]["topics"]["publish"]
+        o2m, m2o = "o2m" in self.directions, "m2o" in self.directions
+        if self.metrics_server:
+            self.metrics_server.start()
+        if o2m:
+            self.osc_handler.start()
+            self.t2u.start()
+            if self.udp:
+                self.udp.start()
+        if m2o:
+            self.t2u.fanout.start()
+            self.scheduler.start()
         try:
             self.mqtt_handler.connect()
-            self.mqtt_handler.subscribe_json(topic_cmnd + "/#")
+            if m2o:
+                for topic in self.routes.subscriptions:
+                    self.mqtt_handler.subscribe_json(topic)
         except Exception as e:
             logging.error("Failed to start OSC2MQTTBridge: %s", str(e))
             logging.error("Trace", e)
             raise SystemExit(
                 "Exiting due to failure in starting OSC2MQTTBridge.") from e
         self.mqtt_handler.start()
-        self.o2m_task = SimpleThread(self._o2m_loop, args=(topic_stat,))
-        self.m2o_task = SimpleThread(self._m2o_loop, args=(topic_cmnd,))
+        if o2m:
+            self.o2m_task = SimpleThread(self._o2m_loop, args=())
+        if m2o:
+            self.mqtt_buffer.start()
+        if self.canary:
+            self.canary.start()
 
     def stop(self):
         """
         Stop the OSC2MQTTBridge. This includes stopping the message handling loops, MQTT handler,
         TCP to Unix OSC server, and OSC server.
         """
-        if self.m2o_task:
-            self.m2o_task.stop()
+        if self.canary:
+            self.canary.stop()
         if self.o2m_task:
             self.o2m_task.stop()
         self.mqtt_handler.stop()
-        self.t2u.stop()
-        self.osc_handler.stop()
+        # No more messages from MQTT: send the queued ones before stopping
+        self.mqtt_buffer.stop()
+        if self.coalescer:
+            logging.info("Coalesced %d OSC messages.", self.coalescer.merged)
+        for buffer in (self.osc_buffer, self.mqtt_buffer):
+            if buffer.dropped:
+                logging.warning("Queue %s dropped %d items.", buffer.name, buffer.dropped)
+        self.scheduler.stop()
+        self.t2u.fanout.stop()
+        if "o2m" in self.directions:
+            self.t2u.stop()
+            if self.udp:
+                self.udp.stop()
+            self.osc_handler.stop()
+        if self.state is not None:
+            self.state.save()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.metrics_server:
+            self.metrics_server.stop()
 
-    def _o2m_loop(self, topic_stat):
+    def _o2m_loop(self):
         """
-        Loop to handle OSC messages and publish them to the MQTT topic.
-
-        :param topic_stat: The MQTT topic prefix for publishing OSC messages.
+        Loop to handle OSC messages and publish them to the MQTT topics of their routes, in
+        batches of up to batch_size messages collected for at most max_latency seconds. The
+        messages of the addresses throttled by the coalescer are held until their interval
+        elapses.
         """
+        coalescer = self.coalescer
+        if coalescer is None:
+            batch = get_batch(self.osc_handler.osc_buffer, self.batch_size, self.max_latency)
+        else:
+            next_due = coalescer.next_due()
+            timeout = 1 if next_due is None else min(1, max(0, next_due - time.monotonic()))
+            batch = get_batch(self.osc_handler.osc_buffer, self.batch_size, self.max_latency,
+                              timeout)
+            now = time.monotonic()
+            batch = coalescer.due(now) + [item for item in batch
+                                          if coalescer.offer(item[0], item, now)]
+        if not batch:
+            return
+        messages = []
+        changes = [] if self.on_state_change is not None else None
+        for address, values, packet in batch:
+            try:
+                message = self._o2m_message(address, values, packet, changes)
+            except Exception as e:
+                # A malformed message is dropped, without stopping the loop nor the batch
+                O2M_ERRORS.inc()
+                logging.error("OSC->MQTT: dropped message to %r: %s", address, e)
+                continue
+            if message is not None:
+                messages.append(message)
+        if changes:
+            self.on_state_change(changes)
+        if not messages:
+            return
         try:
-            address, values = self.osc_handler.osc_buffer.get(timeout=1)
-            address = address.decode(self.encoding)
-            topic = topic_stat + address
-            message = values[0] if len(values) == 1 else values
-            logging.info("OSC->MQTT: {%s: %s}", topic, message)
-            self.mqtt_handler.publish_json(topic, message)
-        except queue.Empty:
-            pass
+            self.mqtt_handler.publish_json_batch(messages)
+        except IOError as e:
+            logging.error("OSC->MQTT: %s", e)
 
-    def _m2o_loop(self, topic_cmnd, auto_send_zero=True):
+    def _o2m_message(self, address, values, packet=None, changes=None):
         """
-        Loop to handle MQTT messages and send them as OSC messages.
+        Translate an OSC message to the MQTT message of its route, recording it in the state
+        cache. The OSC message is published unchanged on the topics of the raw codec, its values
+        are only decoded for the other topics.
 
-        :param topic_cmnd: The MQTT topic prefix for subscribing to MQTT messages.
-        :param auto_send_zero: Whether to automatically send a [0.0] message after a [1.0] message.
+        :param address: The OSC address, as bytes.
+        :param values: The OSC values, or None if they are not decoded yet.
+        :param packet: The OSC message as received, or None.
+        :param changes: The list to append the (address, message) tuple to if the message
+            changed the state, or None.
+        :return: The (topic, message) tuple, or None if the message is not published.
         """
-        try:
-            topic, message = self.mqtt_handler.mqtt_buffer.get(timeout=1)
-            logging.info("MQTT->OSC: {%s: %s}", topic, message)
-            prefix = topic_cmnd
-            if topic.startswith(prefix):
-                address = topic[len(prefix):]
-                b_addr = address.encode('utf-8')
-                values = message if isinstance(
-                    message, Iterable) else [message]
-                self.t2u.send_to_clients(b_addr, values)
-                if auto_send_zero and message == 1.0:
-                    time.sleep(0.1)
-                    self.t2u.send_to_clients(b_addr, [0.0])
-        except queue.Empty:
-            pass
+        route = self.routes.o2m(address)
+        if route is None:
+            return None
+        if self.state is not None:
+            encoded = packet if packet is not None else self.state.encode(address, values)
+            if self.state.put(address, encoded):
+                if changes is not None:
+                    changes.append((address, encoded))
+            elif self.suppress_unchanged:
+                return None
+        topic, transform = route
+        if isinstance(self.codecs.resolve(topic), RawOscCodec):
+            if packet is None:
+                # Received on the Unix socket, and decoded by the OSC server
+                packet = format_message(address, values, encoding=self.encoding)[0]
+            return topic, packet
+        if values is None:
+            values = read_values(packet)
+        if transform is not None:
+            values = transform(values)
+        message = values[0] if len(values) == 1 else values
+        TRACER.log("OSC->MQTT: {%s: %s}", topic, message)
+        return topic, message
+
+    def _send_to_clients(self, address, values):
+        """
+        Send an OSC message to the OSC clients, recording it in the state cache.
+
+        :param address: The OSC address, as bytes.
+        :param values: The OSC values.
+        """
+        if self.state is None:
+            self.t2u.send_to_clients(address, values)
+            return
+        message = self.state.encode(address, values)
+        self.state.put(address, message)
+        self.t2u.send_packet_to_clients(message)
+
+    def _on_osc_clients_change(self, event, endpoint, *patterns):
+        """
+        Schedule the snapshot of the state for a newly connected or subscribed OSC client, to
+        be sent from the scheduler thread rather than from the thread accepting the client.
+
+        :param event: "add", "remove", "subscribe" or "unsubscribe".
+        :param endpoint: The endpoint of the client.
+        :param patterns: The OSC address patterns of a subscription.
+        """
+        if event in ("add", "subscribe"):
+            self.scheduler.schedule(("snapshot", endpoint), 0, self._send_snapshot, endpoint)
+
+    def _send_snapshot(self, endpoint):
+        """
+        Send the state to an OSC client, as bundles.
+
+        :param endpoint: The endpoint of the client.
+        """
+        endpoints_for = self.t2u.osc_clients.endpoints_for
+        bundles = self.state.bundles(self.snapshot_bundle_size,
+                                     lambda address: endpoint in endpoints_for(address))
+        for bundle in bundles:
+            self.t2u.fanout.send_packet(bundle, (endpoint,))
+        logging.info("Sent the state of OSC addresses to %s in %d bundles", endpoint, len(bundles))
+
+    def _find_auto_reset_rule(self, address):
+        """
+        Get the auto reset rule of an OSC address, cached in _auto_reset_rule.
+
+        :param address: The OSC address, as bytes.
+        :return: The first matching (pattern, trigger, reset, delay) rule, or None.
+        """
+        name = address.decode(self.encoding, errors="replace")
+        return next((rule for rule in self.auto_reset_rules
+                     if fnmatch.fnmatchcase(name, rule[0])), None)
+
+    @staticmethod
+    def _is_trigger(values, trigger):
+        """
+        Tell whether values are the trigger of an auto reset rule, with the same types: an int 1
+        is not the 1.0 trigger.
+
+        :param values: The OSC values.
+        :param trigger: The trigger values of the rule.
+        :return: True if the values are the trigger.
+        """
+        values = list(values)
+        return len(values) == len(trigger) and all(
+            type(value) is type(expected) and value == expected
+            for value, expected in zip(values, trigger))
+
+    def _reset(self, address, values, reset_id):
+        """
+        Send the reset values of an address, unless a newer message replaced the reset.
+
+        :param address: The OSC address, as bytes.
+        :param values: The reset values.
+        :param reset_id: The id of the reset.
+        """
+        with self._reset_locks[hash(address) % len(self._reset_locks)]:
+            if self._pending_resets.get(address) != reset_id:
+                return
+            del self._pending_resets[address]
+            self._send_to_clients(address, values)
+
+    def _m2o_partition_key(self, item):
+        """
+        Get the key partitioning the messages from MQTT: their OSC address, so that the
+        messages of an address are sent in order.
+
+        :param item: The (topic, message) tuple.
+        :return: The OSC address, or the topic of the messages without a route.
+        """
+        topic, message = item
+        if isinstance(message, OscPacket):
+            return message[:message.find(b"\0")]
+        route = self.routes.m2o(topic)
+        return topic if route is None else route[0]
+
+    def _m2o_dispatch(self, item):
+        """
+        Handle an MQTT message and send it as an OSC message to the address of its route.
+
+        When the values match the trigger of the address auto reset rule, the reset values are
+        sent after the rule delay, without blocking the dispatch. A new trigger on the same
+        address postpones the pending reset, any other value cancels it.
+
+        :param item: The (topic, message) tuple.
+        """
+        topic, message = item
+        TRACER.log("MQTT->OSC: {%s: %s}", topic, message)
+        if isinstance(message, OscPacket):
+            # Raw OSC packets are forwarded as they are, without routing nor auto reset
+            self.t2u.send_packet_to_clients(message)
+            return
+        route = self.routes.m2o(topic)
+        if route is not None:
+            b_addr, transform = route
+            values = message if isinstance(
+                message, Iterable) else [message]
+            if transform is not None:
+                values = transform(values)
+            rule = self._auto_reset_rule(b_addr)
+            if rule is None:
+                self._send_to_clients(b_addr, values)
+                return
+            _, trigger, reset, delay = rule
+            with self._reset_locks[hash(b_addr) % len(self._reset_locks)]:
+                self._send_to_clients(b_addr, values)
+                if self._is_trigger(values, trigger):
+                    reset_id = next(self._reset_ids)
+                    self._pending_resets[b_addr] = reset_id
+                    self.scheduler.schedule(b_addr, delay, self._reset, b_addr, reset, reset_id)
+                elif self._pending_resets.pop(b_addr, None) is not None:
+                    self.scheduler.cancel(b_addr)
 
 
 if __name__ == "__main__":
@@ -132,7 +471,15 @@ if __name__ == "__main__":
         logging.error("CA certificate file %s does not exist.", crt)
         raise SystemExit("Exiting due to missing CA certificate file.")
 
-    bridge = OSC2MQTTBridge(yaml_config)
+    # docker stop sends SIGTERM: shut down as on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit("Terminated."))
+
+    workers = yaml_config.get("bridge", {}).get("workers", 1)
+    if workers > 1:
+        from workers import BridgeWorkers
+        bridge = BridgeWorkers(yaml_config, workers)
+    else:
+        bridge = OSC2MQTTBridge(yaml_config)
 
     try:
         bridge.start()
@@ -0,0 +1,376 @@
+"""
+This module provides the fan-out of OSC messages to the connected OSC clients: each message is
+encoded once and sent to every interested endpoint from a single shared UDP socket.
+
+A client receives every message, unless it subscribed to OSC address patterns, from the
+configuration of its IP address or with a registration message: it then only receives the
+messages matching one of its patterns. The messages of the bridge itself, under /osc2mqtt/, like
+the canary probes, only go to the clients which subscribed to them.
+
+The messages can also be aggregated over a short time window into one OSC bundle per endpoint,
+capped to the MTU, so that a burst of messages like a scene recall takes a few datagrams.
+"""
+import logging
+import socket
+import struct
+import threading
+import time
+from oscpy.parser import TIME_TAG, format_message, time_to_timetag
+from metrics import METRICS
+from osc_pattern import PatternIndex, split_pattern
+
+BUNDLE_TAG = b"#bundle\0"
+IMMEDIATELY = TIME_TAG.pack(0, 1)
+BUNDLE_HEADER_SIZE = len(BUNDLE_TAG) + TIME_TAG.size
+SIZE = struct.Struct(">i")
+# Addresses of the messages of the bridge itself
+RESERVED_PREFIX = "/osc2mqtt/"
+
+BUNDLES_SENT = METRICS.counter("osc2mqtt_osc_bundles_sent_total",
+                               "OSC bundles aggregating messages sent to the OSC clients")
+BUNDLED_MESSAGES = METRICS.counter("osc2mqtt_osc_bundled_messages_total",
+                                   "OSC messages sent to the OSC clients in aggregated bundles")
+
+
+class OscClientRegistry:
+    """
+    A thread safe registry of the UDP endpoints of the connected OSC clients.
+
+    An endpoint is registered once per connection using it, and stays registered until all of
+    them are gone, its subscriptions with it. Readers iterate over an immutable snapshot, so
+    sending never takes the lock, and the endpoints of each address are cached.
+    """
+
+    MAX_CACHED_ADDRESSES = 4096
+
+    def __init__(self, on_change=None, subscriptions=None, encoding='utf-8'):
+        """
+        Initialize an empty OscClientRegistry.
+
+        :param on_change: A function called after each change with "add" or "remove" and the
+            endpoint, or with "subscribe" or "unsubscribe", the endpoint and the patterns, or None.
+        :param subscriptions: The OSC address patterns each client receives, by IP address, or
+            None for all the clients to receive everything.
+        :param encoding: The encoding of the OSC addresses.
+        """
+        self._lock = threading.Lock()
+        self._counts = {}
+        self.endpoints = ()
+        self.on_change = on_change
+        self.subscriptions = {host: tuple(patterns)
+                              for host, patterns in (subscriptions or {}).items()}
+        self.encoding = encoding
+        for patterns in self.subscriptions.values():
+            for pattern in patterns:
+                split_pattern(pattern)  # Fail at startup on invalid patterns
+        self._patterns = {}  # Endpoint -> set of its patterns
+        self._index = PatternIndex()
+        self._cache = {}  # Address -> endpoints receiving it
+
+    def add(self, endpoint):
+        """
+        Register an endpoint.
+
+        :param endpoint: The (host, port) tuple of the endpoint.
+        """
+        with self._lock:
+            self._counts[endpoint] = self._counts.get(endpoint, 0) + 1
+            if self._counts[endpoint] == 1 and endpoint[0] in self.subscriptions:
+                self._subscribe(endpoint, self.subscriptions[endpoint[0]])
+            self.endpoints = tuple(self._counts)
+            self._cache = {}
+        if self.on_change is not None:
+            self.on_change("add", endpoint)
+
+    def remove(self, endpoint):
+        """
+        Unregister an endpoint.
+
+        :param endpoint: The (host, port) tuple of the endpoint.
+        """
+        with self._lock:
+            count = self._counts.get(endpoint, 0) - 1
+            if count > 0:
+                self._counts[endpoint] = count
+            else:
+                self._counts.pop(endpoint, None)
+                self._unsubscribe(endpoint, ())
+            self.endpoints = tuple(self._counts)
+            self._cache = {}
+        if self.on_change is not None:
+            self.on_change("remove", endpoint)
+
+    def _subscribe(self, endpoint, patterns):
+        current = self._patterns.setdefault(endpoint, set())
+        for pattern in patterns:
+            if pattern not in current:
+                self._index.add(pattern, endpoint)
+                current.add(pattern)
+        if not current:
+            del self._patterns[endpoint]
+
+    def _unsubscribe(self, endpoint, patterns):
+        current = self._patterns.get(endpoint, set())
+        for pattern in patterns or tuple(current):
+            if pattern in current:
+                self._index.remove(pattern, endpoint)
+                current.discard(pattern)
+        if not current:
+            self._patterns.pop(endpoint, None)
+
+    def subscribe(self, endpoint, patterns):
+        """
+        Subscribe a connected endpoint to OSC address patterns: it then only receives the
+        messages matching one of its patterns.
+
+        :param endpoint: The (host, port) tuple of the endpoint.
+        :param patterns: The OSC address patterns.
+        :raises ValueError: If a pattern is not valid.
+        """
+        for pattern in patterns:
+            split_pattern(pattern)
+        with self._lock:
+            if endpoint not in self._counts:
+                return
+            self._subscribe(endpoint, patterns)
+            self._cache = {}
+        if self.on_change is not None:
+            self.on_change("subscribe", endpoint, *patterns)
+
+    def unsubscribe(self, endpoint, patterns=()):
+        """
+        Unsubscribe an endpoint from OSC address patterns. Once it has no pattern left, it
+        receives every message again.
+
+        :param endpoint: The (host, port) tuple of the endpoint.
+        :param patterns: The OSC address patterns (default is all the patterns).
+        """
+        with self._lock:
+            self._unsubscribe(endpoint, patterns)
+            self._cache = {}
+        if self.on_change is not None:
+            self.on_change("unsubscribe", endpoint, *patterns)
+
+    def endpoints_for(self, address):
+        """
+        Get the endpoints receiving the messages of an OSC address.
+
+        :param address: The OSC address, as bytes.
+        :return: The tuple of endpoints.
+        """
+        try:
+            return self._cache[address]
+        except KeyError:
+            pass
+        name = address.decode(self.encoding, errors="replace") \
+            if isinstance(address, bytes) else address
+        with self._lock:
+            if name.startswith(RESERVED_PREFIX):
+                matched = self._index.match(name) if self._patterns else ()
+                endpoints = tuple(endpoint for endpoint in self.endpoints if endpoint in matched)
+            elif not self._patterns:
+                endpoints = self.endpoints
+            else:
+                matched = self._index.match(name)
+                endpoints = tuple(endpoint for endpoint in self.endpoints
+                                  if endpoint not in self._patterns or endpoint in matched)
+            if len(self._cache) >= self.MAX_CACHED_ADDRESSES:
+                self._cache = {}
+            self._cache[address] = endpoints
+        return endpoints
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def __iter__(self):
+        return iter(self.endpoints)
+
+    def __contains__(self, endpoint):
+        return endpoint in self.endpoints
+
+
+class OscFanout:
+    """
+    Sends OSC messages to all the endpoints of an OscClientRegistry.
+
+    With a window, the messages sent to an endpoint are aggregated into a bundle, sent by a
+    dedicated thread once the window elapses, or as soon as the next message would make it
+    bigger than max_bundle_size. Other packets, like bundles, are sent after the pending bundles
+    of their endpoints, keeping the order of the messages.
+    """
+
+    def __init__(self, registry: OscClientRegistry, encoding='', window=0,
+                 max_bundle_size=1400, latency=0):
+        """
+        Initialize the OscFanout.
+
+        :param registry: The registry of the endpoints to send to.
+        :param encoding: The encoding of the str values, if any (default is to only accept bytes).
+        :param window: The time the messages are aggregated for in seconds, or 0 to send each
+            message on its own (default is 0).
+        :param max_bundle_size: The maximum size of the bundles in bytes (default is 1400, to
+            fit in an Ethernet frame).
+        :param latency: The delay after the end of the window the bundles are timetagged to be
+            applied at in seconds, so that the bundles of a window are applied at once, or 0 for
+            the bundles to be applied immediately (default is 0).
+        """
+        self.registry = registry
+        self.encoding = encoding
+        self.window = window
+        self.max_bundle_size = max_bundle_size
+        self.latency = latency
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.alive = False
+        self._condition = threading.Condition()
+        self._pending = {}  # Endpoint -> bundle being aggregated
+        self._deadline = None  # Time the pending bundles are due
+        self._timetag = IMMEDIATELY  # Timetag of the pending bundles
+        self._thread = None
+
+    def start(self):
+        """
+        Start the thread sending the aggregated bundles, if any.
+        """
+        if not self.window:
+            return
+        self.alive = True
+        self._thread = threading.Thread(target=self._run, name="osc_bundles")
+        self._thread.start()
+
+    def stop(self):
+        """
+        Send the pending bundles and stop the thread sending them.
+        """
+        with self._condition:
+            self.alive = False
+            self._flush()
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def send_message(self, address, values):
+        """
+        Encode an OSC message once and send it to the endpoints receiving its address.
+
+        :param address: The OSC address, as bytes.
+        :param values: The OSC values.
+        """
+        endpoints = self.registry.endpoints_for(address)
+        if not endpoints:
+            return
+        packet, _ = format_message(address, values, encoding=self.encoding)
+        self.send_packet(packet, endpoints)
+
+    def send_packet(self, packet, endpoints=None):
+        """
+        Send an encoded OSC packet to endpoints.
+
+        :param packet: The OSC packet.
+        :param endpoints: The endpoints to send to (default is the endpoints receiving the
+            address of the message, or all the registered endpoints for a bundle).
+        """
+        if endpoints is None:
+            if packet[:1] == b"/":
+                endpoints = self.registry.endpoints_for(bytes(packet[:packet.index(b"\0")]))
+            else:
+                endpoints = self.registry.endpoints
+        if self.alive:
+            with self._condition:
+                if packet[:1] == b"/":
+                    self._aggregate(packet, endpoints)
+                    return
+                self._flush(endpoints)
+        self._send(packet, endpoints)
+
+    def _aggregate(self, packet, endpoints):
+        """
+        Add a message to the bundles of endpoints, with the condition held.
+
+        :param packet: The OSC message.
+        :param endpoints: The endpoints to send to.
+        """
+        if self._deadline is None:
+            self._deadline = time.monotonic() + self.window
+            if self.latency:
+                self._timetag = TIME_TAG.pack(
+                    *time_to_timetag(time.time() + self.window + self.latency))
+            self._condition.notify()
+        element = SIZE.pack(len(packet)) + packet
+        for endpoint in endpoints:
+            bundle = self._pending.get(endpoint)
+            if bundle is not None and len(bundle) + len(element) > self.max_bundle_size:
+                self._send_bundle(self._pending.pop(endpoint), endpoint)
+                bundle = None
+            if bundle is None:
+                bundle = self._pending[endpoint] = bytearray(BUNDLE_TAG + self._timetag)
+            bundle += element
+
+    def _send_bundle(self, bundle, endpoint):
+        """
+        Send an aggregated bundle, or its message alone if it is the only one and does not need
+        a timetag.
+
+        :param bundle: The bundle.
+        :param endpoint: The endpoint to send to.
+        """
+        size = SIZE.unpack_from(bundle, BUNDLE_HEADER_SIZE)[0]
+        if BUNDLE_HEADER_SIZE + SIZE.size + size == len(bundle):
+            BUNDLED_MESSAGES.inc()
+            if not self.latency:
+                self._send(memoryview(bundle)[BUNDLE_HEADER_SIZE + SIZE.size:], (endpoint,))
+                return
+        else:
+            count, offset = 0, BUNDLE_HEADER_SIZE
+            while offset < len(bundle):
+                offset += SIZE.size + SIZE.unpack_from(bundle, offset)[0]
+                count += 1
+            BUNDLED_MESSAGES.inc(count)
+        BUNDLES_SENT.inc()
+        self._send(bundle, (endpoint,))
+
+    def _flush(self, endpoints=None):
+        """
+        Send the pending bundles, with the condition held.
+
+        :param endpoints: The endpoints whose bundles are sent (default is all of them).
+        """
+        if not self._pending:
+            return
+        for endpoint in tuple(self._pending) if endpoints is None else endpoints:
+            bundle = self._pending.pop(endpoint, None)
+            if bundle is not None:
+                self._send_bundle(bundle, endpoint)
+        if not self._pending:
+            self._deadline = None
+            self._timetag = IMMEDIATELY
+
+    def _run(self):
+        """
+        Send the pending bundles at the end of each window.
+        """
+        with self._condition:
+            while self.alive:
+                if self._deadline is None:
+                    self._condition.wait()
+                    continue
+                timeout = self._deadline - time.monotonic()
+                if timeout > 0:
+                    self._condition.wait(timeout)
+                    continue
+                self._flush()
+        logging.info("Thread osc_bundles stopped.")
+
+    def _send(self, packet, endpoints):
+        """
+        Send a packet to endpoints.
+
+        :param packet: The packet.
+        :param endpoints: The endpoints.
+        """
+        sendto = self.sock.sendto
+        for endpoint in endpoints:
+            try:
+                sendto(packet, endpoint)
+            except OSError as e:
+                logging.debug("Failed to send OSC packet to %s: %s", endpoint, e)
@@ -0,0 +1,224 @@
+"""
+This module provides incremental decoders splitting an OSC TCP stream into OSC packets.
+
+OSC 1.1 frames packets with SLIP (RFC 1055) END delimiters, OSC 1.0 prefixes each packet with
+its size as a big endian int32. Both decoders receive data into a preallocated buffer, with the
+`get_buffer` / `buffer_updated` pair of `asyncio.BufferedProtocol`, and return the frames as
+memoryviews of that buffer: a frame is only copied when SLIP escapes have to be removed.
+"""
+
+import logging
+import struct
+
+SLIP_END = b'\xc0'
+SLIP_ESC = b'\xdb'
+SLIP_ESC_END = b'\xdb\xdc'
+SLIP_ESC_ESC = b'\xdb\xdd'
+
+SIZE = struct.Struct('>i')
+
+
+def encode_slip(packet):
+    """
+    Frame an OSC packet with SLIP.
+
+    :param packet: The OSC packet.
+    :return: The escaped packet, between two END delimiters.
+    """
+    packet = bytes(packet).replace(SLIP_ESC, SLIP_ESC_ESC).replace(SLIP_END, SLIP_ESC_END)
+    return SLIP_END + packet + SLIP_END
+
+
+def encode_length_prefixed(packet):
+    """
+    Frame an OSC packet with its size.
+
+    :param packet: The OSC packet.
+    :return: The packet, prefixed with its size.
+    """
+    return SIZE.pack(len(packet)) + bytes(packet)
+
+
+class StreamDecoder:
+    """
+    Base class of the stream decoders, managing the receive buffer.
+
+    Data is received with `recv_into(decoder.get_buffer())` and given to `buffer_updated`,
+    which returns the complete frames. The frames are only valid until the next call to
+    `get_buffer`: they must be consumed, or copied, before receiving more data.
+    """
+
+    def __init__(self, max_frame_size=1024*1024, buffer_size=64*1024):
+        """
+        Initialize the decoder.
+
+        :param max_frame_size: The size of the biggest accepted frame.
+        :param buffer_size: The initial size of the receive buffer, grown up to
+            max_frame_size when a frame does not fit.
+        """
+        self.max_frame_size = max_frame_size
+        self._buf = bytearray(min(buffer_size, max_frame_size))
+        self._view = memoryview(self._buf)
+        self._start = 0  # Start of the data not decoded yet
+        self._end = 0  # End of the received data
+
+    def _compact(self):
+        """
+        Move the data not decoded yet to the start of the buffer.
+
+        :return: The number of bytes the data moved by.
+        """
+        shift = self._start
+        if shift:
+            length = self._end - shift
+            self._buf[:length] = self._buf[shift:self._end]
+            self._start, self._end = 0, length
+        return shift
+
+    def _grow(self, size):
+        """
+        Replace the buffer by a bigger one. The previous buffer is left untouched for the
+        frames still referencing it.
+
+        :param size: The new size of the buffer.
+        """
+        buf = bytearray(size)
+        buf[:self._end] = self._buf[:self._end]
+        self._buf = buf
+        self._view = memoryview(buf)
+
+    def get_buffer(self):
+        """
+        Get the free part of the receive buffer.
+
+        :return: A writable memoryview.
+        """
+        raise NotImplementedError
+
+    def buffer_updated(self, nbytes):
+        """
+        Decode the data received in the buffer.
+
+        :param nbytes: The number of bytes written in the buffer.
+        :return: The list of complete frames.
+        """
+        raise NotImplementedError
+
+    def feed(self, data):
+        """
+        Decode data received outside of the buffer. As more data may have to be received
+        in the buffer, the frames are returned as copies.
+
+        :param data: The received data.
+        :return: The list of complete frames, as bytes.
+        """
+        frames = []
+        data = memoryview(data)
+        while data:
+            buf = self.get_buffer()
+            n = min(len(buf), len(data))
+            buf[:n] = data[:n]
+            data = data[n:]
+            frames.extend(bytes(frame) for frame in self.buffer_updated(n))
+        return frames
+
+
+class SlipDecoder(StreamDecoder):
+    """
+    Decoder of SLIP framed OSC packets (OSC 1.1), handling the END and ESC escapes and frames
+    split across reads. Frames bigger than max_frame_size are dropped.
+    """
+
+    def __init__(self, max_frame_size=1024*1024, buffer_size=64*1024):
+        super().__init__(max_frame_size, buffer_size)
+        self._scan = 0  # Where to resume searching END
+        self._skip = False  # Whether the current frame is too big and being dropped
+
+    def get_buffer(self):
+        shift = self._compact()
+        self._scan -= shift
+        if self._end == len(self._buf):
+            # Room for the biggest frame and its END delimiter
+            if len(self._buf) <= self.max_frame_size:
+                self._grow(min(2 * len(self._buf), self.max_frame_size + 1))
+            else:
+                if not self._skip:
+                    logging.warning("Dropping SLIP frame bigger than %d bytes",
+                                    self.max_frame_size)
+                self._skip = True
+                self._start = self._end = self._scan = 0
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        start, end = self._start, self._end + nbytes
+        self._end = end
+        view, find = self._view, self._buf.find
+        i = find(SLIP_END, self._scan, end)
+        if i < 0:
+            self._scan = end
+            return []
+        if self._skip:
+            self._skip = False
+            start = i + 1
+            i = find(SLIP_END, start, end)
+        # Escapes are rare: only look for them in each frame if the received data has some
+        escaped = find(SLIP_ESC, start, end) >= 0
+        frames = []
+        while i >= 0:
+            if i > start:
+                if escaped and find(SLIP_ESC, start, i) >= 0:
+                    # ESC is never a literal byte in a SLIP frame, so both replacements
+                    # are unambiguous
+                    frames.append(bytes(view[start:i]).replace(
+                        SLIP_ESC_END, SLIP_END).replace(SLIP_ESC_ESC, SLIP_ESC))
+                else:
+                    frames.append(view[start:i])
+            start = i + 1
+            i = find(SLIP_END, start, end)
+        self._start = self._scan = start
+        return frames
+
+
+class LengthPrefixDecoder(StreamDecoder):
+    """
+    Decoder of size prefixed OSC packets (OSC 1.0). A frame size bigger than max_frame_size
+    means the stream cannot be decoded anymore and raises a ValueError.
+    """
+
+    def __init__(self, max_frame_size=1024*1024, buffer_size=64*1024):
+        super().__init__(max_frame_size, buffer_size)
+        self._needed = SIZE.size  # Size of the next complete frame, with its prefix
+
+    def get_buffer(self):
+        self._compact()
+        needed = max(self._needed, self._end + 1)
+        if needed > len(self._buf):
+            self._grow(max(needed, min(2 * len(self._buf), self.max_frame_size + SIZE.size)))
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+        frames = []
+        while self._end - self._start >= SIZE.size:
+            size = SIZE.unpack_from(self._buf, self._start)[0]
+            if not 0 <= size <= self.max_frame_size:
+                raise ValueError(f"Invalid OSC frame size {size}")
+            start = self._start + SIZE.size
+            if self._end - start < size:
+                self._needed = SIZE.size + size
+                return frames
+            frames.append(self._view[start:start + size])
+            self._start = start + size
+        self._needed = SIZE.size
+        return frames
+
+
+DECODERS = {
+    "slip": SlipDecoder,
+    "length": LengthPrefixDecoder,
+}
+
+ENCODERS = {
+    "slip": encode_slip,
+    "length": encode_length_prefixed,
+}
@@ -2,14 +2,109 @@
 This module provides a class to handle OSC (Open Sound Control) messages using a Unix socket.
 
 The `OSCServerHandler` class initializes an OSC server that listens for messages on a specified
-Unix socket.
+Unix socket. OSC packets received in the same process can also be decoded directly, without
+going through the socket.
 It buffers incoming OSC messages in a queue and provides methods to start and stop the server.
+The packets received in process are only split into their messages, buffered along with their
+bytes: their values are decoded later, if they are needed at all (see `read_values`). The
+messages of a bundle are buffered together, at the time of its timetag. The messages held until
+then count against the capacity of the buffer.
 """
 
+import itertools
 import logging
 import os
 import queue
+import threading
+import time
+from oscpy.parser import INT, TIME_TAG, format_message, read_message, timetag_to_time
 from oscpy.server import OSCThreadServer
+from metrics import METRICS, stage_histogram
+from recorder import O2M
+from scheduler import DelayedScheduler
+
+DECODE_SECONDS = stage_histogram("osc_decode")
+INVALID_PACKETS = METRICS.counter("osc2mqtt_osc_invalid_packets_total",
+                                  "Dropped invalid OSC packets")
+DELAYED_BUNDLES = METRICS.counter("osc2mqtt_osc_delayed_bundles_total",
+                                  "OSC bundles held until their timetag")
+
+BUNDLE_HEADER = b"#bundle\0"
+
+
+def split_packet(data):
+    """
+    Splits an OSC packet into its messages, without decoding their values. The messages of
+    the bundles nested in a bundle are flattened in order, the timetag of the packet being the
+    latest of its bundles, as a nested bundle is never due before the one containing it.
+
+    Args:
+        data (bytes): The OSC packet, a message or a bundle.
+
+    Returns:
+        tuple: The timetag of the bundle, or None for a message, and the list of the
+            (address, message) tuples of its messages, each message as bytes.
+
+    Raises:
+        ValueError: If the packet is not a valid OSC message or bundle.
+    """
+    if data[:8] != BUNDLE_HEADER:
+        return None, [_split_message(data)]
+    if len(data) < 16:
+        raise ValueError("Truncated OSC bundle")
+    timetag = timetag_to_time(TIME_TAG.unpack_from(data, 8))
+    messages = []
+    offset = 16
+    while offset < len(data):
+        size, = INT.unpack_from(data, offset)
+        offset += INT.size
+        if size <= 0 or size % 4 or offset + size > len(data):
+            raise ValueError(f"Invalid OSC bundle element size {size}")
+        element = data[offset:offset + size]
+        if element[:8] == BUNDLE_HEADER:
+            nested_timetag, nested = split_packet(element)
+            timetag = max(timetag, nested_timetag)
+            messages.extend(nested)
+        else:
+            messages.append(_split_message(element))
+        offset += size
+    return timetag, messages
+
+
+def _split_message(data):
+    """
+    Checks an OSC message and gets its address.
+
+    Args:
+        data (bytes): The OSC message.
+
+    Returns:
+        tuple: The address and the message, as bytes.
+
+    Raises:
+        ValueError: If the data is not an OSC message.
+    """
+    message = bytes(data)
+    end = message.find(b"\0")
+    if not message.startswith(b"/") or end < 0 or len(message) % 4:
+        raise ValueError("Not an OSC message")
+    tags = (end + 4) & ~3
+    if message[tags:tags + 1] != b",":
+        raise ValueError("OSC message without type tags")
+    return message[:end], message
+
+
+def read_values(message):
+    """
+    Decodes the values of an OSC message.
+
+    Args:
+        message (bytes): The OSC message.
+
+    Returns:
+        list: The values.
+    """
+    return read_message(message)[2]
 
 
 class OSCServerHandler:
@@ -17,22 +112,42 @@ class OSCServerHandler:
     A class to handle OSC (Open Sound Control) messages using a Unix socket.
 
     Attributes:
-        unix_socket_path (str): The path to the Unix socket.
-        osc_buffer (queue.Queue): A queue to buffer incoming OSC messages.
+        unix_socket_path (str): The path to the Unix socket, or None to only handle packets
+            given to `handle_packet`.
+        osc_buffer (queue.Queue): A queue to buffer incoming OSC messages, as (address,
+            values, message) tuples: the values are None until decoded from the message, the
+            message is None for the messages received on the Unix socket.
         osc_server (OSCThreadServer): The OSC server instance.
     """
 
-    def __init__(self, unix_socket_path):
+    def __init__(self, unix_socket_path, osc_buffer=None, max_bundle_delay=10, recorder=None):
         """
         Initializes the OSCServerHandler with the given Unix socket path.
 
         Args:
-            unix_socket_path (str): The path to the Unix socket.
+            unix_socket_path (str): The path to the Unix socket, or None to not listen on
+                a Unix socket.
+            osc_buffer (queue.Queue, optional): The queue to buffer incoming OSC messages in.
+                Defaults to an unbounded queue.
+            max_bundle_delay (float, optional): The longest time a bundle is held until its
+                timetag, in seconds, against the clocks of the senders drifting. Defaults to 10.
+            recorder (Recorder, optional): The Recorder capturing the received packets.
+                Defaults to None.
         """
         self.unix_socket_path = unix_socket_path
-        self.osc_buffer = queue.Queue()
+        self.osc_buffer = queue.Queue() if osc_buffer is None else osc_buffer
+        self.max_bundle_delay = max_bundle_delay
+        self.recorder = recorder
         self.osc_server = OSCThreadServer(
             default_handler=self._default_handler)
+        self.bundle_scheduler = DelayedScheduler("osc_bundles_in")
+        self._bundle_ids = itertools.count()
+        self._held = 0  # Messages of the bundles held until their timetag
+        self._held_lock = threading.Lock()
+        self._dropped_bundles = 0
+        METRICS.gauge("osc2mqtt_osc_held_messages",
+                      "Messages of the OSC bundles held until their timetag",
+                      function=lambda: self._held)
 
     def _default_handler(self, address, *values):
         """
@@ -42,12 +157,109 @@ class OSCServerHandler:
             address (str): The OSC address.
             *values: The OSC message values.
         """
-        self.osc_buffer.put((address, values))
+        if self.recorder is not None:
+            # oscpy only gives the decoded message
+            self.recorder.record(O2M, b"", format_message(address, values)[0])
+        self.osc_buffer.put((address, values, None))
+
+    def handle_packet(self, data):
+        """
+        Splits an OSC packet (message or bundle) received in the same process and puts
+        its messages into the buffer. The messages of a bundle timetagged in the future are
+        held until then.
+
+        Args:
+            data (bytes): The OSC packet.
+        """
+        if self.recorder is not None:
+            self.recorder.record(O2M, b"", data)
+        start = time.perf_counter()
+        try:
+            timetag, messages = split_packet(data)
+        except Exception as e:
+            INVALID_PACKETS.inc()
+            logging.warning("Dropped invalid OSC packet: %s", e)
+            return
+        DECODE_SECONDS.observe(time.perf_counter() - start)
+        if timetag is not None and self.bundle_scheduler.alive:
+            delay = timetag - time.time()
+            if delay > 0:
+                if self._hold(messages):
+                    DELAYED_BUNDLES.inc()
+                    self.bundle_scheduler.schedule(next(self._bundle_ids),
+                                                   min(delay, self.max_bundle_delay),
+                                                   self._put_held, messages)
+                    return
+                if getattr(self.osc_buffer, "policy", "block") == "drop_newest":
+                    self._drop(messages)
+                    return
+        self._put_messages(messages)
+
+    def _hold(self, messages):
+        """
+        Counts the messages of a bundle as held until its timetag, if the buffer has room for
+        them along with its queued messages and the other held ones. Otherwise, the bundle is
+        not held, and the overflow policy of the buffer applies to it at once.
+
+        Args:
+            messages (list): The (address, message) tuples of the bundle.
+
+        Returns:
+            bool: True if the messages are held.
+        """
+        maxsize = getattr(self.osc_buffer, "maxsize", 0)
+        with self._held_lock:
+            if maxsize > 0 and self._held + self.osc_buffer.qsize() + len(messages) > maxsize:
+                return False
+            self._held += len(messages)
+            return True
+
+    def _drop(self, messages):
+        """
+        Drops the messages of a bundle the full buffer has no room for, counting them in its
+        dropped items.
+
+        Args:
+            messages (list): The (address, message) tuples of the bundle.
+        """
+        with self.osc_buffer.mutex:
+            self.osc_buffer.dropped += len(messages)
+            self._dropped_bundles += 1
+            dropped = self._dropped_bundles
+        # Log the 1st, 10th, 100th... dropped bundle, like the queue does for its items
+        if str(dropped).strip('0') == '1':
+            logging.warning("Queue %s is full, %d bundles to hold until their timetag dropped "
+                            "so far.", self.osc_buffer.name, dropped)
+
+    def _put_held(self, messages):
+        """
+        Puts the messages of a bundle into the buffer once its timetag is reached.
+
+        Args:
+            messages (list): The (address, message) tuples of the bundle.
+        """
+        with self._held_lock:
+            self._held -= len(messages)
+        self._put_messages(messages)
+
+    def _put_messages(self, messages):
+        """
+        Puts OSC messages into the buffer, as (address, None, message) tuples: their values
+        are not decoded yet.
+
+        Args:
+            messages (list): The (address, message) tuples of the messages.
+        """
+        for address, message in messages:
+            self.osc_buffer.put((address, None, message))
 
     def start(self):
         """
         Starts the OSC server and begins listening for messages on the Unix socket.
         """
+        self.bundle_scheduler.start()
+        if not self.unix_socket_path:
+            return
         if os.path.exists(self.unix_socket_path):
             os.remove(self.unix_socket_path)
         self.osc_server.listen(
@@ -58,5 +270,12 @@ class OSCServerHandler:
         """
         Stops the OSC server.
         """
+        self.bundle_scheduler.stop()
+        self._held = 0  # The held bundles are dropped
+        if not self.unix_socket_path:
+            return
+        # Let the listener thread leave its select before closing the socket it reads from
+        self.osc_server.terminate_server()
+        self.osc_server.join_server()
         self.osc_server.stop()
         logging.info("OSC server stopped.")
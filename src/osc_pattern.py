@@ -0,0 +1,156 @@
+"""
+This module provides the matching of OSC addresses against OSC 1.0 address patterns.
+
+Within a segment of a pattern, "?" matches any character, "*" any sequence of characters,
+"[abc]" or "[a-z]" one of the characters ("[!...]" one character not listed), and "{foo,bar}"
+one of the strings. No wildcard crosses a "/".
+
+The patterns are compiled into a trie of segments: literal segments are looked up in a
+dictionary, only the segments with wildcards are matched with a regular expression, so matching
+an address against many patterns only walks the branches its segments select.
+"""
+import re
+
+
+def compile_segment(segment):
+    """
+    Compile a segment of an OSC address pattern.
+
+    :param segment: The segment.
+    :return: The compiled regular expression, or None if the segment has no wildcard.
+    :raises ValueError: If a "[" or "{" is not closed.
+    """
+    if not any(c in segment for c in "?*[{"):
+        return None
+    regex = []
+    i = 0
+    while i < len(segment):
+        c = segment[i]
+        if c == "?":
+            regex.append(".")
+        elif c == "*":
+            regex.append(".*")
+        elif c == "[":
+            end = segment.find("]", i + 1)
+            if end < 0:
+                raise ValueError(f"Unclosed [ in OSC pattern segment {segment}")
+            chars = segment[i + 1:end]
+            negate = chars.startswith("!")
+            if negate:
+                chars = chars[1:]
+            # Keep the ranges, escape anything else
+            chars = "".join(char if char == "-" else re.escape(char) for char in chars)
+            regex.append(f"[{'^' if negate else ''}{chars}]")
+            i = end
+        elif c == "{":
+            end = segment.find("}", i + 1)
+            if end < 0:
+                raise ValueError(f"Unclosed {{ in OSC pattern segment {segment}")
+            choices = segment[i + 1:end].split(",")
+            regex.append(f"(?:{'|'.join(re.escape(choice) for choice in choices)})")
+            i = end
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    return re.compile("".join(regex), re.DOTALL)
+
+
+def split_pattern(pattern):
+    """
+    Split an OSC address pattern into its compiled segments.
+
+    :param pattern: The OSC address pattern, starting with "/".
+    :return: The list of (segment, regular expression or None) tuples.
+    :raises ValueError: If the pattern is not valid.
+    """
+    if not pattern.startswith("/"):
+        raise ValueError(f"OSC pattern {pattern} does not start with /")
+    return [(segment, compile_segment(segment)) for segment in pattern[1:].split("/")]
+
+
+class _Node:
+    """
+    A node of the pattern trie.
+    """
+
+    __slots__ = ("children", "wildcards", "values")
+
+    def __init__(self):
+        self.children = {}  # Literal segment -> node
+        self.wildcards = {}  # Segment with wildcards -> (regular expression, node)
+        self.values = set()  # Values of the patterns ending at this node
+
+
+class PatternIndex:
+    """
+    An index of OSC address patterns, each associated with values, giving the values of all the
+    patterns matching an address. It is not thread safe.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+
+    def add(self, pattern, value):
+        """
+        Add a pattern.
+
+        :param pattern: The OSC address pattern, starting with "/".
+        :param value: The value associated with the pattern.
+        :raises ValueError: If the pattern is not valid.
+        """
+        node = self._root
+        for segment, regex in split_pattern(pattern):
+            if regex is None:
+                node = node.children.setdefault(segment, _Node())
+            else:
+                node = node.wildcards.setdefault(segment, (regex, _Node()))[1]
+        node.values.add(value)
+
+    def remove(self, pattern, value):
+        """
+        Remove a pattern, pruning the branches left empty.
+
+        :param pattern: The OSC address pattern.
+        :param value: The value associated with the pattern.
+        """
+        path = []
+        node = self._root
+        for segment in pattern[1:].split("/"):
+            if segment in node.children:
+                child, table = node.children[segment], node.children
+            elif segment in node.wildcards:
+                child, table = node.wildcards[segment][1], node.wildcards
+            else:
+                return
+            path.append((table, segment, child))
+            node = child
+        node.values.discard(value)
+        for table, segment, child in reversed(path):
+            if child.values or child.children or child.wildcards:
+                break
+            del table[segment]
+
+    def match(self, address):
+        """
+        Get the values of the patterns matching an address.
+
+        :param address: The OSC address.
+        :return: The set of values.
+        """
+        nodes = [self._root]
+        for segment in address[1:].split("/"):
+            matched = []
+            for node in nodes:
+                child = node.children.get(segment)
+                if child is not None:
+                    matched.append(child)
+                for regex, child in node.wildcards.values():
+                    if regex.fullmatch(segment):
+                        matched.append(child)
+            if not matched:
+                return set()
+            nodes = matched
+        values = set()
+        for node in nodes:
+            values |= node.values
+        return values
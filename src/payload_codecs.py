@@ -0,0 +1,222 @@
+"""
+This module provides the codecs of the MQTT payloads, chosen per topic:
+
+- "json": JSON, with orjson when it is installed, else the standard json module. Blobs are
+  decoded to strings, JSON having no binary type.
+- "msgpack": MessagePack, which keeps blobs as bytes and is smaller on the wire. It needs the
+  msgpack package.
+- "raw": the binary OSC packet itself, forwarded to the OSC clients without being decoded.
+"""
+import json
+
+from paho.mqtt.client import topic_matches_sub
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class OscPacket(bytes):
+    """
+    A binary OSC packet carried unchanged in an MQTT payload.
+    """
+
+
+class BytesEncoder(json.JSONEncoder):
+    """
+    Custom JSON encoder to handle bytes objects.
+    """
+    encoding = 'utf-8'
+
+    def default(self, o):
+        """
+        Override the default method to handle bytes objects.
+        """
+        if isinstance(o, bytes):
+            return o.decode(self.encoding)
+        else:
+            return super().default(o)
+
+
+class JsonCodec:
+    """
+    JSON payloads.
+    """
+
+    name = "json"
+
+    def __init__(self, encoding='utf-8'):
+        """
+        Initialize the JsonCodec.
+
+        :param encoding: The encoding of the payloads and of the blobs.
+        """
+        self.encoding = encoding
+        if orjson is not None and encoding.lower().replace("-", "") == "utf8":
+            # orjson only reads and writes UTF-8
+            self.encode = self._orjson_encode
+            self.decode = orjson.loads
+        else:
+            self.encoder = type("Encoder", (BytesEncoder,), {"encoding": encoding})
+
+    def _default(self, o):
+        if isinstance(o, (bytes, bytearray, memoryview)):
+            return bytes(o).decode(self.encoding)
+        raise TypeError(f"Type is not JSON serializable: {type(o).__name__}")
+
+    def _orjson_encode(self, message):
+        return orjson.dumps(message, default=self._default)
+
+    def encode(self, message):
+        """
+        Encode a message.
+
+        :param message: The message.
+        :return: The payload, as bytes.
+        """
+        return json.dumps(message, cls=self.encoder).encode(self.encoding)
+
+    def decode(self, payload):
+        """
+        Decode a payload.
+
+        :param payload: The payload.
+        :return: The message.
+        """
+        return json.loads(payload.decode(self.encoding))
+
+
+class MsgpackCodec:
+    """
+    MessagePack payloads.
+    """
+
+    name = "msgpack"
+
+    def __init__(self, encoding='utf-8'):
+        """
+        Initialize the MsgpackCodec.
+
+        :param encoding: Unused, MessagePack strings are UTF-8.
+        """
+        if msgpack is None:
+            raise ImportError("The msgpack codec needs the msgpack package")
+
+    def encode(self, message):
+        """
+        Encode a message.
+
+        :param message: The message.
+        :return: The payload, as bytes.
+        """
+        return msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, payload):
+        """
+        Decode a payload.
+
+        :param payload: The payload.
+        :return: The message.
+        """
+        return msgpack.unpackb(payload, raw=False)
+
+
+class RawOscCodec:
+    """
+    Binary OSC packets, published and forwarded unchanged.
+    """
+
+    name = "raw"
+
+    def __init__(self, encoding='utf-8'):
+        """
+        Initialize the RawOscCodec.
+
+        :param encoding: Unused, the packets are not decoded.
+        """
+
+    def encode(self, message):
+        """
+        Encode a message.
+
+        :param message: The OSC packet.
+        :return: The payload, as bytes.
+        """
+        if not isinstance(message, (bytes, bytearray, memoryview)):
+            raise TypeError(f"The raw codec needs an OSC packet, not {type(message).__name__}")
+        return bytes(message)
+
+    def decode(self, payload):
+        """
+        Check that a payload looks like an OSC packet, without decoding it.
+
+        :param payload: The payload.
+        :return: The OscPacket.
+        """
+        if not payload.startswith((b"/", b"#bundle\0")) or len(payload) % 4:
+            raise ValueError("Not an OSC packet")
+        return OscPacket(payload)
+
+
+CODECS = {
+    "json": JsonCodec,
+    "msgpack": MsgpackCodec,
+    "raw": RawOscCodec,
+}
+
+
+class PayloadCodecs:
+    """
+    Chooses the codec of a topic from a list of rules matched against the topic.
+    """
+
+    MAX_CACHED_TOPICS = 65536
+
+    def __init__(self, rules=(), default="json", encoding='utf-8'):
+        """
+        Initialize the PayloadCodecs.
+
+        :param rules: The list of rules, each a dictionary with a "topic" filter (MQTT wildcards
+            allowed) and a "codec" name. The first matching rule applies.
+        :param default: The codec of the topics matching no rule (default is "json").
+        :param encoding: The encoding of the text payloads.
+        """
+        codecs = {}
+
+        def get(name):
+            if name not in CODECS:
+                raise ValueError(f"Unknown payload codec {name}, expected one of {tuple(CODECS)}")
+            if name not in codecs:
+                codecs[name] = CODECS[name](encoding)
+            return codecs[name]
+
+        self.rules = [(rule["topic"], get(rule["codec"])) for rule in rules]
+        self.default = get(default)
+        self._cache = {}
+
+    def resolve(self, topic):
+        """
+        Get the codec of a topic.
+
+        :param topic: The topic.
+        :return: The codec.
+        """
+        try:
+            return self._cache[topic]
+        except KeyError:
+            pass
+        result = self.default
+        for topic_filter, codec in self.rules:
+            if topic_matches_sub(topic_filter, topic):
+                result = codec
+                break
+        if len(self._cache) >= self.MAX_CACHED_TOPICS:
+            self._cache.clear()
+        self._cache[topic] = result
+        return result
@@ -0,0 +1,48 @@
+"""
+This module provides the policy choosing the QoS and retain flag of each published MQTT message.
+"""
+from paho.mqtt.client import topic_matches_sub
+
+
+class PublishPolicy:
+    """
+    Chooses the QoS and retain flag of a topic from a list of rules matched against the topic,
+    for example QoS 0 for continuous faders and QoS 2 for discrete cues.
+    """
+
+    MAX_CACHED_TOPICS = 65536
+
+    def __init__(self, rules=(), qos=2, retain=False):
+        """
+        Initialize the PublishPolicy.
+
+        :param rules: The list of rules, each a dictionary with a "topic" filter (MQTT wildcards
+            allowed) and optional "qos" and "retain" values. The first matching rule applies.
+        :param qos: The QoS of the topics matching no rule (default is 2).
+        :param retain: The retain flag of the topics matching no rule (default is False).
+        """
+        self.rules = [(rule["topic"], rule.get("qos", qos), rule.get("retain", retain))
+                      for rule in rules]
+        self.default = (qos, retain)
+        self._cache = {}
+
+    def resolve(self, topic):
+        """
+        Get the QoS and retain flag to publish a topic with.
+
+        :param topic: The topic.
+        :return: A (qos, retain) tuple.
+        """
+        try:
+            return self._cache[topic]
+        except KeyError:
+            pass
+        result = self.default
+        for topic_filter, qos, retain in self.rules:
+            if topic_matches_sub(topic_filter, topic):
+                result = (qos, retain)
+                break
+        if len(self._cache) >= self.MAX_CACHED_TOPICS:
+            self._cache.clear()
+        self._cache[topic] = result
+        return result
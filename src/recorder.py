@@ -0,0 +1,154 @@
+"""
+This module provides the capture of the traffic crossing the bridge, to reproduce incidents and
+to replay it for load tests (see bench/replay.py).
+
+The messages are recorded as they entered the bridge: the OSC packets received from the OSC
+clients, and the topics and payloads received from MQTT. Recording is a copy into a buffered
+file, without any encoding. The capture is a directory of segment files, rotated by size, the
+oldest deleted beyond max_segments. Each segment starts with a magic string, followed by the
+records: a binary header (time, direction, key and data sizes), the key (the MQTT topic, empty
+for OSC) and the data (the OSC packet or the MQTT payload). Segments are read back through mmap.
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+MAGIC = b"OSC2MQTTREC1"
+# Time of the message, direction, key size, data size
+RECORD = struct.Struct('>dBHI')
+SEGMENT_SUFFIX = ".rec"
+O2M, M2O = 0, 1  # Directions
+
+CaptureRecord = namedtuple("CaptureRecord", "timestamp direction key data")
+CaptureRecord.__doc__ = """
+A recorded message: its direction is O2M, with the OSC packet as data and an empty key, or M2O,
+with the MQTT topic as key and the payload as data.
+"""
+
+
+def _segments(path):
+    """
+    List the segment files of a capture.
+
+    :param path: The directory of the capture.
+    :return: The sorted list of (sequence number, path) tuples.
+    """
+    try:
+        names = os.listdir(path)
+    except FileNotFoundError:
+        return []
+    return sorted((int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(path, name))
+                  for name in names
+                  if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+
+
+class Recorder:
+    """
+    Records the messages crossing the bridge in a segment-rotated capture. It is thread safe.
+    """
+
+    def __init__(self, path, segment_size=64*1024*1024, max_segments=16, flush_interval=1.0):
+        """
+        Initialize the Recorder, starting a new segment after those of previous runs.
+
+        :param path: The directory of the segment files, created if needed.
+        :param segment_size: The size the segments are rotated at (default is 64 MiB).
+        :param max_segments: The number of segments kept, the oldest being deleted, or 0 to keep
+            all of them (default is 16).
+        :param flush_interval: The maximum time the records stay in memory before being
+            written to the file, in seconds (default is 1).
+        """
+        self.path = path
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.flush_interval = flush_interval
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._size = 0
+        self._next_flush = 0
+        os.makedirs(path, exist_ok=True)
+        segments = _segments(path)
+        self._seq = segments[-1][0] + 1 if segments else 0
+        self._rotate()
+
+    def _rotate(self):
+        """
+        Close the segment being written and start a new one, deleting the oldest segments.
+        """
+        if self._file is not None:
+            self._file.close()
+        segment_path = os.path.join(self.path, f"{self._seq:012d}{SEGMENT_SUFFIX}")
+        self._seq += 1
+        self._file = open(segment_path, "wb", buffering=1024*1024)
+        self._file.write(MAGIC)
+        self._size = len(MAGIC)
+        if self.max_segments:
+            for _, old_path in _segments(self.path)[:-self.max_segments]:
+                try:
+                    os.remove(old_path)
+                except OSError as e:
+                    logging.error("Failed to delete capture segment %s: %s", old_path, e)
+
+    def record(self, direction, key, data):
+        """
+        Record a message.
+
+        :param direction: O2M or M2O.
+        :param key: The MQTT topic as bytes, or b"" for an OSC packet.
+        :param data: The OSC packet or MQTT payload.
+        """
+        now = time.time()
+        record = RECORD.pack(now, direction, len(key), len(data)) + key + data
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(record)
+            self._size += len(record)
+            self.recorded += 1
+            if self._size >= self.segment_size:
+                self._rotate()
+            elif now >= self._next_flush:
+                self._file.flush()
+                self._next_flush = now + self.flush_interval
+
+    def close(self):
+        """
+        Write the buffered records and close the segment.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        logging.info("Recorded %d messages to %s", self.recorded, self.path)
+
+
+def read_capture(path):
+    """
+    Read the records of a capture, in order. A record cut by a crash ends its segment.
+
+    :param path: The directory of the capture.
+    :return: An iterator of CaptureRecord.
+    """
+    for _, segment_path in _segments(path):
+        with open(segment_path, "rb") as file:
+            if os.fstat(file.fileno()).st_size <= len(MAGIC):
+                continue
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data[:len(MAGIC)] != MAGIC:
+                    logging.warning("Skipping %s, which is not a capture segment", segment_path)
+                    continue
+                offset, size = len(MAGIC), len(data)
+                while offset + RECORD.size <= size:
+                    timestamp, direction, key_size, data_size = RECORD.unpack_from(data, offset)
+                    start = offset + RECORD.size
+                    offset = start + key_size + data_size
+                    if offset > size:
+                        logging.warning("Truncated record at the end of %s", segment_path)
+                        break
+                    yield CaptureRecord(timestamp, direction, data[start:start + key_size],
+                                        data[start + key_size:offset])
@@ -0,0 +1,251 @@
+"""
+This module provides the routing table translating OSC addresses to MQTT topics and back.
+
+Routes map an OSC address prefix to an MQTT topic prefix, in one direction. They are compiled at
+startup into a trie of path segments, so finding the route of an address only walks its
+segments, and the translations are cached in an LRU cache.
+"""
+import functools
+
+from paho.mqtt.client import topic_matches_sub
+
+WILDCARDS = ("*", "+")
+
+
+class Transform:
+    """
+    A transform of the values of a routed message: invert (1 - value), scale, offset, then
+    cast to a type. Only int, float and bool values are transformed, others are left untouched.
+    """
+
+    TYPES = {"int": int, "float": float, "bool": bool, "str": str}
+
+    def __init__(self, scale=1, offset=0, invert=False, type=None):
+        """
+        Initialize the Transform.
+
+        :param scale: The factor applied to the values (default is 1).
+        :param offset: The offset added to the values (default is 0).
+        :param invert: Whether to replace the values by 1 - value (default is False).
+        :param type: The name of the type to cast the values to: "int", "float", "bool" or
+            "str" (default is to keep the type).
+        """
+        if type is not None and type not in self.TYPES:
+            raise ValueError(f"Unknown transform type {type}, expected one of {tuple(self.TYPES)}")
+        self.scale = scale
+        self.offset = offset
+        self.invert = invert
+        self.cast = self.TYPES.get(type)
+
+    def __call__(self, values):
+        """
+        Transform values.
+
+        :param values: The values.
+        :return: The list of transformed values.
+        """
+        result = []
+        for value in values:
+            if isinstance(value, (int, float)):
+                if self.invert:
+                    value = 1 - value
+                value = value * self.scale + self.offset
+                if self.cast is not None:
+                    value = self.cast(value)
+            result.append(value)
+        return result
+
+
+class Route:
+    """
+    A route from a source prefix to a target prefix.
+    """
+
+    __slots__ = ("source", "target", "target_wildcards", "enabled", "transform")
+
+    def __init__(self, source, target, enabled=True, transform=None):
+        """
+        Initialize the Route.
+
+        :param source: The source prefix, as a list of segments. A "*" or "+" segment matches
+            any segment.
+        :param target: The target prefix, as a list of segments. Its "*" or "+" segments are
+            replaced, in order, by the segments matched by the wildcards of the source.
+        :param enabled: Whether the messages of the route are forwarded (default is True).
+        :param transform: The Transform of the values, or None.
+        """
+        self.source = source
+        self.target = target
+        self.target_wildcards = [i for i, segment in enumerate(target) if segment in WILDCARDS]
+        self.enabled = enabled
+        self.transform = transform
+
+    def translate(self, captured, rest):
+        """
+        Build the target of a routed message.
+
+        :param captured: The segments matched by the wildcards of the source.
+        :param rest: The segments following the source prefix.
+        :return: The list of segments of the target.
+        """
+        target = self.target
+        if self.target_wildcards:
+            target = list(target)
+            for i, segment in zip(self.target_wildcards, captured):
+                target[i] = segment
+        return target + rest
+
+
+class _Node:
+    """
+    A node of the routing trie.
+    """
+
+    __slots__ = ("children", "wildcard", "route")
+
+    def __init__(self):
+        self.children = {}
+        self.wildcard = None
+        self.route = None
+
+
+class RoutingTable:
+    """
+    Translates OSC addresses to MQTT topics (o2m) and MQTT topics to OSC addresses (m2o), with
+    the longest matching route prefix.
+    """
+
+    def __init__(self, routes, encoding='utf-8', cache_size=4096):
+        """
+        Initialize the RoutingTable.
+
+        :param routes: The list of routes, each a dictionary with an "osc" address prefix, an
+            "mqtt" topic prefix, a "direction" ("o2m" or "m2o"), and optional "enabled" flag and
+            "transform" parameters (see Transform).
+        :param encoding: The encoding of the OSC addresses.
+        :param cache_size: The number of translations to cache per direction.
+        """
+        self.encoding = encoding
+        self._tries = {"o2m": _Node(), "m2o": _Node()}
+        filters = []  # MQTT topic filters of the m2o routes
+        for config in routes:
+            direction = config["direction"]
+            if direction not in self._tries:
+                raise ValueError(f"Unknown route direction {direction}, expected o2m or m2o")
+            osc, mqtt = _split(config["osc"]), _split(config["mqtt"])
+            transform = config.get("transform")
+            route = Route(osc if direction == "o2m" else mqtt,
+                          mqtt if direction == "o2m" else osc,
+                          config.get("enabled", True),
+                          Transform(**transform) if transform else None)
+            self._insert(self._tries[direction], route)
+            if direction == "m2o" and route.enabled:
+                filters.append("/".join(["+" if s in WILDCARDS else s for s in mqtt] + ["#"]))
+        # A message matching several subscriptions may be delivered once per subscription
+        self.subscriptions = _uncovered(filters)
+        self.o2m = functools.lru_cache(maxsize=cache_size)(self._o2m)
+        self.m2o = functools.lru_cache(maxsize=cache_size)(self._m2o)
+
+    @staticmethod
+    def _insert(trie, route):
+        """
+        Insert a route in a trie.
+
+        :param trie: The root node of the trie.
+        :param route: The Route.
+        """
+        node = trie
+        for segment in route.source:
+            if segment in WILDCARDS:
+                if node.wildcard is None:
+                    node.wildcard = _Node()
+                node = node.wildcard
+            else:
+                node = node.children.setdefault(segment, _Node())
+        node.route = route
+
+    @staticmethod
+    def _lookup(trie, segments):
+        """
+        Find the longest route prefix matching segments, preferring literal segments over
+        wildcards.
+
+        :param trie: The root node of the trie.
+        :param segments: The segments of the address or topic.
+        :return: A (route, captured segments, rest segments) tuple, or None.
+        """
+        best = None
+        stack = [(trie, 0, ())]
+        while stack:
+            node, depth, captured = stack.pop()
+            if node.route is not None and (best is None or depth > best[1]):
+                best = (node.route, depth, captured)
+            if depth == len(segments):
+                continue
+            segment = segments[depth]
+            # The literal child is pushed last, to be explored first
+            if node.wildcard is not None:
+                stack.append((node.wildcard, depth + 1, captured + (segment,)))
+            child = node.children.get(segment)
+            if child is not None:
+                stack.append((child, depth + 1, captured))
+        if best is None:
+            return None
+        route, depth, captured = best
+        return route, list(captured), list(segments[depth:])
+
+    def _o2m(self, address):
+        """
+        Translate an OSC address to an MQTT topic.
+
+        :param address: The OSC address, as bytes.
+        :return: A (topic, transform) tuple, or None if no enabled route matches.
+        """
+        found = self._lookup(self._tries["o2m"],
+                             _split(address.decode(self.encoding, errors="replace")))
+        if found is None or not found[0].enabled:
+            return None
+        route, captured, rest = found
+        return "/".join(route.translate(captured, rest)), route.transform
+
+    def _m2o(self, topic):
+        """
+        Translate an MQTT topic to an OSC address.
+
+        :param topic: The MQTT topic.
+        :return: An (address, transform) tuple, the address as bytes, or None if no enabled
+            route matches.
+        """
+        found = self._lookup(self._tries["m2o"], _split(topic))
+        if found is None or not found[0].enabled:
+            return None
+        route, captured, rest = found
+        segments = route.translate(captured, rest)
+        if not segments:
+            return None
+        return ("/" + "/".join(segments)).encode(self.encoding), route.transform
+
+
+def _uncovered(filters):
+    """
+    Drop the duplicate topic filters, and those covered by a broader one.
+
+    :param filters: The topic filters, each ending with "#".
+    :return: The list of the remaining filters, in order.
+    """
+    filters = list(dict.fromkeys(filters))
+    # As the filters all end with "#", a filter with no more levels than another, matching it
+    # as a topic, matches all the topics it matches
+    return [topic_filter for topic_filter in filters
+            if not any(other != topic_filter and other.count("/") <= topic_filter.count("/")
+                       and topic_matches_sub(other, topic_filter) for other in filters)]
+
+
+def _split(path):
+    """
+    Split an OSC address or MQTT topic into segments.
+
+    :param path: The address or topic.
+    :return: The list of segments, without the leading empty segment of OSC addresses.
+    """
+    return path.strip("/").split("/") if path.strip("/") else []
@@ -0,0 +1,120 @@
+"""
+This module provides a scheduler running delayed actions from a single thread, without blocking
+the threads scheduling them.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class DelayedScheduler:
+    """
+    Runs actions after a delay, in a dedicated thread.
+
+    Each action has a key: scheduling an action replaces the pending action of the same key,
+    which can also be cancelled. Pending actions are kept in a heap ordered by due time.
+    """
+
+    def __init__(self, name="scheduler"):
+        """
+        Initialize the DelayedScheduler.
+
+        :param name: The name of the thread running the actions.
+        """
+        self.name = name
+        self._heap = []
+        self._pending = {}  # Key -> heap entry of the pending action
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self.alive = False
+
+    def schedule(self, key, delay, action, *args):
+        """
+        Schedule an action, replacing the pending action of the same key.
+
+        :param key: The key of the action.
+        :param delay: The delay before running the action, in seconds.
+        :param action: The function to call.
+        :param args: The arguments to pass to the function.
+        """
+        entry = [time.monotonic() + delay, next(self._counter), key, action, args]
+        with self._condition:
+            previous = self._pending.get(key)
+            if previous is not None:
+                previous[3] = None  # Cancelled, dropped when popped from the heap
+            self._pending[key] = entry
+            heapq.heappush(self._heap, entry)
+            if self._heap[0] is entry:
+                self._condition.notify()
+
+    def cancel(self, key):
+        """
+        Cancel the pending action of a key.
+
+        :param key: The key of the action.
+        :return: True if an action was pending.
+        """
+        with self._condition:
+            entry = self._pending.pop(key, None)
+            if entry is None:
+                return False
+            entry[3] = None
+            return True
+
+    def pending(self, key):
+        """
+        Tell whether an action is pending for a key.
+
+        :param key: The key of the action.
+        :return: True if an action is pending.
+        """
+        return key in self._pending
+
+    def start(self):
+        """
+        Start the thread running the actions.
+        """
+        self.alive = True
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the thread, dropping the pending actions.
+        """
+        with self._condition:
+            self.alive = False
+            self._condition.notify()
+        if self._thread:
+            self._thread.join()
+        logging.info("Thread %s stopped.", self.name)
+
+    def _run(self):
+        """
+        Wait for the pending actions to be due and run them.
+        """
+        heap = self._heap
+        while True:
+            with self._condition:
+                while self.alive:
+                    if heap:
+                        timeout = heap[0][0] - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+                    self._condition.wait(timeout)
+                if not self.alive:
+                    return
+                entry = heapq.heappop(heap)
+                _, _, key, action, args = entry
+                if action is None:
+                    continue
+                del self._pending[key]
+            try:
+                action(*args)
+            except Exception as e:
+                logging.exception("Error running delayed action %s: %s", key, e)
@@ -0,0 +1,309 @@
+"""
+This module provides a disk-backed spool keeping the messages which could not be published to
+MQTT while the broker was unreachable, to publish them in order once it is back.
+
+The spool is an append-only log split into segment files, in a directory. Each record is a small
+binary header (time, QoS and retain flag, topic and payload sizes) followed by the topic and the
+already encoded payload. Fully replayed segments are deleted, and whole segments are evicted,
+oldest first, when the spool exceeds its size cap or its messages exceed their maximum age.
+"""
+import logging
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+# Time of the message, QoS | retain << 2, topic size, payload size
+RECORD = struct.Struct('>dBHI')
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE = "cursor"  # Read position saved on close: segment, offset and index
+
+SpoolRecord = namedtuple("SpoolRecord", "timestamp topic payload qos retain cursor")
+SpoolRecord.__doc__ = """
+A spooled message. Its cursor is the position after it, given back to Spool.commit once the
+message is published.
+"""
+
+
+class _Segment:
+    """
+    A segment file of the spool.
+    """
+
+    __slots__ = ("seq", "path", "size", "count", "read_offset", "read_index", "last_time")
+
+    def __init__(self, seq, path):
+        self.seq = seq
+        self.path = path
+        self.size = 0  # Size of the file
+        self.count = 0  # Number of records in the file
+        self.read_offset = 0  # Position of the first record not replayed yet
+        self.read_index = 0  # Index of the first record not replayed yet
+        self.last_time = 0.0  # Time of the newest record
+
+
+class Spool:
+    """
+    An append-only, segmented message spool. It is thread safe: messages are appended by the
+    publishing thread and read back by the replay thread.
+    """
+
+    def __init__(self, path, max_bytes=64*1024*1024, max_age=24*3600, segment_size=1024*1024):
+        """
+        Initialize the Spool, recovering the messages spooled by a previous run.
+
+        :param path: The directory of the segment files, created if needed.
+        :param max_bytes: The size cap of the spool, enforced by evicting the oldest segments
+            (default is 64 MiB).
+        :param max_age: The maximum age of the spooled messages in seconds, older messages are
+            evicted instead of being published (default is 24 hours).
+        :param segment_size: The size of the segment files (default is 1 MiB).
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment_size = min(segment_size, max_bytes)
+        self.dropped = 0  # Messages evicted by the size cap
+        self.expired = 0  # Messages evicted by their age
+        self._lock = threading.Lock()
+        self._segments = []
+        self._writer = None  # File of the last segment, open for appending
+        self._reader = None  # File of the segment being replayed, open for reading
+        self._reader_seq = None
+        self._count = 0
+        self._size = 0
+        os.makedirs(path, exist_ok=True)
+        for name in sorted(os.listdir(path)):
+            if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit():
+                self._recover(int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(path, name))
+        self._load_cursor()
+        if self._count:
+            logging.info("Recovered %d spooled messages from %s", self._count, path)
+
+    def __len__(self):
+        """
+        Get the number of messages waiting in the spool.
+        """
+        return self._count
+
+    @property
+    def size(self):
+        """
+        Get the size of the spool in bytes.
+        """
+        return self._size
+
+    def _recover(self, seq, path):
+        """
+        Load a segment left by a previous run, truncating a record cut by a crash.
+
+        :param seq: The sequence number of the segment.
+        :param path: The path of the segment file.
+        """
+        with open(path, "rb") as file:
+            data = file.read()
+        segment = _Segment(seq, path)
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            timestamp, _, topic_size, payload_size = RECORD.unpack_from(data, offset)
+            end = offset + RECORD.size + topic_size + payload_size
+            if end > len(data):
+                break
+            segment.count += 1
+            segment.last_time = timestamp
+            offset = end
+        if offset < len(data):
+            logging.warning("Truncating %d bytes of incomplete spool record in %s",
+                            len(data) - offset, path)
+            os.truncate(path, offset)
+        if not segment.count:
+            os.remove(path)
+            return
+        segment.size = offset
+        self._segments.append(segment)
+        self._count += segment.count
+        self._size += segment.size
+
+    def _load_cursor(self):
+        """
+        Skip the messages already replayed by a previous run.
+        """
+        cursor_path = os.path.join(self.path, CURSOR_FILE)
+        try:
+            with open(cursor_path, encoding="utf-8") as file:
+                seq, offset, index = (int(value) for value in file.read().split())
+        except (OSError, ValueError):
+            return
+        os.remove(cursor_path)
+        if self._segments and self._segments[0].seq == seq and offset <= self._segments[0].size:
+            self._commit((seq, offset, index, 0))
+
+    def _new_segment(self):
+        """
+        Close the segment being written and start a new one.
+        """
+        if self._writer is not None:
+            self._writer.close()
+        seq = self._segments[-1].seq + 1 if self._segments else 0
+        segment = _Segment(seq, os.path.join(self.path, f"{seq:012d}{SEGMENT_SUFFIX}"))
+        self._writer = open(segment.path, "ab")
+        self._segments.append(segment)
+        return segment
+
+    def _remove_first(self):
+        """
+        Delete the oldest segment.
+
+        :return: The number of its messages which were not replayed.
+        """
+        segment = self._segments.pop(0)
+        if not self._segments and self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._reader_seq == segment.seq:
+            self._reader.close()
+            self._reader = self._reader_seq = None
+        try:
+            os.remove(segment.path)
+        except OSError as e:
+            logging.error("Failed to delete spool segment %s: %s", segment.path, e)
+        remaining = segment.count - segment.read_index
+        self._count -= remaining
+        self._size -= segment.size
+        return remaining
+
+    def _evict(self, now):
+        """
+        Evict the oldest segments exceeding the size cap or the maximum age.
+
+        :param now: The current time.
+        """
+        while self._segments and self._segments[0].last_time < now - self.max_age:
+            self.expired += self._remove_first()
+        while self._size > self.max_bytes and len(self._segments) > 1:
+            dropped = self._remove_first()
+            if not self.dropped:
+                logging.warning("Spool %s is full, dropping its oldest messages", self.path)
+            self.dropped += dropped
+
+    def append(self, topic, payload, qos=0, retain=False):
+        """
+        Append a message to the spool.
+
+        :param topic: The topic of the message.
+        :param payload: The encoded payload of the message.
+        :param qos: The QoS of the message.
+        :param retain: The retain flag of the message.
+        """
+        b_topic = topic.encode("utf-8")
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        now = time.time()
+        record = RECORD.pack(now, qos | retain << 2, len(b_topic), len(payload)) + b_topic + payload
+        with self._lock:
+            if self._writer is None or self._segments[-1].size >= self.segment_size:
+                self._new_segment()
+            segment = self._segments[-1]
+            self._writer.write(record)
+            # Flushed at each message, to lose nothing but the OS buffers on a crash
+            self._writer.flush()
+            segment.size += len(record)
+            segment.count += 1
+            segment.last_time = now
+            self._count += 1
+            self._size += len(record)
+            self._evict(now)
+
+    def _open_reader(self, segment):
+        """
+        Get the file of a segment open for reading, kept open while the segment is replayed.
+
+        :param segment: The _Segment.
+        :return: The file.
+        """
+        if self._reader_seq != segment.seq:
+            if self._reader is not None:
+                self._reader.close()
+            self._reader = open(segment.path, "rb")
+            self._reader_seq = segment.seq
+        return self._reader
+
+    def read(self, max_count):
+        """
+        Read the oldest messages, without removing them from the spool. Messages older than
+        max_age are skipped.
+
+        :param max_count: The maximum number of messages to read.
+        :return: The list of SpoolRecord.
+        """
+        records = []
+        with self._lock:
+            now = time.time()
+            self._evict(now)
+            expired = 0
+            for segment in list(self._segments):
+                if len(records) >= max_count:
+                    break
+                # Only the records returned are read, from the position of the last commit
+                file = self._open_reader(segment)
+                file.seek(segment.read_offset)
+                offset, index = segment.read_offset, segment.read_index
+                while offset < segment.size and len(records) < max_count:
+                    timestamp, flags, topic_size, payload_size = RECORD.unpack(
+                        file.read(RECORD.size))
+                    data = file.read(topic_size + payload_size)
+                    offset += RECORD.size + topic_size + payload_size
+                    index += 1
+                    cursor = (segment.seq, offset, index, expired)
+                    if timestamp < now - self.max_age:
+                        expired += 1
+                        continue
+                    records.append(SpoolRecord(
+                        timestamp, data[:topic_size].decode("utf-8"), data[topic_size:],
+                        flags & 3, bool(flags & 4), cursor))
+                    expired = 0
+            if not records and expired:
+                # Only expired messages were left
+                self._commit(cursor)
+        return records
+
+    def commit(self, record):
+        """
+        Remove the messages up to a record from the spool, once it is published.
+
+        :param record: The SpoolRecord.
+        """
+        with self._lock:
+            self._commit(record.cursor)
+
+    def _commit(self, cursor):
+        seq, offset, index, expired = cursor
+        self.expired += expired
+        while self._segments and self._segments[0].seq < seq:
+            self._remove_first()
+        if not self._segments or self._segments[0].seq != seq:
+            # Evicted while the message was being published
+            return
+        segment = self._segments[0]
+        self._count -= index - segment.read_index
+        segment.read_offset, segment.read_index = offset, index
+        if segment.read_index == segment.count:
+            # Fully replayed, the next message starts a new segment if it was the last one
+            self._remove_first()
+
+    def close(self):
+        """
+        Close the segment being written. The messages left are recovered by the next run.
+        """
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = self._reader_seq = None
+            if self._segments and self._segments[0].read_index:
+                segment = self._segments[0]
+                with open(os.path.join(self.path, CURSOR_FILE), "w", encoding="utf-8") as file:
+                    file.write(f"{segment.seq} {segment.read_offset} {segment.read_index}")
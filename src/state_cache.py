@@ -0,0 +1,171 @@
+"""
+This module provides the last known value of each OSC address, to bring newly connected OSC
+clients up to date and to drop the messages which do not change anything.
+
+Each value is kept as its encoded OSC message, a single bytes object rather than a tuple of
+Python values: it is compact, compared in one operation, and sent to the clients as it is.
+"""
+import fnmatch
+import logging
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+from oscpy.parser import format_message
+
+BUNDLE_HEADER = b"#bundle\0" + struct.pack(">Q", 1)  # Timetag 1 means immediately
+SIZE = struct.Struct(">I")
+
+
+class StateCache:
+    """
+    The last OSC message of each address, seen in either direction of the bridge. The least
+    recently updated addresses are evicted beyond max_addresses. It is thread safe.
+    """
+
+    def __init__(self, max_addresses=65536, path=None, exclude=(), encoding='utf-8'):
+        """
+        Initialize the StateCache, loading the state saved by a previous run, if any.
+
+        :param max_addresses: The maximum number of addresses kept (default is 65536).
+        :param path: The file the state is saved to on stop and loaded from, or None to keep
+            it in memory only.
+        :param exclude: The address patterns (shell wildcards) which are not states but events,
+            like cues: they are neither kept nor suppressed.
+        :param encoding: The encoding of the str values.
+        """
+        self.max_addresses = max_addresses
+        self.path = path
+        self.exclude = tuple(exclude)
+        self.encoding = encoding
+        self.suppressed = 0  # Number of unchanged messages
+        self._lock = threading.Lock()
+        self._messages = OrderedDict()  # Address -> encoded OSC message
+        self._excluded = {}  # Address -> whether it matches an exclude pattern
+        if path:
+            self.load()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def _is_excluded(self, address):
+        try:
+            return self._excluded[address]
+        except KeyError:
+            pass
+        name = address.decode(self.encoding, errors='replace')
+        excluded = any(fnmatch.fnmatchcase(name, pattern) for pattern in self.exclude)
+        if len(self._excluded) >= self.max_addresses:
+            self._excluded.clear()
+        self._excluded[address] = excluded
+        return excluded
+
+    def encode(self, address, values):
+        """
+        Encode an OSC message.
+
+        :param address: The OSC address, as bytes.
+        :param values: The OSC values.
+        :return: The OSC message.
+        """
+        return format_message(address, values, encoding=self.encoding)[0]
+
+    def put(self, address, message):
+        """
+        Record the last message of an address.
+
+        :param address: The OSC address, as bytes.
+        :param message: The encoded OSC message.
+        :return: False if it is the current message of the address, else True.
+        """
+        if self._is_excluded(address):
+            return True
+        messages = self._messages
+        with self._lock:
+            previous = messages.get(address)
+            if previous == message:
+                self.suppressed += 1
+                return False
+            if previous is not None:
+                messages.move_to_end(address)
+            elif len(messages) >= self.max_addresses:
+                messages.popitem(last=False)
+            messages[address] = message
+        return True
+
+    def update(self, address, values):
+        """
+        Record the last values of an address.
+
+        :param address: The OSC address, as bytes.
+        :param values: The OSC values.
+        :return: False if they are the current values of the address, else True.
+        """
+        if self._is_excluded(address):
+            return True
+        return self.put(address, self.encode(address, values))
+
+    def bundles(self, max_size=1400, accept=None):
+        """
+        Pack the current messages into OSC bundles to be executed immediately.
+
+        :param max_size: The maximum size of a bundle in bytes, bigger messages being sent
+            alone (default is 1400, to fit in an Ethernet frame).
+        :param accept: A function telling whether to include the message of an address, or
+            None to include all of them.
+        :return: The list of bundles.
+        """
+        with self._lock:
+            items = list(self._messages.items())
+        messages = [message for address, message in items if accept is None or accept(address)]
+        bundles = []
+        bundle = bytearray(BUNDLE_HEADER)
+        for message in messages:
+            size = SIZE.size + len(message)
+            if len(bundle) + size > max_size and len(bundle) > len(BUNDLE_HEADER):
+                bundles.append(bytes(bundle))
+                bundle = bytearray(BUNDLE_HEADER)
+            bundle += SIZE.pack(len(message))
+            bundle += message
+        if len(bundle) > len(BUNDLE_HEADER):
+            bundles.append(bytes(bundle))
+        return bundles
+
+    def save(self):
+        """
+        Save the state to its file, atomically.
+        """
+        if not self.path:
+            return
+        with self._lock:
+            messages = list(self._messages.values())
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            for message in messages:
+                file.write(SIZE.pack(len(message)))
+                file.write(message)
+        os.replace(tmp_path, self.path)
+        logging.info("Saved the state of %d OSC addresses to %s", len(messages), self.path)
+
+    def load(self):
+        """
+        Load the state saved to its file, if any.
+        """
+        try:
+            with open(self.path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return
+        offset = 0
+        while offset + SIZE.size <= len(data):
+            size = SIZE.unpack_from(data, offset)[0]
+            offset += SIZE.size
+            message = data[offset:offset + size]
+            offset += size
+            end = message.find(b"\0")
+            if len(message) < size or end <= 0:
+                logging.warning("Ignoring the truncated end of the state file %s", self.path)
+                break
+            self.put(message[:end], message)
+        logging.info("Loaded the state of %d OSC addresses from %s", len(self._messages), self.path)
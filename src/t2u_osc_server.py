@@ -1,31 +1,104 @@
+import asyncio
+import collections
+import contextlib
 import socket
 import threading
 import logging
-from oscpy.client import OSCClient
+import time
+from oscpy.parser import read_packet
+from metrics import METRICS, TRACER, stage_histogram
+from osc_fanout import OscClientRegistry, OscFanout
+from osc_framing import DECODERS
+
+TCP_RECEIVED_BYTES = METRICS.counter("osc2mqtt_tcp_received_bytes_total",
+                                     "Bytes received from the OSC TCP clients")
+TCP_FRAMES = METRICS.counter("osc2mqtt_tcp_frames_total",
+                             "OSC packets received from the OSC TCP clients")
+DECODE_SECONDS = stage_histogram("tcp_decode")
+FANOUT_SECONDS = stage_histogram("osc_fanout")
+
+# Messages of the OSC clients to the bridge itself, not forwarded
+CONTROL_PREFIX = b"/osc2mqtt/"
+SUBSCRIBE = b"/osc2mqtt/subscribe"
+UNSUBSCRIBE = b"/osc2mqtt/unsubscribe"
 
 
 class Tcp2UnixOscServer:
     """
-    A TCP to Unix socket server that forwards data from TCP clients to a Unix socket.
+    A TCP to Unix socket server that forwards data from TCP clients to a Unix socket,
+    or directly to a packet handler in the same process.
     It also sends OSC messages to connected OSC clients.
     """
 
-    def __init__(self, net, port, max_connections, unix_socket_path):
+    ENGINES = ("threads", "asyncio")
+
+    def __init__(self, net, port, max_connections, unix_socket_path=None, engine="threads",
+                 direct=False, packet_handler=None, framing="slip", max_frame_size=1024*1024,
+                 client_port=8080, reuse_port=False, subscriptions=None, bundling=None,
+                 encoding=''):
         """
         Initialize the Tcp2UnixOscServer.
 
-        :param tcp_bind_addr: The address to bind the TCP server to.
-        :param tcp_port: The port to bind the TCP server to.
-        :param unix_socket_path: The path to the Unix socket to forward data to.
+        :param net: The address to bind the TCP server to.
+        :param port: The port to bind the TCP server to.
+        :param max_connections: The listen backlog (and, for the "threads" engine,
+            the expected number of concurrent clients).
+        :param unix_socket_path: The path to the Unix socket to forward data to,
+            unused in direct mode.
+        :param engine: "threads" to handle each client in its own thread, or "asyncio"
+            to handle all clients on a single event loop (default is "threads").
+        :param direct: Whether to give the received OSC packets to packet_handler
+            instead of forwarding them to the Unix socket (default is False).
+        :param packet_handler: The function called with each received OSC packet in
+            direct mode.
+        :param framing: "slip" for OSC 1.1 SLIP framing, or "length" for OSC 1.0 size
+            prefixed packets (default is "slip").
+        :param max_frame_size: The size of the biggest accepted OSC packet.
+        :param client_port: The UDP port the OSC messages are sent to on the connected
+            clients (default is 8080).
+        :param reuse_port: Whether to share the TCP port with other processes with
+            SO_REUSEPORT, the kernel balancing the connections between them (default is False).
+        :param subscriptions: The OSC address patterns sent to the clients, by IP address, for
+            the clients which only use part of the address space (default is to send every
+            message to every client).
+        :param bundling: The parameters of the aggregation of the messages sent to the clients
+            into bundles (see OscFanout), or None to send each message on its own.
+        :param encoding: The encoding of the str values of the messages sent to the clients
+            (default is to only accept bytes).
         """
+        if engine not in self.ENGINES:
+            raise ValueError(f"Unknown TCP engine {engine}, expected one of {self.ENGINES}")
+        if framing not in DECODERS:
+            raise ValueError(f"Unknown OSC framing {framing}, expected one of {tuple(DECODERS)}")
+        if direct and packet_handler is None:
+            raise ValueError("Direct mode needs a packet handler")
+        if not direct and not unix_socket_path:
+            raise ValueError("Unix socket mode needs a unix_socket_path")
         self.net = net
         self.port = port
         self.max_connections = max_connections
         self.unix_socket_path = unix_socket_path
+        self.engine = engine
+        self.direct = direct
+        self.packet_handler = packet_handler
+        self.framing = framing
+        self.max_frame_size = max_frame_size
+        self.client_port = client_port
+        self.reuse_port = reuse_port
         self.tcp_server_socket = None
         self.alive = False
         self.threads = []  # List to keep track of threads
-        self.osc_clients = []  # List to keep track of OSC clients
+        # UDP endpoints of the connected clients
+        self.osc_clients = OscClientRegistry(subscriptions=subscriptions)
+        self.fanout = OscFanout(self.osc_clients, encoding, **(bundling or {}))
+        METRICS.gauge("osc2mqtt_osc_clients", "Connected OSC clients",
+                      function=lambda: len(self.osc_clients))
+        self.loop = None  # Event loop of the "asyncio" engine
+        self._loop_stopped = None
+        self.transports = set()  # Transports of the "asyncio" engine clients
+        # Addresses of the loopback connections of the canary, which are not OSC clients: they
+        # are not sent the messages, and all their messages go to the bridge
+        self.probe_addresses = set()
 
     def _listen(self):
         # Create a TCP server socket
@@ -34,6 +107,8 @@ class Tcp2UnixOscServer:
         # Ensure the port is not in TIME_WAIT state
         self.tcp_server_socket.setsockopt(
             socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.tcp_server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.tcp_server_socket.bind((self.net, self.port))
         self.tcp_server_socket.listen(self.max_connections)
 
@@ -48,6 +123,8 @@ class Tcp2UnixOscServer:
         """
         thread = threading.Thread(target=target, args=args)
         thread.start()
+        # Forget about the threads of disconnected clients
+        self.threads = [t for t in self.threads if t.is_alive()]
         self.threads.append(thread)
 
     def start(self):
@@ -55,7 +132,13 @@ class Tcp2UnixOscServer:
         Start the TCP server.
         """
         self.alive = True
-        self._start_thread(self._run_server)
+        if self.engine == "asyncio":
+            # Created before the thread, so that stop can always wake the loop up
+            self._loop_stopped = asyncio.Event()
+            self.loop = asyncio.new_event_loop()
+            self._start_thread(self._run_async_server)
+        else:
+            self._start_thread(self._run_server)
 
     def _run_server(self):
         """
@@ -87,55 +170,279 @@ class Tcp2UnixOscServer:
         :param client_socket: The client socket.
         :param client_address: The client address.
         """
-        with client_socket, socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as unix_client_socket:
+        with client_socket, contextlib.ExitStack() as stack:
             logging.info("Accepted connection from %s", client_address)
-            osc = OSCClient(client_address[0], 8080)
-            self.osc_clients.append(osc)
+            endpoint = None
+            if client_address not in self.probe_addresses:
+                endpoint = (client_address[0], self.client_port)
+                self.osc_clients.add(endpoint)
             try:
-                unix_client_socket.connect(self.unix_socket_path)
-                last_part = b''
+                if self.direct:
+                    send = self.packet_handler
+                else:
+                    unix_client_socket = stack.enter_context(
+                        socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM))
+                    unix_client_socket.connect(self.unix_socket_path)
+                    send = unix_client_socket.sendall
+                decoder = self._new_decoder()
                 while self.alive:
                     client_socket.settimeout(1)
                     try:
-                        data = client_socket.recv(1024*1024)
-                        if not data:
+                        nbytes = client_socket.recv_into(decoder.get_buffer())
+                        if not nbytes:
                             break
-                        data_parts = data.split(b'\xc0')
-                        if data_parts[0]:
-                            unix_client_socket.sendall(
-                                last_part+data_parts[0])
-                            last_part = b''
-                        for part in data_parts[1:-1]:
-                            if part:
-                                print(f"   part:{part}")
-                                unix_client_socket.sendall(part)
-                        if data_parts[:-1]:
-                            print(f"   last_part:{last_part}")
-                            last_part = data_parts[-1]
+                        for frame in self._decode(decoder, nbytes):
+                            if endpoint is not None and \
+                                    frame[:len(CONTROL_PREFIX)] == CONTROL_PREFIX:
+                                self._control(frame, endpoint)
+                            else:
+                                send(frame)
                     except socket.timeout:
                         continue
             except Exception as e:
                 logging.exception("Error handling client: %s", e)
             finally:
-                self.osc_clients.remove(osc)
+                if endpoint is not None:
+                    self.osc_clients.remove(endpoint)
         logging.info("TCP Client %s stopped.", client_address)
 
+    def _control(self, frame, endpoint):
+        """
+        Handle a message of an OSC client to the bridge: "/osc2mqtt/subscribe" followed by OSC
+        address patterns restricts the messages sent to the client to the matching ones,
+        "/osc2mqtt/unsubscribe" followed by patterns, or by nothing for all of them, reverts it.
+
+        :param frame: The OSC message.
+        :param endpoint: The endpoint of the client.
+        """
+        try:
+            (address, _, values, _), = read_packet(bytes(frame))
+            patterns = [value.decode('utf-8') if isinstance(value, bytes) else str(value)
+                        for value in values]
+            if address == SUBSCRIBE:
+                self.osc_clients.subscribe(endpoint, patterns)
+            elif address == UNSUBSCRIBE:
+                self.osc_clients.unsubscribe(endpoint, patterns)
+            else:
+                raise ValueError(f"unknown address {address}")
+        except Exception as e:
+            logging.warning("Ignored control message of %s: %s", endpoint, e)
+            return
+        logging.info("Client %s %s %s", endpoint, address.decode()[len(CONTROL_PREFIX):],
+                     patterns or "everything")
+
+    @staticmethod
+    def _decode(decoder, nbytes):
+        """
+        Decode the data received by a client, recording the metrics of the decoding.
+
+        :param decoder: The StreamDecoder of the client.
+        :param nbytes: The number of bytes received in its buffer.
+        :return: The list of complete frames.
+        """
+        start = time.perf_counter()
+        frames = decoder.buffer_updated(nbytes)
+        DECODE_SECONDS.observe(time.perf_counter() - start)
+        TCP_RECEIVED_BYTES.inc(nbytes)
+        TCP_FRAMES.inc(len(frames))
+        return frames
+
+    def _new_decoder(self):
+        """
+        Create the decoder splitting the TCP stream of a client into OSC packets.
+
+        :return: The StreamDecoder matching the configured framing.
+        """
+        return DECODERS[self.framing](self.max_frame_size)
+
+    class _AsyncOscClientProtocol(asyncio.BufferedProtocol):
+        """
+        Per connection state of the "asyncio" engine. It is dropped by the event loop
+        as soon as the client disconnects.
+        """
+
+        def __init__(self, server, forwarder):
+            """
+            :param server: The Tcp2UnixOscServer owning the connection.
+            :param forwarder: The _AsyncUnixForwarder to forward data to, or None in
+                direct mode.
+            """
+            self.server = server
+            self.forwarder = forwarder
+            self.transport = None
+            self.client_address = None
+            self.endpoint = None
+            self.decoder = server._new_decoder()
+
+        def connection_made(self, transport):
+            self.transport = transport
+            self.client_address = transport.get_extra_info('peername')
+            logging.info("Accepted connection from %s", self.client_address)
+            if self.client_address not in self.server.probe_addresses:
+                self.endpoint = (self.client_address[0], self.server.client_port)
+                self.server.osc_clients.add(self.endpoint)
+            self.server.transports.add(transport)
+
+        def get_buffer(self, sizehint):
+            return self.decoder.get_buffer()
+
+        def buffer_updated(self, nbytes):
+            try:
+                frames = self.server._decode(self.decoder, nbytes)
+                send = self.server.packet_handler if self.forwarder is None else \
+                    self.forwarder.send
+                for frame in frames:
+                    if self.endpoint is not None and \
+                            frame[:len(CONTROL_PREFIX)] == CONTROL_PREFIX:
+                        self.server._control(frame, self.endpoint)
+                    else:
+                        send(frame)
+                if self.forwarder is not None and self.forwarder.pending:
+                    self.forwarder.pause(self.transport)
+            except Exception as e:
+                logging.exception("Error handling client: %s", e)
+                self.transport.close()
+
+        def connection_lost(self, exc):
+            self.server.transports.discard(self.transport)
+            if self.forwarder is not None:
+                self.forwarder.paused.discard(self.transport)
+            if self.endpoint is not None:
+                self.server.osc_clients.remove(self.endpoint)
+            logging.info("TCP Client %s stopped.", self.client_address)
+
+    class _AsyncUnixForwarder:
+        """
+        Non blocking sender to the Unix socket of the "asyncio" engine. When the OSC
+        server is not keeping up, frames are queued in order and the TCP clients stop
+        being read until the queue is flushed.
+        """
+
+        def __init__(self, loop, unix_socket):
+            """
+            :param loop: The event loop.
+            :param unix_socket: The connected, non blocking, Unix socket.
+            """
+            self.loop = loop
+            self.unix_socket = unix_socket
+            self.pending = collections.deque()
+            self.paused = set()
+
+        def send(self, frame):
+            """
+            Send a frame, or queue it if the Unix socket is full.
+
+            :param frame: The frame to send.
+            """
+            if not self.pending:
+                try:
+                    self.unix_socket.send(frame)
+                    return
+                except BlockingIOError:
+                    self.loop.add_writer(self.unix_socket, self._flush)
+            # The frame is a view of the receive buffer, which is about to be reused
+            self.pending.append(bytes(frame))
+
+        def pause(self, transport):
+            """
+            Stop reading a TCP client until the queued frames are sent.
+
+            :param transport: The transport of the client.
+            """
+            transport.pause_reading()
+            self.paused.add(transport)
+
+        def _flush(self):
+            """
+            Send the queued frames, then resume reading the paused TCP clients.
+            """
+            while self.pending:
+                try:
+                    self.unix_socket.send(self.pending[0])
+                except BlockingIOError:
+                    return
+                self.pending.popleft()
+            self.loop.remove_writer(self.unix_socket)
+            for transport in self.paused:
+                if not transport.is_closing():
+                    transport.resume_reading()
+            self.paused.clear()
+
+    def _run_async_server(self):
+        """
+        Run the TCP server with the "asyncio" engine: all clients are handled on a
+        single event loop, without any timeout polling.
+        """
+        try:
+            self.loop.run_until_complete(self._serve_async())
+        except Exception as e:
+            logging.error("Error: %s", e)
+        finally:
+            self.loop.close()
+        logging.info("TCP Server stopped.")
+
+    async def _serve_async(self):
+        """
+        Serve TCP clients until stop is called.
+        """
+        with contextlib.ExitStack() as stack:
+            forwarder = None
+            if not self.direct:
+                unix_socket = stack.enter_context(
+                    socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM))
+                unix_socket.connect(self.unix_socket_path)
+                # A stalled OSC server must not block the whole event loop
+                unix_socket.setblocking(False)
+                forwarder = self._AsyncUnixForwarder(self.loop, unix_socket)
+            server = await self.loop.create_server(
+                lambda: self._AsyncOscClientProtocol(self, forwarder),
+                self.net, self.port, backlog=self.max_connections, reuse_address=True,
+                reuse_port=self.reuse_port or None)
+            logging.info("TCP server listening on %s:%s", self.net, self.port)
+            async with server:
+                await self._loop_stopped.wait()
+                server.close()
+                for transport in list(self.transports):
+                    transport.close()
+                # Let the protocols run their connection_lost callbacks
+                await asyncio.sleep(0)
+                if forwarder is not None:
+                    self.loop.remove_writer(forwarder.unix_socket)
+
     def stop(self):
         """
         Stop the TCP server.
         """
         self.alive = False
+        if self.loop is not None and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self._loop_stopped.set)
+            except RuntimeError:
+                pass  # The loop closed in the meantime
         for thread in self.threads:
             thread.join()
         logging.info("All TCP Server threads stopped.")
 
     def send_to_clients(self, address, values):
         """
-        Send an OSC message to all connected OSC clients.
+        Send an OSC message to all connected OSC clients. The message is encoded once,
+        whatever the number of clients.
 
         :param address: The OSC address.
         :param values: The OSC values.
         """
-        for c in self.osc_clients:
-            logging.info("Send: {%s: %s}", address, values)
-            c.send_message(address, values)
+        TRACER.log("Send: {%s: %s}", address, values)
+        start = time.perf_counter()
+        self.fanout.send_message(address, values)
+        FANOUT_SECONDS.observe(time.perf_counter() - start)
+
+    def send_packet_to_clients(self, packet):
+        """
+        Send an encoded OSC packet to all connected OSC clients.
+
+        :param packet: The OSC packet.
+        """
+        TRACER.log("Send packet: %s", packet)
+        start = time.perf_counter()
+        self.fanout.send_packet(packet)
+        FANOUT_SECONDS.observe(time.perf_counter() - start)
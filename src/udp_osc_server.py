@@ -0,0 +1,137 @@
+"""
+This module provides the UDP ingress of the bridge, for the OSC devices which do not speak
+SLIP over TCP: each datagram is one OSC packet, message or bundle.
+
+Datagrams are received in batches into a pool of buffers allocated once: when the socket becomes
+readable, every datagram waiting in the kernel queue is drained, up to the batch size, before any
+of them is decoded. No buffer is allocated per datagram, and the decoding is not interleaved with
+the system calls which empty the socket queue, so bursts of fader messages are absorbed by the
+kernel buffer rather than dropped.
+"""
+import logging
+import select
+import socket
+import threading
+
+from metrics import METRICS
+
+UDP_RECEIVED_BYTES = METRICS.counter("osc2mqtt_udp_received_bytes_total",
+                                     "Bytes received from the OSC UDP senders")
+UDP_DATAGRAMS = METRICS.counter("osc2mqtt_udp_datagrams_total",
+                                "OSC packets received from the OSC UDP senders")
+UDP_BATCH_SIZE = METRICS.histogram("osc2mqtt_udp_batch_size",
+                                   "Datagrams received per batch from the UDP socket",
+                                   buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+
+class UdpOscServer:
+    """
+    A UDP server giving the received OSC packets to a packet handler, in the same process.
+    """
+
+    def __init__(self, port, packet_handler, net="0.0.0.0", batch_size=64,
+                 max_datagram_size=65507, receive_buffer_size=4*1024*1024, reuse_port=False):
+        """
+        Initialize the UdpOscServer.
+
+        :param port: The port to bind the UDP server to.
+        :param packet_handler: The function called with each received OSC packet, as a
+            memoryview only valid during the call.
+        :param net: The address to bind the UDP server to (default is all interfaces).
+        :param batch_size: The maximum number of datagrams received before decoding them, and
+            the number of buffers of the pool (default is 64).
+        :param max_datagram_size: The size of each buffer, longer datagrams are dropped
+            (default is 65507, the biggest UDP payload).
+        :param receive_buffer_size: The size requested for the kernel receive buffer of the
+            socket, absorbing the bursts (default is 4 MiB).
+        :param reuse_port: Whether to share the UDP port with other processes with
+            SO_REUSEPORT, the kernel balancing the senders between them (default is False).
+        """
+        if batch_size < 1:
+            raise ValueError("The UDP batch size must be at least 1")
+        self.net = net
+        self.port = port
+        self.packet_handler = packet_handler
+        self.batch_size = batch_size
+        self.max_datagram_size = max_datagram_size
+        self.receive_buffer_size = receive_buffer_size
+        self.reuse_port = reuse_port
+        # One more byte than accepted, to detect the truncated datagrams
+        self._views = [memoryview(bytearray(max_datagram_size + 1)) for _ in range(batch_size)]
+        self._sizes = [0] * batch_size
+        self.dropped = 0  # Datagrams longer than max_datagram_size
+        self.sock = None
+        self.alive = False
+        self._thread = None
+
+    def start(self):
+        """
+        Start the UDP server.
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer_size)
+        self.sock.bind((self.net, self.port))
+        self.sock.setblocking(False)
+        self.alive = True
+        self._thread = threading.Thread(target=self._run, name="udp")
+        self._thread.start()
+        logging.info("UDP server listening on %s:%s", self.net, self.port)
+
+    def _receive_batch(self):
+        """
+        Receive the datagrams waiting in the socket queue into the buffers of the pool.
+
+        :return: The number of datagrams received.
+        """
+        recv_into = self.sock.recv_into
+        views, sizes = self._views, self._sizes
+        count = 0
+        while count < self.batch_size:
+            try:
+                sizes[count] = recv_into(views[count])
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionRefusedError:
+                continue  # ICMP error of an earlier send on Linux, not a datagram
+            count += 1
+        return count
+
+    def _run(self):
+        """
+        Receive and decode the datagrams until stop is called.
+        """
+        handler = self.packet_handler
+        views, sizes = self._views, self._sizes
+        max_size = self.max_datagram_size
+        with self.sock:
+            while self.alive:
+                readable, _, _ = select.select((self.sock,), (), (), 1)
+                if not readable:
+                    continue
+                count = self._receive_batch()
+                if not count:
+                    continue
+                UDP_BATCH_SIZE.observe(count)
+                UDP_DATAGRAMS.inc(count)
+                UDP_RECEIVED_BYTES.inc(sum(sizes[:count]))
+                for view, size in zip(views[:count], sizes[:count]):
+                    if size > max_size:
+                        self.dropped += 1
+                        logging.warning("Dropped an OSC datagram longer than %d bytes", max_size)
+                        continue
+                    try:
+                        handler(view[:size])
+                    except Exception as e:
+                        logging.exception("Error handling OSC datagram: %s", e)
+        logging.info("UDP Server stopped.")
+
+    def stop(self):
+        """
+        Stop the UDP server.
+        """
+        self.alive = False
+        if self._thread is not None:
+            self._thread.join()
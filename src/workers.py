@@ -0,0 +1,297 @@
+"""
+This module provides the multi-process mode of the bridge, to use several CPU cores.
+
+N worker processes share the OSC TCP port with SO_REUSEPORT, the kernel balancing the client
+connections between them. Each worker decodes the OSC messages of its clients and publishes them
+to MQTT on its own connection, with a client ID derived from the configured one. The messages of
+a client all go through the same worker, in order.
+
+The main process subscribes to MQTT and sends the messages to the OSC clients of all the
+workers, which report the endpoints of their clients. As a single process receives the MQTT
+messages, they are sent in order, and once to each endpoint. With the state cache, the workers
+also report the messages of their clients which changed the state, so that the state the main
+process sends to new clients includes both directions.
+"""
+import copy
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
+import threading
+import time
+
+from osc2mqtt_bridge import OSC2MQTTBridge
+
+
+def worker_config(config, index):
+    """
+    Derive the configuration of a worker.
+
+    :param config: The configuration of the bridge.
+    :param index: The index of the worker.
+    :return: The configuration, with a distinct MQTT client ID, Unix socket, spool and capture
+        directories, and metrics port.
+    """
+    config = copy.deepcopy(config)
+    connection = config["mqtt"]["connection"]
+    connection["client_id"] = f"{connection['client_id']}-{index}"
+    osc = config["osc"]
+    osc["reuse_port"] = True
+    if osc.get("udp"):
+        osc["udp"]["reuse_port"] = True
+    if osc.get("unix_socket_path"):
+        osc["unix_socket_path"] = f"{osc['unix_socket_path']}.{index}"
+    spool = config["mqtt"].get("spool")
+    if spool:
+        spool["path"] = os.path.join(spool["path"], f"worker-{index}")
+    recorder = config.get("bridge", {}).get("recorder")
+    if recorder:
+        recorder["path"] = os.path.join(recorder["path"], f"worker-{index}")
+    # Only the main process runs the canary
+    config.get("bridge", {}).pop("canary", None)
+    state = config.get("bridge", {}).get("state")
+    if state:
+        # Only the main process, sending to the OSC clients, saves the state
+        state.pop("path", None)
+    metrics = config.get("bridge", {}).get("metrics")
+    if metrics:
+        metrics["port"] = metrics.get("port", 9100) + 1 + index
+    return config
+
+
+def _run_worker(config, index, events, encoding):
+    """
+    Run a worker process until it receives SIGTERM or SIGINT.
+
+    :param config: The configuration of the worker.
+    :param index: The index of the worker.
+    :param events: The connection reporting the endpoints of the clients, and the state
+        changes, to the main process.
+    :param encoding: The encoding of the OSC messages.
+    """
+    logging.basicConfig(level=logging.INFO, force=True,
+                        format=f"%(levelname)s:%(name)s:worker-{index}:%(message)s")
+    stopped = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stopped.set())
+    bridge = OSC2MQTTBridge(config, encoding, directions=("o2m",))
+    lock = threading.Lock()  # The clients are registered from several threads
+
+    def report(event, *args):
+        with lock:
+            events.send((event, *args))
+    bridge.t2u.osc_clients.on_change = report
+    if bridge.state is not None:
+        bridge.on_state_change = lambda changes: report("state", changes)
+    try:
+        bridge.start()
+        while not stopped.wait(0.5):
+            pass
+    except SystemExit as e:
+        logging.error(str(e))
+        failed = True
+    else:
+        failed = False
+    finally:
+        bridge.stop()
+    if failed:
+        # Not a clean stop: the main process counts it as a failure
+        sys.exit(1)
+
+
+class BridgeWorkers:
+    """
+    Runs the bridge in several processes: OSC to MQTT in the workers, MQTT to OSC in the main
+    process.
+
+    The workers are stopped with SIGTERM, and each reports the endpoints of its clients on its
+    own pipe: nothing is shared between the processes, so a worker killed at any time cannot
+    block the others.
+
+    A worker which dies is restarted after a delay, doubled each time it dies again before
+    running for min_uptime seconds, and given up on after max_restarts such failures in a row.
+    """
+
+    def __init__(self, config, workers, encoding='utf-8', restart_min_delay=1,
+                 restart_max_delay=60, min_uptime=30, max_restarts=10):
+        """
+        Initialize the BridgeWorkers.
+
+        :param config: The configuration of the bridge.
+        :param workers: The number of worker processes.
+        :param encoding: Encoding to use for OSC messages.
+        :param restart_min_delay: The delay before restarting a worker which died, in seconds
+            (default is 1).
+        :param restart_max_delay: The maximum delay before restarting a worker, in seconds
+            (default is 60).
+        :param min_uptime: The time a worker must run for its death not to count as a failure
+            in a row, in seconds (default is 30).
+        :param max_restarts: The number of failures in a row after which a worker is not
+            restarted anymore (default is 10).
+        """
+        self.config = config
+        self.workers = workers
+        self.encoding = encoding
+        self.restart_min_delay = restart_min_delay
+        self.restart_max_delay = restart_max_delay
+        self.min_uptime = min_uptime
+        self.max_restarts = max_restarts
+        # Workers are restarted while the threads of the main process run: do not fork them
+        self.context = multiprocessing.get_context("spawn")
+        self.processes = [None] * workers
+        self.connections = [None] * workers  # Endpoint reports of each worker
+        self.endpoints = [{} for _ in range(workers)]  # Endpoint counts of each worker
+        self.started = [0.0] * workers  # Time each worker was started
+        self.failures = [0] * workers  # Failures in a row of each worker
+        # Time each dead worker is restarted at, infinite once given up on, None while running
+        self.restarts = [None] * workers
+        self.bridge = None
+        self.alive = False
+        self._monitor = None
+
+    def _start_worker(self, index):
+        receiver, sender = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=_run_worker, name=f"osc2mqtt-worker-{index}",
+            args=(worker_config(self.config, index), index, sender, self.encoding))
+        process.start()
+        sender.close()
+        self.processes[index] = process
+        self.connections[index] = receiver
+        self.started[index] = time.monotonic()
+        self.restarts[index] = None
+        logging.info("Started worker %d (pid %d)", index, process.pid)
+
+    def start(self):
+        """
+        Start the workers, then the MQTT to OSC bridge of the main process.
+        """
+        self.alive = True
+        self.bridge = OSC2MQTTBridge(self.config, self.encoding, directions=("m2o",))
+        for index in range(self.workers):
+            self._start_worker(index)
+        self._monitor = threading.Thread(target=self._monitor_workers, name="workers")
+        self._monitor.start()
+        self.bridge.start()
+
+    def _forget_endpoints(self, index):
+        """
+        Unregister the endpoints of the clients of a worker.
+
+        :param index: The index of the worker.
+        """
+        registry = self.bridge.t2u.osc_clients
+        for endpoint, count in self.endpoints[index].items():
+            for _ in range(count):
+                registry.remove(endpoint)
+        self.endpoints[index].clear()
+
+    def _on_event(self, index, event, *args):
+        """
+        Register or unregister the endpoint of a client of a worker, or its subscriptions, or
+        record the state changes of a worker.
+
+        :param index: The index of the worker.
+        :param event: "add", "remove", "subscribe" or "unsubscribe", followed by the endpoint of
+            the client and the OSC address patterns of a subscription, or "state" followed by
+            the list of (address, message) tuples which changed the state.
+        :param args: The arguments of the event.
+        """
+        if event == "state":
+            if self.bridge.state is not None:
+                for address, message in args[0]:
+                    self.bridge.state.put(address, message)
+            return
+        endpoint, *patterns = args
+        registry = self.bridge.t2u.osc_clients
+        counts = self.endpoints[index]
+        if event == "subscribe":
+            registry.subscribe(endpoint, patterns)
+        elif event == "unsubscribe":
+            registry.unsubscribe(endpoint, patterns)
+        elif event == "add":
+            counts[endpoint] = counts.get(endpoint, 0) + 1
+            registry.add(endpoint)
+        elif counts.get(endpoint):
+            counts[endpoint] -= 1
+            if not counts[endpoint]:
+                del counts[endpoint]
+            registry.remove(endpoint)
+
+    def _on_worker_exit(self, index):
+        """
+        Schedule the restart of a worker which died, with a delay growing with its failures in
+        a row, or give up on it.
+
+        :param index: The index of the worker.
+        """
+        process = self.processes[index]
+        process.join()
+        self.connections[index].close()
+        self._forget_endpoints(index)
+        now = time.monotonic()
+        if now - self.started[index] >= self.min_uptime:
+            self.failures[index] = 0
+        self.failures[index] += 1
+        if self.failures[index] > self.max_restarts:
+            self.restarts[index] = float("inf")
+            logging.critical("Worker %d exited with code %s after %d failures in a row, "
+                             "not restarting it", index, process.exitcode, self.max_restarts)
+            return
+        delay = min(self.restart_min_delay * 2 ** (self.failures[index] - 1),
+                    self.restart_max_delay)
+        self.restarts[index] = now + delay
+        logging.error("Worker %d exited with code %s, restarting it in %s s",
+                      index, process.exitcode, delay)
+
+    def _monitor_workers(self):
+        """
+        Register the endpoints reported by the workers, and restart the workers which died.
+        """
+        while self.alive:
+            now = time.monotonic()
+            for index, restart in enumerate(self.restarts):
+                if restart is not None and restart <= now:
+                    self._start_worker(index)
+            running = [index for index, restart in enumerate(self.restarts) if restart is None]
+            timeout = min([1] + [restart - now for restart in self.restarts
+                                 if restart is not None and restart > now])
+            ready = multiprocessing.connection.wait(
+                [self.connections[index] for index in running]
+                + [self.processes[index].sentinel for index in running], timeout=timeout)
+            for index in running:
+                connection = self.connections[index]
+                if connection not in ready:
+                    continue
+                try:
+                    while connection.poll():
+                        self._on_event(index, *connection.recv())
+                except (EOFError, OSError):
+                    pass  # The worker exited, handled with its sentinel
+            for index in running:
+                if self.alive and self.processes[index].sentinel in ready:
+                    self._on_worker_exit(index)
+
+    def stop(self):
+        """
+        Stop the workers and the main process bridge.
+        """
+        self.alive = False
+        if self._monitor is not None:
+            self._monitor.join()
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(10)
+            if process.is_alive():
+                logging.warning("Worker %d did not stop, killing it", index)
+                process.kill()
+                process.join()
+            self.connections[index].close()
+        if self.bridge is not None:
+            self.bridge.stop()
@@ -0,0 +1,9 @@
+"""
+The modules of the bridge and of the benchmarks are imported by their bare names, as when they
+are run from src/ and bench/.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "src"), os.path.join(ROOT, "bench")]
@@ -0,0 +1,84 @@
+"""
+Tests of the queues linking the stages of the bridge.
+"""
+import queue
+import time
+
+import pytest
+from bridge_queue import CLOSED, BridgeQueue, get_batch
+
+
+def drain(buffer):
+    items = []
+    while not buffer.empty():
+        items.append(buffer.get_nowait())
+    return items
+
+
+def fill(buffer, *keys):
+    for key in keys:
+        buffer.put((key, 0))
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        BridgeQueue(1, "drop_random")
+
+
+def test_block_policy_waits_for_room():
+    buffer = BridgeQueue(2, "block")
+    fill(buffer, "a", "b")
+    with pytest.raises(queue.Full):
+        buffer.put(("c", 0), timeout=0.05)
+    assert drain(buffer) == [("a", 0), ("b", 0)]
+    assert buffer.dropped == 0
+
+
+@pytest.mark.parametrize("policy, kept", [
+    ("drop_oldest", ["c", "d"]),
+    ("drop_newest", ["a", "b"]),
+])
+def test_drop_policies(policy, kept):
+    buffer = BridgeQueue(2, policy)
+    fill(buffer, "a", "b", "c", "d")
+    assert [key for key, _ in drain(buffer)] == kept
+    assert buffer.dropped == 2
+
+
+def test_coalesce_policy_replaces_the_queued_item_of_the_same_key():
+    buffer = BridgeQueue(3, "coalesce")
+    fill(buffer, "a", "b", "c")
+    buffer.put(("b", 1))  # Replaced in place, keeping its position
+    buffer.put(("d", 0))  # No item of its key: the oldest is dropped
+    assert drain(buffer) == [("b", 1), ("c", 0), ("d", 0)]
+    assert buffer.dropped == 2
+    # The keys of the items taken are forgotten
+    fill(buffer, "b")
+    assert drain(buffer) == [("b", 0)]
+
+
+def test_unbounded_queue_keeps_everything():
+    buffer = BridgeQueue(0, "drop_newest")
+    fill(buffer, *range(1000))
+    assert len(drain(buffer)) == 1000
+
+
+@pytest.mark.parametrize("policy", BridgeQueue.POLICIES)
+def test_closed_marker_comes_last_and_is_never_dropped(policy):
+    buffer = BridgeQueue(2, policy)
+    fill(buffer, "a", "b")
+    buffer.close()  # Queued whatever the capacity
+    # Put after the close, like a late producer: dropped rather than the marker
+    fill(buffer, "b", "c", "d")
+    assert drain(buffer) == [("a", 0), ("b", 0), CLOSED]
+    assert buffer.dropped == 3
+
+
+def test_get_batch():
+    buffer = BridgeQueue()
+    fill(buffer, *range(5))
+    assert len(get_batch(buffer, 3)) == 3
+    assert len(get_batch(buffer, 3)) == 2
+    start = time.monotonic()
+    assert get_batch(buffer, 3, timeout=0.05) == []
+    assert time.monotonic() - start >= 0.05
@@ -0,0 +1,67 @@
+"""
+Tests of the canary of the bridge, against the in-process MiniBroker.
+"""
+import socket
+import time
+
+import pytest
+from bench_bridge import free_port
+from canary import LATENCY, PATHS, Canary
+from metrics import METRICS
+from mini_broker import MiniBroker
+from oscpy.parser import format_message
+from osc2mqtt_bridge import OSC2MQTTBridge
+from payload_codecs import OscPacket
+from replay import bridge_config
+
+
+def counts():
+    return {path: METRICS.histogram(LATENCY, "", path=path).count for path in PATHS}
+
+
+@pytest.mark.parametrize("directions", [("o2m", "m2o"), ("m2o",)])
+def test_probes_make_the_loop(directions):
+    broker = MiniBroker()
+    config = bridge_config(None, broker.start(), free_port(), free_port(socket.SOCK_DGRAM))
+    config["bridge"]["canary"] = {"interval": 0.05, "threshold": 1.0}
+    before = counts()
+    bridge = OSC2MQTTBridge(config, directions=directions)
+    bridge.start()
+    try:
+        deadline = time.monotonic() + 5
+        while counts()["m2o"] - before["m2o"] < 3 and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        bridge.stop()
+        broker.stop()
+    observed = {path: counts()[path] - before[path] for path in PATHS}
+    assert observed["m2o"] >= 3
+    if "o2m" in directions:
+        assert observed["o2m"] >= 3 and observed["round_trip"] >= 3
+    else:
+        assert observed["o2m"] == observed["round_trip"] == 0
+
+
+def test_probe_seq():
+    probe_seq = Canary._probe_seq
+    packet = format_message(Canary.ADDRESS.encode(), [42])[0]
+    assert probe_seq(None, OscPacket(packet)) == 42
+    assert probe_seq(None, [42]) == 42
+    assert probe_seq(None, 42) == 42
+    with pytest.raises(ValueError):
+        probe_seq(None, "canary")
+
+
+def test_lost_probes_are_counted_per_direction():
+    canary = Canary(None, None, "osc/cmnd/osc2mqtt/canary", timeout=0.0)
+    lost = {direction: canary._lost[direction].value for direction in ("o2m", "m2o")}
+    old = time.perf_counter() - 1
+    canary._pending = {1: [old, None], 2: [old, old], 3: [None, old], 4: [None, None]}
+    canary._expire()
+    assert canary._pending == {4: [None, None]}
+    assert canary._lost["o2m"].value - lost["o2m"] == 1
+    assert canary._lost["m2o"].value - lost["m2o"] == 2
+    # The first probe coming back clears the alert of its direction
+    assert ("lost", "m2o") in canary._alerting
+    canary._observe("m2o", 0.001)
+    assert ("lost", "m2o") not in canary._alerting
@@ -0,0 +1,43 @@
+"""
+Tests of the coalescing of high rate OSC addresses.
+"""
+from coalescer import Coalescer
+
+
+def message(address, value):
+    return (address, [value], None)
+
+
+def test_addresses_without_rule_pass_through():
+    coalescer = Coalescer([{"address": "/fader/*", "max_rate": 10}])
+    assert all(coalescer.offer(b"/button/1", message(b"/button/1", i), 0) for i in range(5))
+    assert coalescer.next_due() is None
+
+
+def test_keeps_the_latest_message_per_interval():
+    coalescer = Coalescer([{"address": "/fader/*", "max_rate": 10}])
+    address = b"/fader/1"
+    assert coalescer.offer(address, message(address, 0), 0.0)
+    # Within the 0.1 s interval: held, each replacing the previous one
+    assert not coalescer.offer(address, message(address, 1), 0.02)
+    assert not coalescer.offer(address, message(address, 2), 0.05)
+    assert coalescer.merged == 1
+    assert coalescer.next_due() == 0.1
+    assert coalescer.due(0.09) == []
+    assert coalescer.due(0.1) == [message(address, 2)]
+    assert coalescer.next_due() is None
+    # The interval starts again from the held message sent
+    assert not coalescer.offer(address, message(address, 3), 0.15)
+    assert coalescer.due(0.2) == [message(address, 3)]
+    assert coalescer.offer(address, message(address, 4), 0.31)
+
+
+def test_addresses_are_throttled_independently():
+    coalescer = Coalescer([{"address": "/fader/1", "window": 0.5},
+                           {"address": "/fader/*", "window": 0.1}])
+    assert coalescer.offer(b"/fader/1", message(b"/fader/1", 0), 0)
+    assert coalescer.offer(b"/fader/2", message(b"/fader/2", 0), 0)
+    assert not coalescer.offer(b"/fader/1", message(b"/fader/1", 1), 0.2)
+    assert coalescer.offer(b"/fader/2", message(b"/fader/2", 1), 0.2)
+    assert coalescer.due(0.4) == []
+    assert coalescer.due(0.5) == [message(b"/fader/1", 1)]
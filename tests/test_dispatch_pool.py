@@ -0,0 +1,76 @@
+"""
+Tests of the pool of threads handling items in parallel partitions.
+"""
+import threading
+import time
+
+import pytest
+from bridge_queue import DispatchPool
+
+
+def test_needs_a_partition():
+    with pytest.raises(ValueError):
+        DispatchPool(print, partitions=0)
+
+
+def test_items_of_a_key_are_handled_in_order():
+    handled = {}
+    threads = {}
+
+    def handler(item):
+        key, value = item
+        handled.setdefault(key, []).append(value)
+        threads.setdefault(key, set()).add(threading.current_thread().name)
+        time.sleep(0.0001)
+    pool = DispatchPool(handler, partitions=4, name="test")
+    pool.start()
+    keys = [f"/fader/{i}" for i in range(16)]
+    for value in range(50):
+        for key in keys:
+            pool.put((key, value))
+    pool.stop()
+    assert handled == {key: list(range(50)) for key in keys}
+    # Each key is handled by a single thread, the keys spread over several
+    assert all(len(names) == 1 for names in threads.values())
+    assert len(set.union(*threads.values())) > 1
+
+
+def test_stop_handles_the_queued_items():
+    handled = []
+    started = threading.Event()
+
+    def handler(item):
+        started.set()
+        time.sleep(0.01)
+        handled.append(item)
+    pool = DispatchPool(handler, partitions=2, key=lambda item: item % 2, name="test")
+    pool.start()
+    for item in range(20):
+        pool.put(item)
+    assert started.wait(1)
+    pool.stop()
+    assert sorted(handled) == list(range(20))
+    assert pool.threads == []
+
+
+def test_handler_errors_do_not_stop_the_threads():
+    handled = []
+
+    def handler(item):
+        if item[1] % 3 == 0:
+            raise RuntimeError("bad item")
+        handled.append(item[1])
+    pool = DispatchPool(handler, partitions=2, name="test")
+    pool.start()
+    for value in range(10):
+        pool.put(("key", value))
+    pool.stop()
+    assert handled == [1, 2, 4, 5, 7, 8]
+
+
+def test_capacity_is_split_between_the_partitions():
+    pool = DispatchPool(print, partitions=3, name="test", maxsize=10, policy="drop_newest")
+    assert [buffer.maxsize for buffer in pool.queues] == [4, 4, 4]
+    for value in range(10):
+        pool.put(("key", value))
+    assert pool.dropped == 6
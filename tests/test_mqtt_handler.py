@@ -0,0 +1,76 @@
+"""
+Tests of the MQTT client handler against the in-process MiniBroker.
+"""
+import threading
+import time
+
+import pytest
+from paho.mqtt import client as mqtt
+from mini_broker import MiniBroker
+from mqtt_handler import CONNECTED, MQTTClientHandler
+from spool import Spool
+
+
+@pytest.fixture
+def broker():
+    broker = MiniBroker()
+    port = broker.start()
+    yield port
+    broker.stop()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def retained(port, topic_filter):
+    """
+    Get the retained messages of the broker.
+    """
+    messages = {}
+    event = threading.Event()
+
+    def on_message(client, userdata, msg):
+        messages[msg.topic] = msg.payload
+        event.set()
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, "test-retained")
+    client.on_message = on_message
+    client.connect("127.0.0.1", port)
+    client.subscribe(topic_filter)
+    client.loop_start()
+    event.wait(2)
+    time.sleep(0.2)
+    client.loop_stop()
+    client.disconnect()
+    return messages
+
+
+def test_replay_does_not_overwrite_newer_messages(broker, tmp_path):
+    handler = MQTTClientHandler("127.0.0.1", broker, "test", "test", "test", tls=False,
+                                spool=Spool(str(tmp_path)), replay_rate=50)
+    # Spooled while disconnected
+    for i in range(20):
+        handler.publish_json("state/a", i, qos=0, retain=True)
+    for i in range(5):
+        handler.publish_json("state/b", i, qos=0, retain=True)
+    assert len(handler.spool) == 25
+    handler.connect()
+    handler.start()
+    try:
+        assert wait_for(lambda: handler.states[0] == CONNECTED)
+        # Published while the backlog is replayed, newer than the spooled messages of state/a
+        handler.publish_json("state/a", "live", qos=0, retain=True)
+        assert wait_for(lambda: not handler.spool)
+        assert retained(broker, "state/#") == {"state/a": b'"live"', "state/b": b"4"}
+        # Once replayed, state/a is spooled and replayed again after a disconnection
+        handler.states[0] = "connecting"
+        handler.publish_json("state/a", "spooled", qos=0, retain=True)
+        handler.states[0] = CONNECTED
+        handler._replay_event.set()
+        assert wait_for(lambda: not handler.spool)
+        assert retained(broker, "state/a")["state/a"] == b'"spooled"'
+    finally:
+        handler.stop()
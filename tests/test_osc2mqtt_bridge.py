@@ -0,0 +1,142 @@
+"""
+Tests of the bridge, against the in-process MiniBroker, and of its MQTT to OSC dispatch.
+"""
+import socket
+import struct
+import threading
+import time
+
+import pytest
+from paho.mqtt import client as mqtt
+from bench_bridge import free_port
+from mini_broker import MiniBroker
+from osc2mqtt_bridge import OSC2MQTTBridge
+
+# "/raw/x" with a double and an int64, which the OSC parser does not decode
+RAW_MESSAGE = b"/raw/x\0\0,dh\0" + struct.pack(">dq", 0.1, 2 ** 40 + 3)
+
+
+@pytest.fixture
+def bridge():
+    broker = MiniBroker()
+    mqtt_port = broker.start()
+    udp_port = free_port(socket.SOCK_DGRAM)
+    config = {
+        "mqtt": {"connection": {"broker": "127.0.0.1", "port": mqtt_port, "client_id": "test",
+                                "username": "test", "password": "test", "tls": False},
+                 "topics": {"publish": "osc/stat", "subscribe": "osc/cmnd"},
+                 "codecs": {"rules": [{"topic": "osc/stat/raw/#", "codec": "raw"}]}},
+        "osc": {"net": "127.0.0.1", "port": free_port(), "max_connections": 8,
+                "direct": True, "client_port": free_port(socket.SOCK_DGRAM),
+                "udp": {"net": "127.0.0.1", "port": udp_port}},
+        "bridge": {"auto_reset": []},
+    }
+    bridge = OSC2MQTTBridge(config)
+    bridge.start()
+    received = []
+    lock = threading.Lock()
+
+    def on_message(client, userdata, msg):
+        with lock:
+            received.append((msg.topic, msg.payload))
+    subscriber = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, "test-subscriber")
+    subscriber.on_message = on_message
+    subscriber.connect("127.0.0.1", mqtt_port)
+    subscriber.subscribe("osc/stat/#")
+    subscriber.loop_start()
+    time.sleep(0.3)
+
+    def send(packet):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(packet, ("127.0.0.1", udp_port))
+    yield send, received
+    subscriber.loop_stop()
+    subscriber.disconnect()
+    bridge.stop()
+    broker.stop()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_raw_codec_publishes_messages_unchanged(bridge):
+    send, received = bridge
+    send(RAW_MESSAGE)
+    assert wait_for(lambda: received)
+    assert received == [("osc/stat/raw/x", RAW_MESSAGE)]
+
+
+def test_raw_codec_publishes_the_messages_of_bundles_unchanged(bridge):
+    send, received = bridge
+    other = b"/raw/y\0\0,d\0\0" + struct.pack(">d", -1e300)
+    send(b"#bundle\0" + struct.pack(">Q", 1)
+         + b"".join(struct.pack(">i", len(message)) + message
+                    for message in (RAW_MESSAGE, other)))
+    assert wait_for(lambda: len(received) == 2)
+    assert received == [("osc/stat/raw/x", RAW_MESSAGE), ("osc/stat/raw/y", other)]
+
+
+@pytest.fixture
+def m2o_bridge():
+    """
+    A bridge sending the messages from MQTT to a list, with the auto reset of /pulse/*.
+    """
+    config = {
+        "mqtt": {"connection": {"broker": "127.0.0.1", "port": 1883, "client_id": "test",
+                                "username": "test", "password": "test", "tls": False},
+                 "topics": {"publish": "osc/stat", "subscribe": "osc/cmnd"}},
+        "osc": {"net": "127.0.0.1", "port": 0, "max_connections": 8, "direct": True},
+        "bridge": {"auto_reset": [{"address": "/pulse/*", "trigger": [1.0], "reset": [0.0],
+                                   "delay": 0.05}],
+                   "route_cache_size": 16},
+    }
+    bridge = OSC2MQTTBridge(config, directions=("m2o",))
+    sent = []
+    bridge._send_to_clients = lambda address, values: sent.append((address, list(values)))
+    bridge.scheduler.start()
+    yield bridge, sent
+    bridge.scheduler.stop()
+
+
+def test_auto_reset_after_the_trigger(m2o_bridge):
+    bridge, sent = m2o_bridge
+    bridge._m2o_dispatch(("osc/cmnd/pulse/1", 1.0))
+    bridge._m2o_dispatch(("osc/cmnd/fader/1", 1.0))
+    assert wait_for(lambda: len(sent) == 3)
+    time.sleep(0.1)
+    assert sent == [(b"/pulse/1", [1.0]), (b"/fader/1", [1.0]), (b"/pulse/1", [0.0])]
+
+
+def test_auto_reset_trigger_types_must_match(m2o_bridge):
+    bridge, sent = m2o_bridge
+    for value in (1, True, [1.0, 1.0]):
+        bridge._m2o_dispatch(("osc/cmnd/pulse/1", value))
+    time.sleep(0.2)
+    assert [values for _, values in sent] == [[1], [True], [1.0, 1.0]]
+
+
+def test_auto_reset_rules_are_cached_in_an_lru(m2o_bridge):
+    bridge, _ = m2o_bridge
+    for i in range(100):
+        bridge._auto_reset_rule(f"/pulse/{i}".encode())
+    assert bridge._auto_reset_rule.cache_info().currsize == 16
+
+
+def test_due_reset_does_not_fire_after_a_newer_message(m2o_bridge):
+    bridge, sent = m2o_bridge
+    bridge.scheduler.stop()  # The resets are fired by hand
+    bridge._m2o_dispatch(("osc/cmnd/pulse/1", 1.0))
+    first = bridge._pending_resets[b"/pulse/1"]
+    bridge._m2o_dispatch(("osc/cmnd/pulse/1", 1.0))
+    # The first reset, already due when the second trigger came, does not zero it
+    bridge._reset(b"/pulse/1", [0.0], first)
+    assert sent == [(b"/pulse/1", [1.0])] * 2
+    second = bridge._pending_resets[b"/pulse/1"]
+    bridge._m2o_dispatch(("osc/cmnd/pulse/1", 0.5))
+    bridge._reset(b"/pulse/1", [0.0], second)
+    assert sent[-1] == (b"/pulse/1", [0.5])
+    assert not bridge._pending_resets
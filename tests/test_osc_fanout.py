@@ -0,0 +1,37 @@
+"""
+Tests of the fan-out of the OSC messages to the clients.
+"""
+import socket
+
+import pytest
+from oscpy.parser import read_packet
+from osc_fanout import OscClientRegistry, OscFanout
+
+
+@pytest.fixture
+def receiver():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(2)
+    yield sock
+    sock.close()
+
+
+def test_sends_str_values_with_the_encoding(receiver):
+    registry = OscClientRegistry()
+    registry.add(receiver.getsockname())
+    fanout = OscFanout(registry, encoding="utf-8")
+    fanout.send_message(b"/label/1", ["Lead vocal"])
+    (address, _, values, _), = read_packet(receiver.recv(65536))
+    assert address == b"/label/1"
+    assert values == [b"Lead vocal"]
+
+
+def test_reserved_addresses_only_go_to_subscribed_clients(receiver):
+    registry = OscClientRegistry()
+    other = ("127.0.0.1", 9)
+    registry.add(other)
+    registry.add(receiver.getsockname())
+    registry.subscribe(receiver.getsockname(), ["/osc2mqtt/canary"])
+    assert registry.endpoints_for(b"/osc2mqtt/canary") == (receiver.getsockname(),)
+    assert registry.endpoints_for(b"/fader/1") == (other,)
@@ -0,0 +1,55 @@
+"""
+Tests of the decoders splitting an OSC TCP stream into OSC packets.
+"""
+import pytest
+from osc_framing import DECODERS, ENCODERS, SLIP_END, SLIP_ESC
+
+PACKETS = [b"/a\x00\x00,i\x00\x00\x00\x00\x00\x01", b"x" * 100, b"\x01\x02\x03\x04"]
+
+
+def decode(decoder, stream, chunk):
+    frames = []
+    for i in range(0, len(stream), chunk):
+        frames.extend(decoder.feed(stream[i:i + chunk]))
+    return frames
+
+
+@pytest.mark.parametrize("framing", sorted(DECODERS))
+@pytest.mark.parametrize("chunk", [1, 3, 17, 4096])
+def test_decodes_frames_split_across_reads(framing, chunk):
+    stream = b"".join(ENCODERS[framing](packet) for packet in PACKETS)
+    decoder = DECODERS[framing](max_frame_size=1024, buffer_size=8)
+    assert decode(decoder, stream, chunk) == PACKETS
+
+
+@pytest.mark.parametrize("framing", sorted(DECODERS))
+def test_decodes_escaped_bytes(framing):
+    packets = [SLIP_END * 3, SLIP_ESC + b"a" + SLIP_END + SLIP_ESC, b"\xdb\xdc\xdb\xdd"]
+    stream = b"".join(ENCODERS[framing](packet) for packet in packets)
+    decoder = DECODERS[framing](max_frame_size=1024, buffer_size=8)
+    assert decode(decoder, stream, 5) == packets
+
+
+@pytest.mark.parametrize("framing", sorted(DECODERS))
+@pytest.mark.parametrize("buffer_size", [4, 16, 64])
+def test_decodes_frames_of_the_maximum_size(framing, buffer_size):
+    packets = [bytes(range(16)), b"y" * 16]
+    stream = b"".join(ENCODERS[framing](packet) for packet in packets)
+    decoder = DECODERS[framing](max_frame_size=16, buffer_size=buffer_size)
+    assert decode(decoder, stream, 5) == packets
+    decoder = DECODERS[framing](max_frame_size=16, buffer_size=buffer_size)
+    assert decoder.feed(stream) == packets
+
+
+def test_slip_drops_oversized_frames():
+    packets = [b"a" * 16, b"b" * 17, b"c" * 100, b"d" * 8]
+    stream = b"".join(ENCODERS["slip"](packet) for packet in packets)
+    decoder = DECODERS["slip"](max_frame_size=16, buffer_size=4)
+    assert decode(decoder, stream, 5) == [b"a" * 16, b"d" * 8]
+
+
+def test_length_prefix_rejects_oversized_frames():
+    decoder = DECODERS["length"](max_frame_size=16, buffer_size=4)
+    assert decoder.feed(ENCODERS["length"](b"a" * 16)) == [b"a" * 16]
+    with pytest.raises(ValueError):
+        decoder.feed(ENCODERS["length"](b"b" * 17))
@@ -0,0 +1,76 @@
+"""
+Tests of the OSC bundles held until their timetag.
+"""
+import struct
+import time
+import pytest
+from oscpy.parser import format_bundle
+from bridge_queue import BridgeQueue
+from osc_handler import INVALID_PACKETS, OSCServerHandler, split_packet
+
+
+def bundle(*addresses, delay=5):
+    return format_bundle([(address, [1]) for address in addresses],
+                         timetag=time.time() + delay)[0]
+
+
+@pytest.fixture
+def handler_of():
+    handlers = []
+
+    def handler_of(queue):
+        handler = OSCServerHandler(None, osc_buffer=queue)
+        handler.start()
+        handlers.append(handler)
+        return handler
+
+    yield handler_of
+    for handler in handlers:
+        handler.stop()
+
+
+def test_holds_bundles_until_their_timetag(handler_of):
+    queue = BridgeQueue(10, "drop_newest")
+    handler = handler_of(queue)
+    handler.handle_packet(bundle(b"/a", b"/b", delay=0.2))
+    assert queue.qsize() == 0 and handler._held == 2
+    time.sleep(0.5)
+    assert [queue.get()[0] for _ in range(2)] == [b"/a", b"/b"]
+    assert handler._held == 0
+
+
+@pytest.mark.parametrize("policy, queued, dropped", [
+    ("drop_newest", [b"/q"], 2),
+    ("drop_oldest", [b"/b", b"/c"], 1),
+    ("block", [b"/q", b"/b", b"/c"], 0),
+])
+def test_held_messages_count_against_the_capacity(handler_of, policy, queued, dropped):
+    queue = BridgeQueue(3 if policy == "block" else 2, policy)
+    handler = handler_of(queue)
+    queue.put((b"/q", (1,)))
+    handler.handle_packet(bundle(b"/a"))
+    assert handler._held == 1
+    # No room for this bundle along with the queued and held messages: not held
+    handler.handle_packet(bundle(b"/b", b"/c"))
+    assert handler._held == 1
+    assert [queue.get_nowait()[0] for _ in range(queue.qsize())] == queued
+    assert queue.dropped == dropped
+
+
+def test_nested_bundles_are_flattened(handler_of):
+    inner = bundle(b"/b", b"/c", delay=0.3)
+    outer = bundle(b"/a", delay=0.1)
+    packet = outer + struct.pack(">i", len(inner)) + inner + outer[16:]
+    timetag, messages = split_packet(packet)
+    assert [address for address, _ in messages] == [b"/a", b"/b", b"/c", b"/a"]
+    assert timetag == pytest.approx(time.time() + 0.3, abs=0.05)
+    queue = BridgeQueue(10, "drop_newest")
+    handler = handler_of(queue)
+    invalid = INVALID_PACKETS.value
+    handler.handle_packet(packet)
+    assert handler._held == 4 and INVALID_PACKETS.value == invalid
+    time.sleep(0.5)
+    assert [queue.get()[0] for _ in range(4)] == [b"/a", b"/b", b"/c", b"/a"]
+    # A nested element which is not a valid bundle invalidates the packet
+    with pytest.raises(ValueError):
+        split_packet(outer + struct.pack(">i", 12) + inner[:12])
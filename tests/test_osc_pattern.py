@@ -0,0 +1,61 @@
+"""
+Tests of the matching of OSC addresses against OSC 1.0 address patterns.
+"""
+import pytest
+from osc_pattern import PatternIndex, compile_segment
+
+
+@pytest.mark.parametrize("pattern, matching, not_matching", [
+    ("/fader/1", ["/fader/1"], ["/fader/10", "/fader", "/fader/1/x"]),
+    ("/fader/?", ["/fader/1", "/fader/x"], ["/fader/10", "/fader/"]),
+    ("/fader/*", ["/fader/1", "/fader/10", "/fader/"], ["/fader/1/x", "/mute/1"]),
+    ("/x*y/z", ["/xy/z", "/xaay/z"], ["/xa/y/z"]),
+    ("/ch/[1-3]", ["/ch/1", "/ch/3"], ["/ch/4", "/ch/12"]),
+    ("/ch/[!1-3]", ["/ch/4", "/ch/a"], ["/ch/2", "/ch/"]),
+    ("/ch/[a-c-]", ["/ch/b", "/ch/-"], ["/ch/d"]),
+    ("/mix/{main,aux}/level", ["/mix/main/level", "/mix/aux/level"],
+     ["/mix/mon/level", "/mix/mainaux/level", "/mix/main,aux/level"]),
+    ("/a.b/+", ["/a.b/+"], ["/aXb/+", "/a.b/x"]),
+])
+def test_matches_osc_patterns(pattern, matching, not_matching):
+    index = PatternIndex()
+    index.add(pattern, "client")
+    for address in matching:
+        assert index.match(address) == {"client"}, address
+    for address in not_matching:
+        assert index.match(address) == set(), address
+
+
+def test_literal_segments_are_not_compiled():
+    assert compile_segment("fader") is None
+    with pytest.raises(ValueError):
+        compile_segment("[abc")
+    with pytest.raises(ValueError):
+        compile_segment("{a,b")
+
+
+def test_returns_the_values_of_all_the_matching_patterns():
+    index = PatternIndex()
+    index.add("/fader/*", "a")
+    index.add("/fader/[0-4]", "b")
+    index.add("/fader/3", "c")
+    index.add("/fader/3", "d")
+    index.add("/mute/*", "e")
+    assert index.match("/fader/3") == {"a", "b", "c", "d"}
+    assert index.match("/fader/7") == {"a"}
+    with pytest.raises(ValueError):
+        index.add("fader", "f")
+
+
+def test_remove_prunes_the_empty_branches():
+    index = PatternIndex()
+    index.add("/fader/*", "a")
+    index.add("/fader/*", "b")
+    index.add("/mix/{main,aux}/level", "a")
+    index.remove("/fader/*", "a")
+    assert index.match("/fader/1") == {"b"}
+    index.remove("/fader/*", "b")
+    index.remove("/mix/{main,aux}/level", "a")
+    index.remove("/unknown/pattern", "a")
+    assert index.match("/fader/1") == set()
+    assert not index._root.children and not index._root.wildcards
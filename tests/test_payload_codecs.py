@@ -0,0 +1,77 @@
+"""
+Tests of the codecs of the MQTT payloads.
+"""
+import struct
+
+import pytest
+import payload_codecs
+from payload_codecs import JsonCodec, MsgpackCodec, OscPacket, PayloadCodecs, RawOscCodec
+
+MESSAGE = [1, 0.5, "fader", b"blob", True, None]
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_json_round_trip(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(payload_codecs, "orjson", None)
+    elif payload_codecs.orjson is None:
+        pytest.skip("orjson is not installed")
+    codec = JsonCodec()
+    payload = codec.encode(MESSAGE)
+    assert isinstance(payload, bytes)
+    # Blobs are decoded to strings, JSON having no binary type
+    assert codec.decode(payload) == [1, 0.5, "fader", "blob", True, None]
+
+
+def test_json_other_encoding():
+    codec = JsonCodec("latin-1")
+    payload = codec.encode(["caf\xe9", "caf\xe9".encode("latin-1")])
+    assert codec.decode(payload) == ["caf\xe9", "caf\xe9"]
+
+
+def test_msgpack_round_trip():
+    pytest.importorskip("msgpack")
+    codec = MsgpackCodec()
+    assert codec.decode(codec.encode(MESSAGE)) == MESSAGE
+
+
+def test_msgpack_needs_its_package(monkeypatch):
+    monkeypatch.setattr(payload_codecs, "msgpack", None)
+    with pytest.raises(ImportError):
+        MsgpackCodec()
+
+
+def test_raw_round_trip():
+    codec = RawOscCodec()
+    message = b"/raw/x\0\0,d\0\0" + struct.pack(">d", 0.1)
+    bundle = b"#bundle\0" + struct.pack(">Qi", 1, len(message)) + message
+    for packet in (message, bundle):
+        payload = codec.encode(memoryview(packet))
+        assert payload == packet
+        decoded = codec.decode(payload)
+        assert isinstance(decoded, OscPacket) and decoded == packet
+
+
+def test_raw_rejects_what_is_not_osc():
+    codec = RawOscCodec()
+    with pytest.raises(TypeError):
+        codec.encode([1, 2])
+    for payload in (b'{"value": 1}', b"/raw/x\0", b"#bundl\0\0"):
+        with pytest.raises(ValueError):
+            codec.decode(payload)
+
+
+def test_resolve_first_matching_rule():
+    codecs = PayloadCodecs([{"topic": "osc/stat/raw/#", "codec": "raw"},
+                            {"topic": "osc/stat/+/json", "codec": "json"},
+                            {"topic": "osc/stat/#", "codec": "raw"}])
+    assert codecs.resolve("osc/stat/raw/json").name == "raw"
+    assert codecs.resolve("osc/stat/fader/json").name == "json"
+    assert codecs.resolve("osc/stat/fader").name == "raw"
+    assert codecs.resolve("other/fader").name == "json"
+    # The codecs are shared between the rules, and the topics cached
+    assert codecs.rules[0][1] is codecs.rules[2][1]
+    assert codecs.resolve("other/fader") is codecs.default
+    assert "other/fader" in codecs._cache
+    with pytest.raises(ValueError):
+        PayloadCodecs([{"topic": "#", "codec": "xml"}])
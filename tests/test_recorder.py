@@ -0,0 +1,48 @@
+"""
+Tests of the capture of the traffic crossing the bridge.
+"""
+import os
+
+from recorder import M2O, MAGIC, O2M, Recorder, read_capture
+
+PACKET = b"/fader/1\0\0\0\0,f\0\0\x3f\0\0\0"
+
+
+def test_round_trip(tmp_path):
+    recorder = Recorder(str(tmp_path))
+    recorder.record(O2M, b"", PACKET)
+    recorder.record(M2O, "osc/cmnd/caf\xe9".encode(), b"0.5")
+    recorder.close()
+    recorder.record(O2M, b"", PACKET)  # Ignored once closed
+    records = list(read_capture(str(tmp_path)))
+    assert [(r.direction, r.key, r.data) for r in records] == [
+        (O2M, b"", PACKET), (M2O, "osc/cmnd/caf\xe9".encode(), b"0.5")]
+    assert records[0].timestamp <= records[1].timestamp
+    assert recorder.recorded == 2
+
+
+def test_segments_are_rotated_and_deleted(tmp_path):
+    recorder = Recorder(str(tmp_path), segment_size=200, max_segments=3)
+    for i in range(40):
+        recorder.record(M2O, b"osc/cmnd/fader", str(i).encode())
+    recorder.close()
+    assert len(os.listdir(tmp_path)) == 3
+    data = [int(record.data) for record in read_capture(str(tmp_path))]
+    # The latest records, in order
+    assert data == list(range(40 - len(data), 40))
+    # A new run starts a segment after those of the previous ones
+    recorder = Recorder(str(tmp_path), max_segments=0)
+    recorder.record(O2M, b"", PACKET)
+    recorder.close()
+    assert list(read_capture(str(tmp_path)))[-1].data == PACKET
+
+
+def test_truncated_record_ends_its_segment(tmp_path):
+    recorder = Recorder(str(tmp_path))
+    recorder.record(O2M, b"", PACKET)
+    recorder.record(O2M, b"", PACKET)
+    recorder.close()
+    (segment,) = tmp_path.iterdir()
+    segment.write_bytes(segment.read_bytes()[:-4])
+    (tmp_path / "not-a-segment.rec").write_bytes(MAGIC)
+    assert [record.data for record in read_capture(str(tmp_path))] == [PACKET]
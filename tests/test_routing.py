@@ -0,0 +1,73 @@
+"""
+Tests of the routing table between OSC addresses and MQTT topics.
+"""
+import pytest
+from routing import RoutingTable, Transform
+
+CATCH_ALL = [{"osc": "", "mqtt": "osc/stat", "direction": "o2m"},
+             {"osc": "", "mqtt": "osc/cmnd", "direction": "m2o"}]
+
+
+def test_catch_all_routes():
+    table = RoutingTable(CATCH_ALL)
+    assert table.o2m(b"/fader/1") == ("osc/stat/fader/1", None)
+    assert table.m2o("osc/cmnd/fader/1") == (b"/fader/1", None)
+    assert table.m2o("other/fader/1") is None
+    # The topic of the route prefix itself has no address
+    assert table.m2o("osc/cmnd") is None
+
+
+def test_longest_prefix_and_wildcards():
+    table = RoutingTable(CATCH_ALL + [
+        {"osc": "/mixer", "mqtt": "desk/mixer", "direction": "o2m"},
+        {"osc": "/mixer/*/fader", "mqtt": "mix/+/level", "direction": "o2m"},
+        {"osc": "/mixer/*/fader", "mqtt": "mix/+/level", "direction": "m2o"},
+    ])
+    assert table.o2m(b"/mixer/3/fader")[0] == "mix/3/level"
+    assert table.o2m(b"/mixer/3/fader/fine")[0] == "mix/3/level/fine"
+    assert table.o2m(b"/mixer/3/mute")[0] == "desk/mixer/3/mute"
+    assert table.m2o("mix/7/level")[0] == b"/mixer/7/fader"
+
+
+def test_disabled_routes_drop_their_messages():
+    table = RoutingTable(CATCH_ALL + [
+        {"osc": "/private", "mqtt": "osc/stat/private", "direction": "o2m", "enabled": False},
+    ])
+    assert table.o2m(b"/private/1") is None
+    assert table.o2m(b"/public/1") is not None
+
+
+def test_transforms():
+    table = RoutingTable(CATCH_ALL + [
+        {"osc": "/fader", "mqtt": "osc/stat/percent", "direction": "o2m",
+         "transform": {"scale": 100, "type": "int"}},
+    ])
+    topic, transform = table.o2m(b"/fader/1")
+    assert topic == "osc/stat/percent/1"
+    assert transform([0.255, b"label"]) == [25, b"label"]
+    assert Transform(invert=True)([0.25]) == [0.75]
+    with pytest.raises(ValueError):
+        Transform(type="complex")
+
+
+@pytest.mark.parametrize("routes, subscriptions", [
+    # Under the catch-all subscribe topic
+    ([{"osc": "/lights", "mqtt": "osc/cmnd/lights", "direction": "m2o"},
+      {"osc": "/mixer/*/fader", "mqtt": "osc/cmnd/+/level", "direction": "m2o"}],
+     ["osc/cmnd/#"]),
+    # Covered by a wildcard route, or duplicated
+    ([{"osc": "/x", "mqtt": "other/+/x", "direction": "m2o"},
+      {"osc": "/y", "mqtt": "other/a/x/y", "direction": "m2o"},
+      {"osc": "/z", "mqtt": "other/+/x", "direction": "m2o"}],
+     ["osc/cmnd/#", "other/+/x/#"]),
+    # Not covered: a literal level does not cover a wildcard, nor a longer filter a shorter one
+    ([{"osc": "/x", "mqtt": "other/a/x", "direction": "m2o"},
+      {"osc": "/y", "mqtt": "other/+/x", "direction": "m2o"},
+      {"osc": "/z", "mqtt": "more/+/+", "direction": "m2o"},
+      {"osc": "/w", "mqtt": "more/a", "direction": "m2o"}],
+     ["osc/cmnd/#", "other/+/x/#", "more/+/+/#", "more/a/#"]),
+    # Disabled routes are not subscribed
+    ([{"osc": "/x", "mqtt": "other", "direction": "m2o", "enabled": False}], ["osc/cmnd/#"]),
+])
+def test_subscriptions_are_not_covered_by_one_another(routes, subscriptions):
+    assert RoutingTable(CATCH_ALL + routes).subscriptions == subscriptions
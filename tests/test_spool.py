@@ -0,0 +1,60 @@
+"""
+Tests of the disk spool.
+"""
+from spool import Spool
+
+
+def replay(spool, chunk=7):
+    messages = []
+    while True:
+        records = spool.read(chunk)
+        if not records:
+            return messages
+        for record in records:
+            messages.append((record.topic, record.payload))
+            spool.commit(record)
+
+
+def test_replays_in_order_across_segments(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=256)
+    sent = [(f"t/{i % 3}", f"{i}".encode()) for i in range(100)]
+    for topic, payload in sent:
+        spool.append(topic, payload, qos=1)
+    assert len(spool) == 100
+    assert replay(spool) == sent
+    assert len(spool) == 0
+    spool.close()
+
+
+def test_appends_while_replaying(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=256)
+    spool.append("a", b"1")
+    records = spool.read(10)
+    spool.append("a", b"2")
+    for record in records:
+        spool.commit(record)
+    spool.append("a", b"3")
+    assert replay(spool) == [("a", b"2"), ("a", b"3")]
+    spool.close()
+
+
+def test_uncommitted_records_are_read_again(tmp_path):
+    spool = Spool(str(tmp_path))
+    for i in range(5):
+        spool.append("a", str(i).encode())
+    first = spool.read(3)
+    spool.commit(first[0])
+    assert [record.payload for record in spool.read(3)] == [b"1", b"2", b"3"]
+    spool.close()
+
+
+def test_recovers_after_close(tmp_path):
+    spool = Spool(str(tmp_path))
+    for i in range(5):
+        spool.append("a", str(i).encode())
+    spool.commit(spool.read(2)[1])
+    spool.close()
+    spool = Spool(str(tmp_path))
+    assert len(spool) == 3
+    assert [payload for _, payload in replay(spool)] == [b"2", b"3", b"4"]
+    spool.close()
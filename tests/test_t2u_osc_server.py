@@ -0,0 +1,20 @@
+"""
+Tests of the TCP ingress engines.
+"""
+import threading
+
+import pytest
+from bench_bridge import free_port
+from t2u_osc_server import Tcp2UnixOscServer
+
+
+@pytest.mark.parametrize("engine", Tcp2UnixOscServer.ENGINES)
+def test_stop_right_after_start(engine):
+    server = Tcp2UnixOscServer("127.0.0.1", free_port(), 8, engine=engine, direct=True,
+                               packet_handler=lambda packet: None)
+    for _ in range(5):
+        server.start()
+        stopper = threading.Thread(target=server.stop)
+        stopper.start()
+        stopper.join(10)
+        assert not stopper.is_alive(), "stop() hung"
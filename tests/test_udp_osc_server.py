@@ -0,0 +1,77 @@
+"""
+Tests of the OSC over UDP ingress, through a bridge running against the in-process MiniBroker.
+"""
+import socket
+import threading
+import time
+
+import pytest
+from paho.mqtt import client as mqtt
+from bench_bridge import free_port
+from mini_broker import MiniBroker
+from osc2mqtt_bridge import OSC2MQTTBridge
+from oscpy.parser import format_message
+
+
+@pytest.fixture
+def bridge():
+    broker = MiniBroker()
+    mqtt_port = broker.start()
+    udp_port = free_port(socket.SOCK_DGRAM)
+    config = {
+        "mqtt": {"connection": {"broker": "127.0.0.1", "port": mqtt_port, "client_id": "test",
+                                "username": "test", "password": "test", "tls": False},
+                 "topics": {"publish": "osc/stat", "subscribe": "osc/cmnd"}},
+        "osc": {"net": "127.0.0.1", "port": free_port(), "max_connections": 8,
+                "direct": True, "client_port": free_port(socket.SOCK_DGRAM),
+                "udp": {"net": "127.0.0.1", "port": udp_port}},
+        "bridge": {"auto_reset": []},
+    }
+    bridge = OSC2MQTTBridge(config)
+    bridge.start()
+    received = []
+    event = threading.Event()
+
+    def on_message(client, userdata, msg):
+        received.append(msg.topic)
+        event.set()
+    subscriber = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, "test-subscriber")
+    subscriber.on_message = on_message
+    subscriber.connect("127.0.0.1", mqtt_port)
+    subscriber.subscribe("osc/stat/#")
+    subscriber.loop_start()
+    time.sleep(0.3)
+    yield bridge, udp_port, received
+    subscriber.loop_stop()
+    subscriber.disconnect()
+    bridge.stop()
+    broker.stop()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_publishes_udp_messages(bridge):
+    _, udp_port, received = bridge
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.sendto(format_message(b"/fader/1", [0.5])[0], ("127.0.0.1", udp_port))
+    assert wait_for(lambda: "osc/stat/fader/1" in received)
+
+
+def test_address_not_utf8_does_not_stop_the_bridge(bridge):
+    instance, udp_port, received = bridge
+    # "/bad/" followed by bytes which are not valid UTF-8, padded to 4 bytes, then ",i" 1
+    bad = b"/bad/\xff\xfe\x00,i\x00\x00\x00\x00\x00\x01"
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.sendto(bad, ("127.0.0.1", udp_port))
+        sock.sendto(format_message(b"/fader/1", [1])[0], ("127.0.0.1", udp_port))
+        assert wait_for(lambda: "osc/stat/fader/1" in received)
+        # Still publishing after the bad message
+        sock.sendto(bad, ("127.0.0.1", udp_port))
+        sock.sendto(format_message(b"/fader/2", [1])[0], ("127.0.0.1", udp_port))
+        assert wait_for(lambda: "osc/stat/fader/2" in received)
+    assert instance.o2m_task.thread.is_alive()
@@ -0,0 +1,98 @@
+"""
+Tests of the multi-process mode of the bridge.
+"""
+import socket
+import threading
+import time
+
+from bench_bridge import free_port
+from osc2mqtt_bridge import OSC2MQTTBridge
+from workers import BridgeWorkers, worker_config
+
+
+def bridge_config(mqtt_port, path="/tmp"):
+    return {
+        "mqtt": {"connection": {"broker": "127.0.0.1", "port": mqtt_port, "client_id": "test",
+                                "username": "test", "password": "test", "tls": False},
+                 "topics": {"publish": "osc/stat", "subscribe": "osc/cmnd"},
+                 "spool": {"path": f"{path}/spool"}},
+        "osc": {"net": "127.0.0.1", "port": free_port(), "max_connections": 8,
+                "direct": True, "client_port": free_port(socket.SOCK_DGRAM),
+                "unix_socket_path": f"{path}/osc.sock"},
+        "bridge": {"auto_reset": [], "canary": {}, "metrics": {"port": 9100},
+                   "state": {"path": f"{path}/state"}},
+    }
+
+
+def test_worker_config():
+    config = bridge_config(1883)
+    derived = worker_config(config, 2)
+    assert derived["mqtt"]["connection"]["client_id"] == "test-2"
+    assert derived["osc"]["reuse_port"]
+    assert derived["osc"]["unix_socket_path"] == "/tmp/osc.sock.2"
+    assert derived["mqtt"]["spool"]["path"] == "/tmp/spool/worker-2"
+    assert derived["bridge"]["metrics"]["port"] == 9103
+    assert "canary" not in derived["bridge"]
+    assert "path" not in derived["bridge"]["state"]
+    # The configuration of the main process is left untouched
+    assert config["mqtt"]["connection"]["client_id"] == "test"
+    assert "canary" in config["bridge"]
+
+
+def test_registers_the_clients_of_the_workers(tmp_path):
+    config = bridge_config(1883, tmp_path)
+    del config["bridge"]["canary"]
+    workers = BridgeWorkers(config, 2)
+    workers.bridge = OSC2MQTTBridge(config, directions=("m2o",))
+    registry = workers.bridge.t2u.osc_clients
+    endpoint = ("127.0.0.1", 9000)
+    workers._on_event(0, "add", endpoint)
+    workers._on_event(1, "add", endpoint)
+    workers._on_event(1, "remove", endpoint)
+    assert endpoint in registry
+    workers._on_event(1, "add", endpoint)
+    workers._forget_endpoints(0)
+    assert endpoint in registry
+    workers._forget_endpoints(1)
+    assert endpoint not in registry
+    workers._on_event(0, "state", [(b"/fader/1", b"message")])
+
+
+class CountingWorkers(BridgeWorkers):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.start_times = []
+
+    def _start_worker(self, index):
+        self.start_times.append(time.monotonic())
+        super()._start_worker(index)
+
+
+def test_restarts_failing_workers_with_a_backoff_then_gives_up(tmp_path):
+    # No broker: the worker fails to connect and exits at startup
+    config = bridge_config(free_port(), tmp_path)
+    del config["bridge"]["canary"]
+    del config["bridge"]["metrics"]
+    config["osc"]["unix_socket_path"] = None
+    workers = CountingWorkers(config, 1, restart_min_delay=0.5, max_restarts=2)
+    workers.bridge = OSC2MQTTBridge(config, directions=("m2o",))
+    workers.alive = True
+    workers._start_worker(0)
+    monitor = threading.Thread(target=workers._monitor_workers)
+    monitor.start()
+    try:
+        deadline = time.monotonic() + 50
+        while workers.restarts[0] != float("inf") and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert workers.restarts[0] == float("inf")
+    finally:
+        workers.alive = False
+        monitor.join()
+        workers.stop()
+    assert workers.processes[0].exitcode == 1
+    assert len(workers.start_times) == 3
+    delays = [later - earlier for earlier, later in zip(workers.start_times,
+                                                       workers.start_times[1:])]
+    # Each restart waits for the worker to exit, then for 0.5 s, then 1 s
+    assert delays[0] >= 0.5 and delays[1] >= 1